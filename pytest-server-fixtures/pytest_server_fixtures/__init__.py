@@ -1,5 +1,7 @@
+import getpass
 import socket
 import os
+import tempfile
 
 from pytest_fixture_config import Config
 from .util import get_random_id
@@ -17,9 +19,14 @@ class FixtureConfig(Config):
         'minio_image',
         'mongo_bin',
         'mongo_image',
+        'mongo_storage',
+        'mongo_cache_size_gb',
         'pg_config_executable',
+        'pg_cluster_cache',
         'redis_executable',
         'redis_image',
+        'redis_databases',
+        'redis_rdb_cache',
         'rethink_executable',
         'rethink_image',
         'httpd_executable',
@@ -31,7 +38,16 @@ class FixtureConfig(Config):
         'server_class',
         'session_id',
         'k8s_namespace',
-        'k8s_local_test'
+        'k8s_local_test',
+        'k8s_async_delete',
+        'k8s_pack_pods',
+        'pool_size',
+        'pool_max_reuse',
+        'background_teardown',
+        'teardown_workers',
+        'output_buffer_size',
+        'docker_reuse',
+        'docker_reuse_timeout',
     )
 
 # Default values for system resource locations - patch this to change defaults
@@ -44,6 +60,15 @@ DEFAULT_SERVER_FIXTURES_DISABLE_HTTP_PROXY = True
 DEFAULT_SERVER_FIXTURES_SERVER_CLASS = 'thread'
 DEFAULT_SERVER_FIXTURES_K8S_NAMESPACE = None
 DEFAULT_SERVER_FIXTURES_K8S_LOCAL_TEST = False
+DEFAULT_SERVER_FIXTURES_K8S_ASYNC_DELETE = False
+DEFAULT_SERVER_FIXTURES_K8S_PACK_PODS = False
+DEFAULT_SERVER_FIXTURES_POOL_SIZE = 0
+DEFAULT_SERVER_FIXTURES_POOL_MAX_REUSE = 100
+DEFAULT_SERVER_FIXTURES_BACKGROUND_TEARDOWN = False
+DEFAULT_SERVER_FIXTURES_TEARDOWN_WORKERS = 4
+DEFAULT_SERVER_FIXTURES_OUTPUT_BUFFER_SIZE = 0
+DEFAULT_SERVER_FIXTURES_DOCKER_REUSE = False
+DEFAULT_SERVER_FIXTURES_DOCKER_REUSE_TIMEOUT = 600
 DEFAULT_SERVER_FIXTURES_JAVA = 'java'
 DEFAULT_SERVER_FIXTURES_JENKINS_URL = 'http://acmejenkins.example.com'
 DEFAULT_SERVER_FIXTURES_JENKINS_WAR = '/usr/share/jenkins/jenkins.war'
@@ -52,9 +77,18 @@ DEFAULT_SERVER_FIXTURES_MINIO = 'minio'
 DEFAULT_SERVER_FIXTURES_MINIO_IMAGE = 'minio/minio:latest'
 DEFAULT_SERVER_FIXTURES_MONGO_BIN = 'mongod'
 DEFAULT_SERVER_FIXTURES_MONGO_IMAGE = 'mongo:3.6'
+DEFAULT_SERVER_FIXTURES_MONGO_STORAGE = 'disk'
+DEFAULT_SERVER_FIXTURES_MONGO_CACHE_SIZE_GB = 0
 DEFAULT_SERVER_FIXTURES_PG_CONFIG = 'pg_config'
+# initdb clusters belong to the user that created them
+DEFAULT_SERVER_FIXTURES_PG_CLUSTER_CACHE = os.path.join(tempfile.gettempdir(),
+                                                        'pytest-server-fixtures-pg-clusters-%s' % getpass.getuser())
 DEFAULT_SERVER_FIXTURES_REDIS = 'redis-server'
 DEFAULT_SERVER_FIXTURES_REDIS_IMAGE = 'redis:5.0.2-alpine'
+DEFAULT_SERVER_FIXTURES_REDIS_DATABASES = 16
+# Per-user, as other users can't create files in a cache directory we made
+DEFAULT_SERVER_FIXTURES_REDIS_RDB_CACHE = os.path.join(tempfile.gettempdir(),
+                                                       'pytest-server-fixtures-redis-rdb-%s' % getpass.getuser())
 DEFAULT_SERVER_FIXTURES_RETHINK = 'rethinkdb'
 DEFAULT_SERVER_FIXTURES_RETHINK_IMAGE = 'rethinkdb:2.3.6'
 DEFAULT_SERVER_FIXTURES_HTTPD = 'apache2'
@@ -71,6 +105,20 @@ CONFIG = FixtureConfig(
     server_class=os.getenv('SERVER_FIXTURES_SERVER_CLASS', DEFAULT_SERVER_FIXTURES_SERVER_CLASS),
     k8s_namespace=os.getenv('SERVER_FIXTURES_K8S_NAMESPACE', DEFAULT_SERVER_FIXTURES_K8S_NAMESPACE),
     k8s_local_test=os.getenv('SERVER_FIXTURES_K8S_LOCAL_TEST', DEFAULT_SERVER_FIXTURES_K8S_LOCAL_TEST),
+    k8s_async_delete=str(os.getenv('SERVER_FIXTURES_K8S_ASYNC_DELETE',
+                                   DEFAULT_SERVER_FIXTURES_K8S_ASYNC_DELETE)).lower() in ('1', 'true', 'yes'),
+    k8s_pack_pods=str(os.getenv('SERVER_FIXTURES_K8S_PACK_PODS',
+                                DEFAULT_SERVER_FIXTURES_K8S_PACK_PODS)).lower() in ('1', 'true', 'yes'),
+    pool_size=int(os.getenv('SERVER_FIXTURES_POOL_SIZE', DEFAULT_SERVER_FIXTURES_POOL_SIZE)),
+    pool_max_reuse=int(os.getenv('SERVER_FIXTURES_POOL_MAX_REUSE', DEFAULT_SERVER_FIXTURES_POOL_MAX_REUSE)),
+    background_teardown=str(os.getenv('SERVER_FIXTURES_BACKGROUND_TEARDOWN',
+                                      DEFAULT_SERVER_FIXTURES_BACKGROUND_TEARDOWN)).lower() in ('1', 'true', 'yes'),
+    teardown_workers=int(os.getenv('SERVER_FIXTURES_TEARDOWN_WORKERS', DEFAULT_SERVER_FIXTURES_TEARDOWN_WORKERS)),
+    output_buffer_size=int(os.getenv('SERVER_FIXTURES_OUTPUT_BUFFER_SIZE', DEFAULT_SERVER_FIXTURES_OUTPUT_BUFFER_SIZE)),
+    docker_reuse=str(os.getenv('SERVER_FIXTURES_DOCKER_REUSE',
+                               DEFAULT_SERVER_FIXTURES_DOCKER_REUSE)).lower() in ('1', 'true', 'yes'),
+    docker_reuse_timeout=int(os.getenv('SERVER_FIXTURES_DOCKER_REUSE_TIMEOUT',
+                                       DEFAULT_SERVER_FIXTURES_DOCKER_REUSE_TIMEOUT)),
     session_id=os.getenv('SERVER_FIXTURES_SESSION_ID', DEFAULT_SERVER_FIXTURES_SESSION_ID),
     java_executable=os.getenv('SERVER_FIXTURES_JAVA', DEFAULT_SERVER_FIXTURES_JAVA),
     jenkins_war=os.getenv('SERVER_FIXTURES_JENKINS_WAR', DEFAULT_SERVER_FIXTURES_JENKINS_WAR),
@@ -79,9 +127,14 @@ CONFIG = FixtureConfig(
     minio_image=os.getenv('SERVER_FIXTURES_MINIO_IMAGE', DEFAULT_SERVER_FIXTURES_MINIO_IMAGE),
     mongo_bin=os.getenv('SERVER_FIXTURES_MONGO_BIN', DEFAULT_SERVER_FIXTURES_MONGO_BIN),
     mongo_image=os.getenv('SERVER_FIXTURES_MONGO_IMAGE', DEFAULT_SERVER_FIXTURES_MONGO_IMAGE),
+    mongo_storage=os.getenv('SERVER_FIXTURES_MONGO_STORAGE', DEFAULT_SERVER_FIXTURES_MONGO_STORAGE),
+    mongo_cache_size_gb=float(os.getenv('SERVER_FIXTURES_MONGO_CACHE_SIZE_GB', DEFAULT_SERVER_FIXTURES_MONGO_CACHE_SIZE_GB)),
     pg_config_executable=os.getenv('SERVER_FIXTURES_PG_CONFIG', DEFAULT_SERVER_FIXTURES_PG_CONFIG),
+    pg_cluster_cache=os.getenv('SERVER_FIXTURES_PG_CLUSTER_CACHE', DEFAULT_SERVER_FIXTURES_PG_CLUSTER_CACHE),
     redis_executable=os.getenv('SERVER_FIXTURES_REDIS', DEFAULT_SERVER_FIXTURES_REDIS),
     redis_image=os.getenv('SERVER_FIXTURES_REDIS_IMAGE', DEFAULT_SERVER_FIXTURES_REDIS_IMAGE),
+    redis_databases=int(os.getenv('SERVER_FIXTURES_REDIS_DATABASES', DEFAULT_SERVER_FIXTURES_REDIS_DATABASES)),
+    redis_rdb_cache=os.getenv('SERVER_FIXTURES_REDIS_RDB_CACHE', DEFAULT_SERVER_FIXTURES_REDIS_RDB_CACHE),
     rethink_executable=os.getenv('SERVER_FIXTURES_RETHINK', DEFAULT_SERVER_FIXTURES_RETHINK),
     rethink_image=os.getenv('SERVER_FIXTURES_RETHINK_IMAGE', DEFAULT_SERVER_FIXTURES_RETHINK_IMAGE),
     httpd_executable=os.getenv('SERVER_FIXTURES_HTTPD', DEFAULT_SERVER_FIXTURES_HTTPD),
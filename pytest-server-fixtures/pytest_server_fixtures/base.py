@@ -14,10 +14,16 @@ import logging
 import random
 import errno
 
+import psutil
 from six import string_types
 
 from pytest_server_fixtures import CONFIG
 from pytest_shutil.workspace import Workspace
+from .ports import find_free_port, find_listening_pids, lease_port, release_port
+from .readiness import LogLineProbe, TCPProbe
+from .snapshot import Snapshot
+from . import reaper, timings
+from .output import RingBuffer, read_lines, track
 
 log = logging.getLogger(__name__)
 
@@ -60,10 +66,12 @@ def get_ephemeral_host(cached=True, regen_cache=False):
     return res
 
 
-def get_ephemeral_port(port=0, host=None, cache_host=True):
+def get_ephemeral_port(port=0, host=None, cache_host=True, lease=False):
     """
     Get an ephemeral socket at random from the kernel.
 
+    Ports leased by other processes are never returned at random.
+
     Parameters
     ----------
     port: `str`
@@ -72,6 +80,9 @@ def get_ephemeral_port(port=0, host=None, cache_host=True):
         If specified, use this host. Otherwise it will use a temporary IP in the 127.0.0.0/24 range
     cache_host: `bool`
         If True, the generated host is cached. This has no effect if you specify the host.
+    lease: `bool`
+        If True, the port stays leased to this process until it is passed to
+        `ports.release_port`, so other processes on the same machine will not be given it.
 
     Returns
     -------
@@ -80,49 +91,47 @@ def get_ephemeral_port(port=0, host=None, cache_host=True):
     if host is None:
         host = get_ephemeral_host(cached=cache_host)
 
-    # Dynamic port-range:
-    # * cat /proc/sys/net/ipv4/ip_local_port_range
-    # 32768   61000
-    if port == 0:
-        port = random.randrange(1024, 32768)
+    if lease:
+        return lease_port(host, port).port
+    return find_free_port(host, port)
 
-    while True:
-        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        try:
-            s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-            s.bind((host, port))
-            port = s.getsockname()[1]
-            s.close()
-            return port
-        except socket.error:
-            port = random.randrange(1024, 32768)
 
+class ProcessReader(object):
+    """ Forwards the output of a server process to stderr or the log, and to callbacks.
 
-class ProcessReader(threading.Thread):
-    def __init__(self, process, stream, stderr):
+        The stream is read by the process-wide `output.OutputMultiplexer` thread once start()
+        is called.
+    """
+    def __init__(self, process, stream, stderr, callbacks=None, buffer=None):
         self.stderr = stderr
         self.process = process
         self.stream = stream
-        super(ProcessReader, self).__init__()
-        self.setDaemon(True)
+        self.callbacks = callbacks if callbacks is not None else []
+        self.buffer = buffer
 
-    def run(self):
-        while self.process.poll() is None:
-            l = self.stream.readline()
-            if not isinstance(l, string_types):
-                l = l.decode('utf-8')
-
-            if l.strip():
-                if self.stderr:
-                    sys.stderr.writelines(l.strip() + "\n")
-                else:
-                    log.debug(l.strip())
+    def start(self):
+        read_lines(self.stream, self.handle_line)
+
+    def handle_line(self, l):
+        if self.buffer is not None and not isinstance(l, string_types):
+            self.buffer.write(l)
+        if not isinstance(l, string_types):
+            l = l.decode('utf-8', 'replace')
+
+        if l.strip():
+            for callback in self.callbacks:
+                callback(l)
+            if self.stderr:
+                sys.stderr.writelines(l.strip() + "\n")
+            else:
+                log.debug(l.strip())
 
 
 class ServerThread(threading.Thread):
     """ Class for running the server in a thread """
 
-    def __init__(self, hostname, port, run_cmd, run_stdin=None, env=None, cwd=None):
+    def __init__(self, hostname, port, run_cmd, run_stdin=None, env=None, cwd=None, line_callback=None,
+                 output_buffer=None):
         threading.Thread.__init__(self)
         self.hostname = hostname
         self.port = port
@@ -132,8 +141,11 @@ class ServerThread(threading.Thread):
         self.exit = False
         self.env = env or dict(os.environ)
         self.cwd = cwd or os.getcwd()
+        # Output is only captured (and so visible to line_callback) when not in DEBUG mode
+        self.capturing = 'DEBUG' not in os.environ
+        callbacks = [line_callback] if line_callback else []
 
-        if 'DEBUG' in os.environ:
+        if not self.capturing:
             self.p = subprocess.Popen(self.run_cmd, env=self.env, cwd=self.cwd,
                                       stdin=subprocess.PIPE if run_stdin else None)
         else:
@@ -141,8 +153,8 @@ class ServerThread(threading.Thread):
                                       stdin=subprocess.PIPE if run_stdin else None,
                                       stdout=subprocess.PIPE,
                                       stderr=subprocess.PIPE)
-            ProcessReader(self.p, self.p.stdout, False).start()
-            ProcessReader(self.p, self.p.stderr, True).start()
+            ProcessReader(self.p, self.p.stdout, False, callbacks, output_buffer).start()
+            ProcessReader(self.p, self.p.stderr, True, callbacks, output_buffer).start()
 
     def run(self):
         log.debug("Running server: %s" % ' '.join(self.run_cmd))
@@ -170,6 +182,8 @@ class TestServer(Workspace):
         installed during tests_require
     cache_host: `bool`
         Use cached ephemeral hostnames
+    snapshot: `bool`
+        Snapshot the `snapshot_dirs` of the workspace in save(), so they can be rolled back with restore()
     """
     server = None
     serverclass = ServerThread  # Child classes can set this to a different serverthread class
@@ -181,8 +195,24 @@ class TestServer(Workspace):
     # Number of seconds to wait between kill retries. Increase if the service takes a while to die
     kill_retry_delay = 1
 
-    def __init__(self, workspace=None, delete=None, preserve_sys_path=False, cache_host=True, **kwargs):
+    # Number of seconds to wait for the readiness probe before falling back to polling check_server_up
+    readiness_timeout = 60
+
+    # Workspace directories holding the server's data, relative to the workspace. Use '.' for all of it.
+    snapshot_dirs = ()
+
+    def __init__(self, workspace=None, delete=None, preserve_sys_path=False, cache_host=True, snapshot=False,
+                 **kwargs):
         super(TestServer, self).__init__(workspace=workspace, delete=delete)
+        self.snapshot = snapshot
+        self._snapshot = None
+        self._teardown_submitted = False
+        self._fixture_scope = timings.current_scope()
+        self.output_buffer = None
+        if CONFIG.output_buffer_size:
+            # Recent server output, attached to the reports of failing tests
+            self.output_buffer = RingBuffer(CONFIG.output_buffer_size)
+            track(self)
         self.hostname = kwargs.get('hostname') or get_ephemeral_host(cached=cache_host)
         self.port = kwargs.get('port') or self.get_port()
         # We don't know if the server is alive or dead at this point, assume alive
@@ -202,9 +232,11 @@ class TestServer(Workspace):
     def start(self):
         self.kill()
         try:
-            self.pre_setup()
+            with timings.phase(self, 'pre_setup'):
+                self.pre_setup()
             self.start_server(env=self.env)
-            self.post_setup()
+            with timings.phase(self, 'post_setup'):
+                self.post_setup()
             self.save()
         except:
             self.teardown()
@@ -217,7 +249,7 @@ class TestServer(Workspace):
         if not self.random_port:
             return self.port_seed - int(hashlib.sha1((os.environ['USER']
                                                       + self.__class__.__name__).encode('utf-8')).hexdigest()[:3], 16)
-        return get_ephemeral_port(host=self.hostname)
+        return get_ephemeral_port(host=self.hostname, lease=True)
 
     def pre_setup(self):
         """ This should execute any setup required before starting the server
@@ -247,12 +279,19 @@ class TestServer(Workspace):
         """
         raise NotImplementedError("Concrete class should implement this")
 
-    def wait_for_go(self, start_interval=0.1, retries_per_interval=3, retry_limit=28, base=2.0):
+    def readiness_probe(self):
+        """ Returns a cheap `readiness.ReadinessProbe` that must fire before check_server_up
+            is called, or None to rely on polling check_server_up alone.
+        """
+        return TCPProbe(self.hostname, self.port)
+
+    def wait_for_go(self, start_interval=0.1, retries_per_interval=3, retry_limit=28, base=2.0, probe=None):
         """
         This is called to wait until the server has started running.
 
-        Uses a binary exponential backoff algorithm to set wait interval
-        between retries. This finds the happy medium between quick starting
+        Waits for the readiness probe to fire first, then uses a binary
+        exponential backoff algorithm to set wait interval between retries
+        of check_server_up. This finds the happy medium between quick starting
         servers (e.g. in-memory DBs) while remaining useful for the slower
         starting servers (e.g. web servers).
 
@@ -266,6 +305,8 @@ class TestServer(Workspace):
             total number of retries to attempt before giving up
         base: ``float``
             backoff multiplier
+        probe: `readiness.ReadinessProbe`
+            probe to wait on, defaults to self.readiness_probe()
 
         """
         if start_interval <= 0.0:
@@ -275,6 +316,10 @@ class TestServer(Workspace):
 
         retry_count = retry_limit
         start_time = datetime.now()
+        if probe is None:
+            probe = self.readiness_probe()
+        if probe is not None and not probe.wait(self.readiness_timeout):
+            log.debug('readiness probe %r did not fire, falling back to polling' % probe)
         while retry_count > 0:
             for _ in range(retries_per_interval):
                 log.debug('sleeping for %s before retrying (%d of %d)'
@@ -295,41 +340,64 @@ class TestServer(Workspace):
         """ Start the server instance.
         """
         log.debug("Starting Server on host %s port %s" % (self.hostname, self.port))
+        probe = self.readiness_probe()
+        kwargs = {}
+        if isinstance(probe, LogLineProbe):
+            kwargs['line_callback'] = probe.feed
+        if self.output_buffer is not None:
+            kwargs['output_buffer'] = self.output_buffer
         self.server = self.serverclass(self.hostname, self.port, self.run_cmd, self.run_stdin,
-                                       env=getattr(self, "env", env), cwd=self.cwd)
-        self.server.start()
-        self.wait_for_go()
+                                       env=getattr(self, "env", env), cwd=self.cwd, **kwargs)
+        if isinstance(probe, LogLineProbe) and self.server.capturing:
+            probe.attach()
+        with timings.phase(self, 'launch'):
+            self.server.start()
+        with timings.phase(self, 'wait_for_go'):
+            self.wait_for_go(probe=probe)
         log.debug("Server now awake")
         self.dead = False
 
+    def _find_pids(self):
+        """ Find the pids of the processes listening on our port
+        """
+        ip = socket.gethostbyname(self.hostname)
+        if not OSX:
+            pids = find_listening_pids(ip, self.port)
+            if pids is not None:
+                return list(pids)
+            netstat_cmd = ("netstat -anp 2>/dev/null | grep %s:%s | grep LISTEN | "
+                           "awk '{ print $7 }' | cut -d'/' -f1" % (ip, self.port))
+        else:
+            netstat_cmd = "lsof -n -i:{} | grep LISTEN | awk '{{ print $2 }}'".format(self.port)
+        return [p.strip() for p in self.run(netstat_cmd, capture=True, cd='/').split('\n') if p.strip()]
+
     def _find_and_kill(self, retries, signal):
         log.debug("Killing server running at {}:{} using signal {}".format(self.hostname, self.port, signal))
         for _ in range(retries):
-            if OSX:
-                netstat_cmd = "lsof -n -i:{} | grep LISTEN | awk '{{ print $2 }}'".format(self.port)
-            else:
-                netstat_cmd = ("netstat -anp 2>/dev/null | grep %s:%s | grep LISTEN | "
-                            "awk '{ print $7 }' | cut -d'/' -f1" % (socket.gethostbyname(self.hostname), self.port))
-            pids = [p.strip() for p in self.run(netstat_cmd, capture=True, cd='/').split('\n') if p.strip()]
+            pids = self._find_pids()
 
             if not pids:
                 # No PIDs remaining, server has died.
                 break
 
+            procs = []
             for pid in pids:
                 try:
                     pid = int(pid)
                 except ValueError:
                     log.error("Can't determine port, process shutting down or owned by someone else")
-                else:
-                    try:
-                        os.kill(pid, signal)
-                    except OSError as oe:
-                        if oe.errno == errno.ESRCH:  # Process doesn't appear to exist.
-                            log.error("For some reason couldn't find PID {} to kill.".format(p))
-                        else:
-                            raise
-            time.sleep(self.kill_retry_delay)
+                    continue
+                try:
+                    procs.append(psutil.Process(pid))
+                    os.kill(pid, signal)
+                except (OSError, psutil.NoSuchProcess) as oe:
+                    if isinstance(oe, psutil.NoSuchProcess) or oe.errno == errno.ESRCH:
+                        # Process doesn't appear to exist.
+                        log.error("For some reason couldn't find PID {} to kill.".format(pid))
+                    else:
+                        raise
+            # Returns as soon as the processes have exited rather than sleeping the full delay
+            psutil.wait_procs(procs, timeout=self.kill_retry_delay)
         else:
             raise ServerNotDead("Server not dead after %d retries" % retries)
 
@@ -346,27 +414,60 @@ class TestServer(Workspace):
         if self.dead:
             return
 
-        try:
-            self._find_and_kill(retries, self.kill_signal)
-        except ServerNotDead:
-            log.error("Server not dead after %d retries, trying with SIGKILL" % retries)
-        try:
-            self._find_and_kill(retries, signal.SIGKILL)
-        except ServerNotDead:
-            log.error("Server still not dead, giving up")
+        with timings.phase(self, 'kill'):
+            try:
+                self._find_and_kill(retries, self.kill_signal)
+            except ServerNotDead:
+                log.error("Server not dead after %d retries, trying with SIGKILL" % retries)
+            try:
+                self._find_and_kill(retries, signal.SIGKILL)
+            except ServerNotDead:
+                log.error("Server still not dead, giving up")
 
     def teardown(self):
         """ Called when tearing down this instance, eg in a context manager
+
+            With CONFIG.background_teardown the workspace is moved to a trash path and the
+            server is killed and deleted in the background by the `reaper`.
         """
+        if CONFIG.background_teardown:
+            if not self._teardown_submitted:
+                self._teardown_submitted = True
+                if self.delete is None or self.delete:
+                    self.workspace = self.workspace.__class__(reaper.trash(self.workspace))
+                reaper.submit('teardown of %s' % self.__class__.__name__, self._teardown)
+            return
+        self._teardown()
+
+    def _teardown(self):
         self.kill()
-        super(TestServer, self).teardown()
+        release_port(self.port)
+        if self._snapshot:
+            self._snapshot.discard()
+        with timings.phase(self, 'rmtree'):
+            super(TestServer, self).teardown()
 
     def save(self):
         """ Called to save any state that can be then restored using self.restore
+
+            When snapshots are enabled, the server is stopped while its `snapshot_dirs`
+            are captured, then started again.
         """
-        pass
+        if not (self.snapshot and self.snapshot_dirs):
+            return
+        self.kill()
+        if self._snapshot is None:
+            self._snapshot = Snapshot(self.workspace, self.snapshot_dirs)
+        with timings.phase(self, 'save'):
+            self._snapshot.capture()
+        self.start_server(env=self.env)
 
     def restore(self):
         """ Called to restore any state that was saved using using self.save
         """
-        pass
+        if self._snapshot is None:
+            return
+        self.kill()
+        with timings.phase(self, 'restore'):
+            self._snapshot.restore()
+        self.start_server(env=self.env)
@@ -7,6 +7,11 @@ from datetime import datetime
 from pytest_server_fixtures import CONFIG
 from pytest_shutil.workspace import Workspace
 from .base import get_ephemeral_host, get_ephemeral_port
+from .ports import release_port
+from .readiness import LogLineProbe, TCPProbe
+from .snapshot import Snapshot
+from . import reaper, timings
+from .output import RingBuffer, track
 from .serverclass import create_server
 
 log = logging.getLogger(__name__)
@@ -22,8 +27,12 @@ class TestServerV2(Workspace):
     random_port = True
     random_hostname = True
     port_seed = 65535
+    # Number of seconds to wait for the readiness probe before falling back to polling check_server_up
+    readiness_timeout = 60
+    # Workspace directories holding the server's data, relative to the workspace. Use '.' for all of it.
+    snapshot_dirs = ()
 
-    def __init__(self, cwd=None, workspace=None, delete=None, server_class=CONFIG.server_class):
+    def __init__(self, cwd=None, workspace=None, delete=None, server_class=CONFIG.server_class, snapshot=False):
         """
         Initialise a test server.
 
@@ -31,12 +40,25 @@ class TestServerV2(Workspace):
         @param workspace: where all files will be stored
         @param delete: whether to delete the workspace after teardown or not
         @param server_class: specify server class name (default from CONFIG.server_class)
+        @param snapshot: snapshot the snapshot_dirs in save() so they can be rolled back with restore()
         """
         super(TestServerV2, self).__init__(workspace=workspace, delete=delete)
+        self.snapshot = snapshot
+        self._snapshot = None
         self._cwd = cwd or os.getcwd()
         self._server_class = server_class
         self._server = None
         self._killed = False
+        self._leased_ports = []
+        # serverclass.kubernetes.PackedPod this server runs in, set by group.ServerGroup
+        self.packed_pod = None
+        self._teardown_submitted = False
+        self._fixture_scope = timings.current_scope()
+        self.output_buffer = None
+        if CONFIG.output_buffer_size:
+            # Recent server output, attached to the reports of failing tests
+            self.output_buffer = RingBuffer(CONFIG.output_buffer_size)
+            track(self)
         self._listen_hostname = self._get_hostname()
 
     def start(self):
@@ -47,33 +69,59 @@ class TestServerV2(Workspace):
             raise TestServerAlreadyKilledException()
 
         try:
-            self._server = create_server(
-                server_class=CONFIG.server_class,
-                server_type=self.__class__.__name__,
-                cmd=self.cmd,
-                cmd_local=self.cmd_local,
-                get_args=self.get_args,
-                env=self.env,
-                image=self.image,
-                labels=self.labels,
-                workspace=self.workspace,
-                cwd=self._cwd,
-                listen_hostname=self._listen_hostname,
-            )
-
-            if self._server_class == 'thread':
-                self.pre_setup()
-
-            self._server.launch()
-            self._wait_for_go()
-            log.debug("Server now awake")
-
-            self.post_setup()
+            self._launch_server(pre_setup=True)
+            with timings.phase(self, 'post_setup'):
+                self.post_setup()
+            self.save()
         except OSError as err:
             log.warning("Error when starting the test server.")
             log.debug(err)
             raise
 
+    def _launch_server(self, pre_setup=False):
+        """
+        Create the server class instance, launch it and wait for it to come up.
+        """
+        self._server = create_server(
+            server_class=CONFIG.server_class,
+            server_type=self.__class__.__name__,
+            cmd=self.cmd,
+            cmd_local=self.cmd_local,
+            get_args=self.get_args,
+            env=self.env,
+            image=self.image,
+            labels=self.labels,
+            workspace=self.workspace,
+            cwd=self._cwd,
+            listen_hostname=self._listen_hostname,
+            # Containers can only be reused by servers that know how to reset them
+            reuse=CONFIG.docker_reuse and self._supports_reset(),
+            packed_pod=self.packed_pod,
+        )
+
+        self._server.output_buffer = self.output_buffer
+        probe = None
+        if self._server_class == 'thread':
+            if pre_setup:
+                with timings.phase(self, 'pre_setup'):
+                    self.pre_setup()
+            probe = self.readiness_probe()
+            if isinstance(probe, LogLineProbe):
+                # Log line probes must be hooked up to the output before the process starts
+                self._server.line_callbacks.append(probe.feed)
+                if self._server.captures_output:
+                    probe.attach()
+
+        with timings.phase(self, 'launch'):
+            self._server.launch()
+        with timings.phase(self, 'wait_for_go'):
+            self._wait_for_go(probe=probe)
+        if getattr(self._server, 'reused', False):
+            # Attached to a container left by an earlier fixture
+            with timings.phase(self, 'reset'):
+                self.reset()
+        log.debug("Server now awake")
+
     def kill(self):
         """
         Stop the server and clean up all resources.
@@ -89,15 +137,72 @@ class TestServerV2(Workspace):
         # Prevent traceback printed when the server goes away as we kill it
         self._server.exit = True
 
-        self._server.teardown()
+        with timings.phase(self, 'kill'):
+            self._server.teardown()
         self._server = None
         self._killed = True
 
     def teardown(self):
-        """ Called when tearing down this instance, eg in a context manager
         """
+        Called when tearing down this instance, eg in a context manager.
+
+        With CONFIG.background_teardown the workspace is moved to a trash path and the
+        server is killed and deleted in the background by the `reaper`.
+        """
+        if CONFIG.background_teardown:
+            if not self._teardown_submitted:
+                self._teardown_submitted = True
+                if self.delete is None or self.delete:
+                    self.workspace = self.workspace.__class__(reaper.trash(self.workspace))
+                reaper.submit('teardown of %s' % self.__class__.__name__, self._teardown)
+            return
+        self._teardown()
+
+    def _teardown(self):
         self.kill()
-        super(TestServerV2, self).teardown()
+        for port in self._leased_ports:
+            release_port(port)
+        self._leased_ports = []
+        if self._snapshot:
+            self._snapshot.discard()
+        with timings.phase(self, 'rmtree'):
+            super(TestServerV2, self).teardown()
+
+    def save(self):
+        """
+        Save the server's data so it can be rolled back with restore().
+
+        Only used when snapshots are enabled and SERVER_FIXTURE_SERVER_CLASS is 'thread'.
+        The server is stopped while its snapshot_dirs are captured, then started again.
+        """
+        if not (self.snapshot and self.snapshot_dirs and self._server_class == 'thread'):
+            return
+        self._stop_server()
+        if self._snapshot is None:
+            self._snapshot = Snapshot(self.workspace, self.snapshot_dirs)
+        with timings.phase(self, 'save'):
+            self._snapshot.capture()
+        self._launch_server()
+
+    def restore(self):
+        """
+        Roll the server's data back to the state captured by the last save().
+        """
+        if self._snapshot is None:
+            return
+        self._stop_server()
+        with timings.phase(self, 'restore'):
+            self._snapshot.restore()
+        self._launch_server()
+
+    def _stop_server(self):
+        """
+        Stop the server process, leaving the test server able to launch it again.
+        """
+        self._server.exit = True
+        with timings.phase(self, 'kill'):
+            self._server.teardown()
+        self._server = None
 
 
     def check_server_up(self):
@@ -106,6 +211,16 @@ class TestServerV2(Workspace):
         """
         raise NotImplementedError("Concret class should implement this")
 
+    def readiness_probe(self):
+        """
+        Get a cheap `readiness.ReadinessProbe` that must fire before check_server_up is called.
+
+        Return None to rely on polling check_server_up alone.
+        """
+        if not self.hostname:
+            return None
+        return TCPProbe(self.hostname, self.port)
+
     @property
     def hostname(self):
         """
@@ -192,12 +307,22 @@ class TestServerV2(Workspace):
         """
         pass
 
-    def _wait_for_go(self, start_interval=0.1, retries_per_interval=3, retry_limit=28, base=2.0):
+    def reset(self):
+        """
+        Return a running server to a clean state, so it can be reused by another test.
+        """
+        raise NotImplementedError("Concrete class should implement this")
+
+    def _supports_reset(self):
+        return type(self).reset is not TestServerV2.reset
+
+    def _wait_for_go(self, start_interval=0.1, retries_per_interval=3, retry_limit=28, base=2.0, probe=None):
         """
         This is called to wait until the server has started running.
 
-        Uses a binary exponential backoff algorithm to set wait interval
-        between retries. This finds the happy medium between quick starting
+        Waits for the readiness probe to fire first, then uses a binary
+        exponential backoff algorithm to set wait interval between retries
+        of check_server_up. This finds the happy medium between quick starting
         servers (e.g. in-memory DBs) while remaining useful for the slower
         starting servers (e.g. web servers).
 
@@ -211,6 +336,8 @@ class TestServerV2(Workspace):
             total number of retries to attempt before giving up
         base: ``float``
             backoff multiplier
+        probe: `readiness.ReadinessProbe`
+            probe to wait on, defaults to self.readiness_probe()
 
         """
         if start_interval <= 0.0:
@@ -220,6 +347,10 @@ class TestServerV2(Workspace):
 
         retry_count = retry_limit
         start_time = datetime.now()
+        if probe is None:
+            probe = self.readiness_probe()
+        if probe is not None and not probe.wait(self.readiness_timeout):
+            log.debug('readiness probe %r did not fire, falling back to polling' % probe)
         while retry_count > 0:
             for _ in range(retries_per_interval):
                 log.debug('sleeping for %s before retrying (%d of %d)'
@@ -253,9 +384,11 @@ class TestServerV2(Workspace):
         Get a random or pseudo-random port based on config.
         """
         if self._server_class == 'thread':
-            return get_ephemeral_port(host=self._listen_hostname) \
-                    if self.random_port \
-                    else self._get_pseudo_random_port()
+            if not self.random_port:
+                return self._get_pseudo_random_port()
+            port = get_ephemeral_port(host=self._listen_hostname, lease=True)
+            self._leased_ports.append(port)
+            return port
 
         return default_port
 
@@ -0,0 +1,165 @@
+""" Start and stop several test servers concurrently.
+
+Starting servers one after the other costs the sum of their start times;
+a `ServerGroup` runs their setup, launch and wait phases on a thread pool so
+the group is ready in roughly the time taken by the slowest server.
+"""
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+from pytest_server_fixtures import CONFIG
+
+log = logging.getLogger(__name__)
+
+# Registry of session-scoped fixtures that can be started as a group,
+# fixture name -> (factory, required config variables)
+SESSION_SERVERS = {}
+
+# Servers started ahead of time by the session plugin, fixture name -> server
+_prestarted = {}
+
+
+class ServerGroup(object):
+    """
+    A group of TestServer or TestServerV2 instances started and torn down together.
+    If any server fails to start, every server in the group is torn down and the
+    first error is re-raised.
+
+    Parameters
+    ----------
+    servers: `list`
+        Servers to manage, more can be added with `add()`
+    max_workers: `int`
+        Maximum number of servers started at once, defaults to all of them
+    pack: `bool`
+        With the kubernetes server class, run the TestServerV2 servers as containers of a single pod.
+        Servers listening on the same port as another one get their own pod.
+    """
+
+    def __init__(self, servers=None, max_workers=None, pack=False):
+        self.servers = list(servers) if servers else []
+        self.max_workers = max_workers
+        self.pack = pack
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, errtype, value, traceback):  # @UnusedVariable
+        self.teardown()
+
+    def add(self, server):
+        self.servers.append(server)
+        return server
+
+    def _map(self, fn, workers=None):
+        """ Call fn on every server in parallel, returns a list of (server, exception) for failures
+        """
+        if not self.servers:
+            return []
+        workers = workers or self.max_workers or len(self.servers)
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            futures = [(server, pool.submit(fn, server)) for server in self.servers]
+        return [(server, future.exception()) for server, future in futures if future.exception()]
+
+    def start_all(self):
+        """ Start all servers in parallel and wait until they are all up.
+        """
+        log.debug("Starting %d servers in parallel" % len(self.servers))
+        pod = self._pack()
+        if pod is None:
+            errors = self._map(lambda server: server.start())
+        else:
+            def start(server):
+                try:
+                    server.start()
+                except Exception as e:
+                    if server.packed_pod is pod:
+                        # Don't leave the other servers waiting for this one to join
+                        pod.abort(e)
+                    raise
+            # Every packed server must be launching at once for the pod to be created
+            errors = self._map(start, workers=len(self.servers))
+        if errors:
+            for server, err in errors:
+                log.error("Failed to start %s: %s" % (server.__class__.__name__, err))
+            self.teardown()
+            raise errors[0][1]
+        return self
+
+    def _pack(self):
+        """ Assign the servers that can share a pod to a new `PackedPod`, returns it or None
+        """
+        if not (self.pack and CONFIG.server_class == 'kubernetes'):
+            return None
+        members = []
+        ports = set()
+        for server in self.servers:
+            if not hasattr(server, 'packed_pod') or server.port in ports:
+                continue
+            ports.add(server.port)
+            members.append(server)
+        if len(members) < 2:
+            return None
+        from .serverclass.kubernetes import PackedPod
+        pod = PackedPod(len(members))
+        for server in members:
+            server.packed_pod = pod
+        return pod
+
+    def teardown(self):
+        """ Tear down all servers in parallel.
+        """
+        for server, err in self._map(lambda server: server.teardown()):
+            log.warning("Error tearing down %s: %s" % (server.__class__.__name__, err))
+
+
+def start_all(*servers, **kwargs):
+    """ Start the given servers in parallel, returning the `ServerGroup` that owns them.
+    """
+    return ServerGroup(servers, max_workers=kwargs.get('max_workers')).start_all()
+
+
+def register_session_server(fixture_name, factory, required_config=()):
+    """ Register a session-scoped server fixture so the session plugin can start it
+        up-front alongside the other session servers.
+
+    Parameters
+    ----------
+    fixture_name: `str`
+        Name of the session-scoped fixture
+    factory: `callable`
+        Returns a new, unstarted server
+    required_config: `list`
+        CONFIG variables that must be set, the fixture is skipped otherwise
+    """
+    SESSION_SERVERS[fixture_name] = (factory, required_config)
+
+
+def prestart_session_servers(fixture_names, max_workers=None):
+    """ Start all registered session servers named in fixture_names in parallel.
+        Returns the `ServerGroup` owning them.
+    """
+    group = ServerGroup(max_workers=max_workers, pack=CONFIG.k8s_pack_pods)
+    for name in sorted(set(fixture_names)):
+        if name not in SESSION_SERVERS or name in _prestarted:
+            continue
+        factory, required_config = SESSION_SERVERS[name]
+        if not all(getattr(CONFIG, var) for var in required_config):
+            continue
+        _prestarted[name] = group.add(factory())
+    try:
+        group.start_all()
+    except Exception:
+        _prestarted.clear()
+        raise
+    return group
+
+
+def get_prestarted(fixture_name):
+    """ Returns the server started up-front for this fixture, or None
+    """
+    return _prestarted.get(fixture_name)
+
+
+def clear_prestarted():
+    _prestarted.clear()
@@ -0,0 +1,60 @@
+""" Pre-pulling of the images used by server fixtures.
+
+With the docker and kubernetes server classes, the first fixture to use an
+image pulls it, inside whichever test happens to need it first, and different
+images are pulled one after another. The session plugin can instead pull every
+image needed by the collected tests up-front, concurrently.
+"""
+import logging
+
+from pytest_server_fixtures import CONFIG
+from . import timings
+
+log = logging.getLogger(__name__)
+
+# Fixture name -> CONFIG variable holding the image it runs
+FIXTURE_IMAGES = {}
+
+
+class ImagePrePull(object):
+    """ Stands in for a server in the lifecycle timings
+    """
+    _fixture_scope = 'session'
+
+
+def register_fixture_image(fixture_name, config_var):
+    """ Declare that a fixture runs the image named by a CONFIG variable, eg. 'redis_image'
+    """
+    FIXTURE_IMAGES[fixture_name] = config_var
+
+
+def images_for(fixture_names):
+    """ Returns the images run by the given fixtures
+    """
+    return sorted(set(getattr(CONFIG, FIXTURE_IMAGES[name]) for name in fixture_names if name in FIXTURE_IMAGES))
+
+
+def prepull(fixture_names, max_workers=4):
+    """
+    Pull the images run by the given fixtures for the configured server class.
+
+    Returns
+    -------
+    The list of images pulled, empty if the server class does not run images
+    """
+    if CONFIG.server_class not in ('docker', 'kubernetes'):
+        return []
+    images = images_for(fixture_names)
+    if not images:
+        return []
+    with timings.phase(ImagePrePull(), 'prepull'):
+        if CONFIG.server_class == 'docker':
+            from .serverclass.docker import pull_images
+            pull_images(images, max_workers=max_workers)
+        elif timings.get_worker() in ('master', 'gw0'):
+            # The DaemonSet pulls onto every node of the cluster, once is enough for all xdist workers
+            from .serverclass.kubernetes import prepull_images
+            prepull_images(images)
+        else:
+            return []
+    return images
@@ -50,6 +50,7 @@ def jenkins_server_module():
 class JenkinsTestServer(HTTPTestServer):
     port_seed = 65533
     kill_retry_delay = 2
+    snapshot_dirs = ('.',)
 
     def __init__(self, **kwargs):
         global jenkins
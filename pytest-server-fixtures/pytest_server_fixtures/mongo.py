@@ -6,6 +6,9 @@ import time
 import errno
 import logging
 import getpass
+import re
+import threading
+import uuid
 
 import pytest
 
@@ -13,9 +16,46 @@ from pytest_server_fixtures import CONFIG
 from pytest_fixture_config import yield_requires_config
 
 from .base2 import TestServerV2
+from .group import get_prestarted, register_session_server
+from .images import register_fixture_image
+from .pool import lease_server
 
 log = logging.getLogger(__name__)
 
+SYSTEM_DATABASES = ('admin', 'config', 'local')
+
+STORAGE_MODES = ('disk', 'inMemory', 'ephemeralForTest', 'tmpfs', 'auto')
+TMPFS_DIR = '/dev/shm'
+
+_mongod_version_cache = {}
+
+
+def get_mongod_version(mongod):
+    """
+    Returns the version of a mongod executable as a (major, minor) tuple, or None if it
+    can't be told, and whether it is MongoDB Enterprise. Results are cached for the session.
+    """
+    if mongod not in _mongod_version_cache:
+        out = subprocess.check_output([mongod, '--version']).decode('utf-8')
+        match = re.search(r'db version v(\d+)\.(\d+)', out)
+        version = (int(match.group(1)), int(match.group(2))) if match else None
+        _mongod_version_cache[mongod] = (version, 'enterprise' in out)
+    return _mongod_version_cache[mongod]
+
+
+def choose_storage(version, enterprise, tmpfs_dir=TMPFS_DIR):
+    """
+    Picks the fastest storage mode available: the inMemory engine of MongoDB Enterprise,
+    the ephemeralForTest engine before MongoDB 7.0, then a dbpath on tmpfs.
+    """
+    if enterprise:
+        return 'inMemory'
+    if version and version < (7, 0):
+        return 'ephemeralForTest'
+    if os.path.isdir(tmpfs_dir) and os.access(tmpfs_dir, os.W_OK):
+        return 'tmpfs'
+    return 'disk'
+
 
 def _mongo_server():
     """ This does the actual work - there are several versions of this used
@@ -31,7 +71,7 @@ def _mongo_server():
 
 @pytest.yield_fixture(scope='function')
 @yield_requires_config(CONFIG, ['mongo_bin'])
-def mongo_server():
+def mongo_server(request):
     """ Function-scoped MongoDB server started in a local thread.
         This also provides a temp workspace.
         We tear down, and cleanup mongos at the end of the test.
@@ -43,7 +83,13 @@ def mongo_server():
         ----------
         api (`pymongo.MongoClient`)  : PyMongo Client API connected to this server
         .. also inherits all attributes from the `workspace` fixture
+
+        When SERVER_FIXTURES_POOL_SIZE is set, a warm server is leased from
+        a pool and its databases are dropped after the test instead.
     """
+    if CONFIG.pool_size:
+        yield lease_server(request, MongoTestServer)
+        return
     for server in _mongo_server():
         yield server
 
@@ -53,6 +99,10 @@ def mongo_server():
 def mongo_server_sess():
     """ Same as mongo_server fixture, scoped as session instead.
     """
+    server = get_prestarted('mongo_server_sess')
+    if server:
+        yield server
+        return
     for server in _mongo_server():
         yield server
 
@@ -76,12 +126,49 @@ def mongo_server_module():
         yield server
 
 
+@pytest.yield_fixture(scope='function')
+@yield_requires_config(CONFIG, ['mongo_bin'])
+def mongo_unique_db(mongo_server_sess):
+    """ Function-scoped `pymongo.database.Database` with a unique name on the session server.
+        The database is dropped in the background after the test.
+    """
+    name = 'test_%s' % uuid.uuid4().hex
+    yield mongo_server_sess.api[name]
+    mongo_server_sess.drop_database_later(name)
+
+
 class MongoTestServer(TestServerV2):
+    """
+    MongoDB server.
 
-    def __init__(self, delete=True, **kwargs):
+    Parameters
+    ----------
+    storage: `str`
+        Where data is kept, one of `STORAGE_MODES`: 'disk' in the workspace, the 'inMemory'
+        (MongoDB Enterprise only) or 'ephemeralForTest' (before MongoDB 7.0) storage engines,
+        'tmpfs' for a dbpath under /dev/shm, or 'auto' for the fastest of these that the
+        mongod supports. Defaults to SERVER_FIXTURES_MONGO_STORAGE.
+    cache_size_gb: `float`
+        Size of the WiredTiger cache, or of the whole dataset with the inMemory engine.
+        Defaults to SERVER_FIXTURES_MONGO_CACHE_SIZE_GB, or mongod's own default if 0.
+    """
+
+    def __init__(self, delete=True, storage=None, cache_size_gb=None, **kwargs):
+        # teardown() drains the drop queue, and runs from __del__ even if this raises
+        self._pending_drops = []
+        self._drops_cond = threading.Condition()
+        self._drops_thread = None
+        self._drops_stopping = False
+        # Checked before the workspace is created, so a bad setting doesn't leak one
+        self.storage = storage or CONFIG.mongo_storage
+        if self.storage not in STORAGE_MODES:
+            raise ValueError("Unknown Mongo storage mode %s, choose from %s" % (self.storage, ', '.join(STORAGE_MODES)))
+        self.cache_size_gb = CONFIG.mongo_cache_size_gb if cache_size_gb is None else cache_size_gb
+        self._storage_mode = None
+        self._dbpath = None
+        self.api = None
         super(MongoTestServer, self).__init__(delete=delete, **kwargs)
         self._port = self._get_port(27017)
-        self.api = None
 
     @property
     def cmd(self):
@@ -91,21 +178,70 @@ class MongoTestServer(TestServerV2):
     def cmd_local(self):
         return CONFIG.mongo_bin
 
+    @property
+    def storage_mode(self):
+        """ The storage mode in use, with 'auto' resolved
+        """
+        if self._storage_mode is None:
+            mode = self.storage
+            if mode == 'auto':
+                if self._server_class == 'thread':
+                    mode = choose_storage(*get_mongod_version(CONFIG.mongo_bin), tmpfs_dir=TMPFS_DIR)
+                else:
+                    # The version of the image isn't known until it runs
+                    mode = 'disk'
+            elif mode == 'tmpfs' and self._server_class != 'thread':
+                log.warning("Mongo tmpfs storage needs the thread server class, using disk")
+                mode = 'disk'
+            self._storage_mode = mode
+        return self._storage_mode
+
+    @property
+    def mongod_version(self):
+        """ (major, minor) version of the local mongod, or None if not known, eg. for containers
+        """
+        if self._server_class != 'thread':
+            return None
+        try:
+            return get_mongod_version(CONFIG.mongo_bin)[0]
+        except (OSError, subprocess.CalledProcessError) as e:
+            log.debug("Failed to get the version of %s: %s" % (CONFIG.mongo_bin, e))
+            return None
+
     def get_args(self, **kwargs):
+        mode = self.storage_mode
+        version = self.mongod_version
         cmd = [
             '--bind_ip=%s' % self._listen_hostname,
             '--port=%s' % self.port,
             '--nounixsocket',
             '--syncdelay=0',
-            '--nojournal',
             '--quiet',
         ]
+        if mode == 'inMemory':
+            cmd.append('--storageEngine=inMemory')
+            if self.cache_size_gb:
+                cmd.append('--inMemorySizeGB=%s' % self.cache_size_gb)
+        else:
+            if version is None or version < (6, 1):
+                # Removed in MongoDB 6.1
+                cmd.append('--nojournal')
+            if mode == 'ephemeralForTest':
+                cmd.append('--storageEngine=ephemeralForTest')
+            elif self.cache_size_gb:
+                cmd.append('--wiredTigerCacheSizeGB=%s' % self.cache_size_gb)
 
         if 'workspace' in kwargs:
-            cmd.append('--dbpath=%s' % str(kwargs['workspace']))
+            cmd.append('--dbpath=%s' % (self._dbpath or str(kwargs['workspace'])))
 
         return cmd
 
+    def pre_setup(self):
+        """ Create the dbpath on tmpfs
+        """
+        if self.storage_mode == 'tmpfs' and self._dbpath is None:
+            self._dbpath = tempfile.mkdtemp(prefix='mongo.', dir=TMPFS_DIR)
+
     @property
     def image(self):
         return CONFIG.mongo_image
@@ -137,8 +273,78 @@ class MongoTestServer(TestServerV2):
             pass
         return False
 
+    def reset(self):
+        """Drop all non-system databases."""
+        for name in self.api.list_database_names():
+            if name not in SYSTEM_DATABASES:
+                self.api.drop_database(name)
+
+    def drop_database_later(self, name):
+        """ Drop a database on a background thread. Databases queued while a drop
+            is running are dropped together in the next batch. Once `drain_drops()`
+            has been called, databases are dropped straight away instead.
+        """
+        with self._drops_cond:
+            draining = self._drops_stopping
+            if not draining:
+                self._pending_drops.append(name)
+                if self._drops_thread is None:
+                    self._drops_thread = threading.Thread(target=self._drop_databases, name='mongo-drops')
+                    self._drops_thread.daemon = True
+                    self._drops_thread.start()
+                self._drops_cond.notify()
+        if draining:
+            self._drop_database(name)
+
+    def _drop_database(self, name):
+        if self.api is None:
+            log.debug("Not dropping Mongo database %s, the server is gone" % name)
+            return
+        try:
+            self.api.drop_database(name)
+        except Exception as e:
+            log.warning("Failed to drop Mongo database %s: %s" % (name, e))
+
+    def _drop_databases(self):
+        while True:
+            with self._drops_cond:
+                while not self._pending_drops and not self._drops_stopping:
+                    self._drops_cond.wait()
+                if not self._pending_drops:
+                    return
+                batch, self._pending_drops = self._pending_drops, []
+            log.debug("Dropping %d Mongo databases" % len(batch))
+            for name in batch:
+                self._drop_database(name)
+
+    def drain_drops(self):
+        """ Wait for the databases queued by `drop_database_later()` to be dropped.
+            The background thread is stopped for good, later drops run inline.
+        """
+        with self._drops_cond:
+            thread, self._drops_thread = self._drops_thread, None
+            self._drops_stopping = True
+            self._drops_cond.notify()
+        if thread is not None:
+            thread.join()
+
     def teardown(self):
+        self.drain_drops()
+        if not hasattr(self, 'workspace'):
+            # __init__ raised before the workspace was created
+            return
         if self.api:
             self.api.close()
             self.api = None
         super(MongoTestServer, self).teardown()
+
+    def _teardown(self):
+        super(MongoTestServer, self)._teardown()
+        if self._dbpath is not None:
+            shutil.rmtree(self._dbpath, ignore_errors=True)
+            self._dbpath = None
+
+
+register_session_server('mongo_server_sess', MongoTestServer, ['mongo_bin'])
+for _name in ('mongo_server', 'mongo_server_sess', 'mongo_server_cls', 'mongo_server_module', 'mongo_unique_db'):
+    register_fixture_image(_name, 'mongo_image')
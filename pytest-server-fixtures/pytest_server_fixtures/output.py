@@ -0,0 +1,199 @@
+""" Process-wide reader for the output of server processes.
+
+Rather than two blocking reader threads per server, all server stdout/stderr
+pipes are made non-blocking and registered with a single selector, served by
+one daemon thread. Data is split into lines incrementally and each complete
+line is handed to the sink registered with its pipe. A pipe is unregistered
+and closed at EOF, after flushing any unterminated last line.
+
+Servers also keep their most recent output in a fixed-size `RingBuffer`, which
+the session plugin uses to attach the output produced during a failing test
+to its report.
+"""
+import fcntl
+import logging
+import os
+import selectors
+import threading
+import weakref
+
+log = logging.getLogger(__name__)
+
+READ_SIZE = 65536
+
+
+class RingBuffer(object):
+    """
+    Fixed-size buffer holding the most recent bytes written to it.
+
+    Attributes
+    ----------
+    size: `int`
+        Capacity in bytes, allocated up-front
+    position: `int`
+        Total number of bytes ever written, used as an offset for `since()`
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.position = 0
+        self._data = bytearray(size)
+        self._lock = threading.Lock()
+
+    def write(self, data):
+        with self._lock:
+            n = len(data)
+            if n > self.size:
+                data = data[n - self.size:]
+            start = (self.position + n - len(data)) % self.size
+            first = min(len(data), self.size - start)
+            self._data[start:start + first] = data[:first]
+            self._data[:len(data) - first] = data[first:]
+            self.position += n
+
+    def since(self, offset=0):
+        """ Returns the bytes written after offset that are still held
+        """
+        with self._lock:
+            offset = max(offset, self.position - self.size)
+            n = self.position - offset
+            start = offset % self.size
+            first = min(n, self.size - start)
+            return bytes(self._data[start:start + first] + self._data[:n - first])
+
+    def getvalue(self):
+        return self.since(0)
+
+
+# Servers with an output buffer, for the session plugin
+_tracked = weakref.WeakSet()
+
+
+def track(server):
+    """ Makes server.output_buffer available to the failing test reports
+    """
+    _tracked.add(server)
+
+
+def tracked_servers():
+    return list(_tracked)
+
+
+class _Stream(object):
+    __slots__ = ('stream', 'sink', 'buffer')
+
+    def __init__(self, stream, sink):
+        self.stream = stream
+        self.sink = sink
+        self.buffer = b''
+
+
+class OutputMultiplexer(object):
+    """ Reads lines from any number of pipes on a single thread.
+    """
+
+    def __init__(self):
+        self._selector = selectors.DefaultSelector()
+        self._lock = threading.Lock()
+        self._pending = []
+        self._thread = None
+        self._wakeup_r, self._wakeup_w = os.pipe()
+        _set_nonblocking(self._wakeup_r)
+        _set_nonblocking(self._wakeup_w)
+        self._selector.register(self._wakeup_r, selectors.EVENT_READ)
+
+    def add(self, stream, sink):
+        """
+        Start reading a pipe.
+
+        Parameters
+        ----------
+        stream: file object
+            Readable end of a pipe, eg. `subprocess.Popen.stdout`. It is closed at EOF.
+        sink: `callable`
+            Called with each line read from the stream, as bytes including the trailing newline
+        """
+        _set_nonblocking(stream.fileno())
+        with self._lock:
+            self._pending.append(_Stream(stream, sink))
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='server-fixtures-output')
+                self._thread.daemon = True
+                self._thread.start()
+        self._wakeup()
+
+    def _wakeup(self):
+        try:
+            os.write(self._wakeup_w, b'x')
+        except OSError:
+            # Pipe full, the thread has been woken up already
+            pass
+
+    def _register_pending(self):
+        with self._lock:
+            pending, self._pending = self._pending, []
+        for s in pending:
+            self._selector.register(s.stream.fileno(), selectors.EVENT_READ, s)
+
+    def _run(self):
+        while True:
+            self._register_pending()
+            for key, _ in self._selector.select():
+                if key.data is None:
+                    try:
+                        os.read(self._wakeup_r, READ_SIZE)
+                    except OSError:
+                        pass
+                    continue
+                self._read(key.fd, key.data)
+
+    def _read(self, fd, s):
+        try:
+            data = os.read(fd, READ_SIZE)
+        except OSError as e:
+            log.debug("Error reading server output: %s" % e)
+            data = b''
+        if not data:
+            self._selector.unregister(fd)
+            if s.buffer:
+                self._emit(s, s.buffer)
+            s.stream.close()
+            return
+        lines = (s.buffer + data).split(b'\n')
+        s.buffer = lines.pop()
+        for line in lines:
+            self._emit(s, line + b'\n')
+
+    def _emit(self, s, line):
+        try:
+            s.sink(line)
+        except Exception:
+            log.exception("Error handling server output")
+
+
+def _set_nonblocking(fd):
+    flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+    fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+
+
+_multiplexer = None
+_multiplexer_pid = None
+_multiplexer_lock = threading.Lock()
+
+
+def get_multiplexer():
+    """ Returns the process-wide `OutputMultiplexer`
+    """
+    global _multiplexer, _multiplexer_pid
+    with _multiplexer_lock:
+        # The reader thread does not survive a fork
+        if _multiplexer is None or _multiplexer_pid != os.getpid():
+            _multiplexer = OutputMultiplexer()
+            _multiplexer_pid = os.getpid()
+        return _multiplexer
+
+
+def read_lines(stream, sink):
+    """ Hand each line of a pipe to sink, on the process-wide output thread
+    """
+    get_multiplexer().add(stream, sink)
@@ -0,0 +1,209 @@
+""" Session-level plugin for the server fixtures.
+"""
+import json
+import logging
+import time
+import weakref
+
+import pytest
+
+from . import group, images, output, pool, reaper, redis, timings
+
+log = logging.getLogger(__name__)
+
+# Number of tests listed in the Redis command stats summary
+REDIS_SUMMARY_TESTS = 20
+
+_redis_stats = []
+
+
+def pytest_addoption(parser):
+    grp = parser.getgroup('server-fixtures')
+    grp.addoption('--server-fixtures-parallel-start', action='store_true', default=False,
+                  help="Start all session-scoped server fixtures used by the collected tests "
+                       "in parallel at the start of the session")
+    grp.addoption('--server-fixtures-prepull', action='store_true', default=False,
+                  help="With the docker and kubernetes server classes, pull the images used by the "
+                       "collected tests concurrently at the start of the session")
+    grp.addoption('--server-fixtures-timings', action='store_true', default=False,
+                  help="Show how long each server fixture lifecycle phase took at the end of the session")
+    grp.addoption('--server-fixtures-trace', metavar='PATH', default=None,
+                  help="Write server fixture lifecycle phase timings to PATH as a Chrome trace-event file")
+    grp.addoption('--server-fixtures-redis-stats', action='store_true', default=False,
+                  help="Record the commands each test sends to Redis servers, their server-side time "
+                       "and the slowest of them, and summarize them at the end of the session")
+    grp.addoption('--server-fixtures-redis-stats-json', metavar='PATH', default=None,
+                  help="Write the per-test Redis command statistics to PATH as JSON")
+
+
+def pytest_configure(config):
+    if config.getoption('server_fixtures_redis_stats') or config.getoption('server_fixtures_redis_stats_json'):
+        redis.enable_stats()
+
+
+def pytest_collection_finish(session):
+    if not session.config.getoption('server_fixtures_prepull'):
+        return
+    fixture_names = set()
+    for item in session.items:
+        fixture_names.update(getattr(item, 'fixturenames', ()))
+    start = time.time()
+    pulled = images.prepull(fixture_names)
+    if pulled:
+        reporter = session.config.pluginmanager.get_plugin('terminalreporter')
+        if reporter is not None:
+            reporter.write_line('server-fixtures: pre-pulled %s in %.1fs' % (', '.join(pulled), time.time() - start))
+
+
+@pytest.hookimpl(hookwrapper=True)
+def pytest_fixture_setup(fixturedef, request):
+    # Servers remember the scope of the fixture that created them, for the timings
+    with timings.fixture_scope(fixturedef.scope):
+        yield
+
+
+def pytest_sessionfinish(session):
+    pool.close_all()
+    config = session.config
+    failures = reaper.drain()
+    if failures:
+        reporter = config.pluginmanager.get_plugin('terminalreporter')
+        if reporter is not None:
+            reporter.write_sep('=', 'server fixture teardown errors', red=True)
+            for description, err in failures:
+                reporter.write_line('%s: %s: %s' % (description, err.__class__.__name__, err))
+    if hasattr(config, 'workeroutput'):
+        # xdist worker, send the timings and stats to the master
+        config.workeroutput['server_fixtures_timings'] = [rec._asdict() for rec in timings.get_records()]
+        config.workeroutput['server_fixtures_redis_stats'] = list(_redis_stats)
+        return
+    if config.getoption('server_fixtures_trace'):
+        timings.write_chrome_trace(config.getoption('server_fixtures_trace'))
+    if config.getoption('server_fixtures_redis_stats_json'):
+        with open(config.getoption('server_fixtures_redis_stats_json'), 'w') as f:
+            json.dump(_redis_stats, f, indent=2)
+
+
+@pytest.hookimpl(tryfirst=True)
+def pytest_runtest_setup(item):
+    # Remember how much output each server had produced before the test started
+    item._server_output_marks = weakref.WeakKeyDictionary(
+        (server, server.output_buffer.position) for server in output.tracked_servers())
+
+
+@pytest.hookimpl(hookwrapper=True)
+def pytest_runtest_makereport(item, call):
+    outcome = yield
+    report = outcome.get_result()
+    marks = getattr(item, '_server_output_marks', None)
+    if call.when == 'teardown':
+        item._server_output_marks = None
+    if not report.failed or marks is None:
+        return
+    for server in output.tracked_servers():
+        buf = server.output_buffer
+        # Servers started by the test's own fixtures have no mark
+        mark = marks.get(server, 0)
+        data = buf.since(mark)
+        if not data:
+            continue
+        dropped = buf.position - mark - len(data)
+        if dropped > 0:
+            data = b'[%d earlier bytes dropped]\n' % dropped + data
+        report.sections.append(('Captured server output: %s %s' % (server.__class__.__name__, server.workspace),
+                                data.decode('utf-8', 'replace')))
+
+
+@pytest.hookimpl(hookwrapper=True)
+def pytest_runtest_call(item):
+    if not redis.stats_enabled():
+        yield
+        return
+    # Snapshot after fixture setup, so that only what the test itself does is counted
+    marks = weakref.WeakKeyDictionary()
+    for server in redis.instrumented_servers():
+        try:
+            marks[server] = redis.stats_snapshot(server)
+        except Exception as e:
+            log.debug("Failed to snapshot Redis stats of %s: %s" % (server.port, e))
+    yield
+    servers = []
+    for server in redis.instrumented_servers():
+        if server.hostname is None:
+            continue
+        try:
+            # Servers started by the test itself have no mark
+            stats = redis.stats_since(server, marks.get(server))
+        except Exception as e:
+            log.debug("Failed to collect Redis stats of %s: %s" % (server.port, e))
+            continue
+        if stats['calls']:
+            servers.append(stats)
+    if servers:
+        slowest = sorted((entry for stats in servers for entry in stats['slowest']),
+                         key=lambda entry: entry['usec'], reverse=True)
+        _redis_stats.append({
+            'nodeid': item.nodeid,
+            'calls': sum(stats['calls'] for stats in servers),
+            'usec': sum(stats['usec'] for stats in servers),
+            'slowest': slowest[:redis.SLOWEST_COMMANDS],
+            'servers': servers,
+        })
+
+
+@pytest.hookimpl(optionalhook=True)
+def pytest_testnodedown(node, error):
+    workeroutput = getattr(node, 'workeroutput', {})
+    timings.add_records(workeroutput.get('server_fixtures_timings', []))
+    _redis_stats.extend(workeroutput.get('server_fixtures_redis_stats', []))
+
+
+def pytest_terminal_summary(terminalreporter):
+    if terminalreporter.config.getoption('server_fixtures_timings'):
+        _write_timings(terminalreporter)
+    if terminalreporter.config.getoption('server_fixtures_redis_stats'):
+        _write_redis_stats(terminalreporter)
+
+
+def _write_timings(terminalreporter):
+    rows = timings.summarize()
+    terminalreporter.write_sep('=', 'server fixture timings')
+    if not rows:
+        terminalreporter.write_line('no servers were started')
+        return
+    fmt = '%-30s %-10s %-12s %6s %10s %10s'
+    terminalreporter.write_line(fmt % ('server', 'scope', 'phase', 'count', 'total (s)', 'max (s)'))
+    for server, scope, phase, count, total, longest in rows:
+        terminalreporter.write_line(fmt % (server, scope, phase, count, '%.3f' % total, '%.3f' % longest))
+
+
+def _write_redis_stats(terminalreporter):
+    terminalreporter.write_sep('=', 'redis command stats')
+    if not _redis_stats:
+        terminalreporter.write_line('no tests sent commands to instrumented Redis servers')
+        return
+    fmt = '%8s %12s  %-30s %s'
+    terminalreporter.write_line(fmt % ('calls', 'usec', 'slowest command', 'test'))
+    for stats in sorted(_redis_stats, key=lambda stats: stats['usec'], reverse=True)[:REDIS_SUMMARY_TESTS]:
+        slowest = stats['slowest'][0] if stats['slowest'] else None
+        slowest = '%s (%dus)' % (slowest['command'][:22], slowest['usec']) if slowest else '-'
+        terminalreporter.write_line(fmt % (stats['calls'], stats['usec'], slowest, stats['nodeid']))
+
+
+@pytest.fixture(scope='session', autouse=True)
+def _server_fixtures_parallel_start(request):
+    """ Starts all session-scoped server fixtures needed by the collected tests up-front
+        as a `group.ServerGroup`, when --server-fixtures-parallel-start is given.
+    """
+    if not request.config.getoption('server_fixtures_parallel_start'):
+        yield
+        return
+    fixture_names = set()
+    for item in request.session.items:
+        fixture_names.update(getattr(item, 'fixturenames', ()))
+    server_group = group.prestart_session_servers(fixture_names)
+    try:
+        yield server_group
+    finally:
+        group.clear_prestarted()
+        server_group.teardown()
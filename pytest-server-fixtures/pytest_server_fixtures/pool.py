@@ -0,0 +1,129 @@
+""" Pools of warm servers for function-scoped fixtures.
+
+Starting a server for every test is slow. A pool keeps already running servers
+per process (and so per pytest-xdist worker), leases one to each test and calls
+the server's `reset()` hook when the test hands it back.
+Pooling is enabled by setting SERVER_FIXTURES_POOL_SIZE.
+"""
+import logging
+import threading
+
+from pytest_server_fixtures import CONFIG
+from .group import ServerGroup
+from . import timings
+
+log = logging.getLogger(__name__)
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+class ServerPool(object):
+    """
+    Pool of started servers created by `factory`.
+
+    Parameters
+    ----------
+    factory: `callable`
+        Returns a new, unstarted server that implements `reset()`
+    size: `int`
+        Number of idle servers to keep warm
+    max_reuse: `int`
+        Number of times a server is leased before it is replaced with a fresh one
+    """
+
+    def __init__(self, factory, size=1, max_reuse=100):
+        self.factory = factory
+        self.size = size
+        self.max_reuse = max_reuse
+        self._idle = []
+        self._uses = {}
+        self._lock = threading.Lock()
+
+    def fill(self):
+        """ Start servers in parallel until there are `size` idle ones.
+        """
+        with self._lock:
+            missing = self.size - len(self._idle)
+        if missing <= 0:
+            return
+        group = ServerGroup([self.factory() for _ in range(missing)]).start_all()
+        with self._lock:
+            for server in group.servers:
+                self._uses[id(server)] = 0
+                self._idle.append(server)
+
+    def acquire(self):
+        """ Lease a clean, running server from the pool.
+        """
+        with self._lock:
+            if self._idle:
+                return self._idle.pop()
+        server = self.factory()
+        server.start()
+        with self._lock:
+            self._uses[id(server)] = 0
+        return server
+
+    def release(self, server):
+        """ Hand a leased server back. It is reset and kept for reuse, or torn down if the pool
+            is full, it has been reused `max_reuse` times or the reset fails.
+        """
+        with self._lock:
+            uses = self._uses[id(server)] = self._uses.get(id(server), 0) + 1
+            keep = uses < self.max_reuse and len(self._idle) < self.size
+        if keep:
+            try:
+                with timings.phase(server, 'reset'):
+                    server.reset()
+            except Exception as e:
+                log.warning("Failed to reset %s, discarding it: %s" % (server.__class__.__name__, e))
+                keep = False
+        if keep:
+            with self._lock:
+                self._idle.append(server)
+            return
+        self._discard(server)
+
+    def _discard(self, server):
+        with self._lock:
+            self._uses.pop(id(server), None)
+        server.teardown()
+
+    def close(self):
+        """ Tear down all idle servers.
+        """
+        with self._lock:
+            idle, self._idle = self._idle, []
+            self._uses.clear()
+        ServerGroup(idle).teardown()
+
+
+def get_pool(factory):
+    """ Returns the pool for this server factory, creating and filling it on first use.
+    """
+    with _pools_lock:
+        pool = _pools.get(factory)
+        if pool is None:
+            pool = _pools[factory] = ServerPool(factory, size=CONFIG.pool_size, max_reuse=CONFIG.pool_max_reuse)
+            pool.fill()
+    return pool
+
+
+def lease_server(request, factory):
+    """ Lease a server from the pool for the duration of a fixture.
+    """
+    pool = get_pool(factory)
+    server = pool.acquire()
+    request.addfinalizer(lambda: pool.release(server))
+    return server
+
+
+def close_all():
+    """ Tear down the servers in all pools.
+    """
+    with _pools_lock:
+        pools = list(_pools.values())
+        _pools.clear()
+    for pool in pools:
+        pool.close()
@@ -0,0 +1,277 @@
+""" Cross-process port leases, and lookup of the processes listening on a port.
+
+Binding a socket, closing it and handing the port number to a server leaves a
+window where another process (eg. a different pytest-xdist worker) can pick the
+same port. Ports handed out here are also leased in a shared lock file using a
+one-byte POSIX record lock at offset <port>, so every process run by the same
+user on this machine skips ports that are leased by someone else. Leases are
+dropped by the kernel when the owning process exits. If the lock file can't be
+used, ports are handed out without leases, as before.
+"""
+import binascii
+import errno
+import fcntl
+import getpass
+import logging
+import os
+import random
+import socket
+import struct
+import tempfile
+import threading
+
+log = logging.getLogger(__name__)
+
+LEASE_FILE = os.path.join(tempfile.gettempdir(), 'pytest-server-fixtures-ports-%s.lock' % getpass.getuser())
+
+# Port range to pick random ports from, below the kernel's dynamic port range:
+# * cat /proc/sys/net/ipv4/ip_local_port_range
+# 32768   61000
+PORT_RANGE = (1024, 32768)
+
+_lock = threading.Lock()
+# None until the lease file is opened, -1 if it can't be
+_lease_fd = None
+_leases = {}
+
+
+class PortLease(object):
+    """ A port reserved for this process until `release()` is called.
+
+    Attributes
+    ----------
+    port: `int`
+        The leased port number
+    socket: `socket.socket`
+        The bound listening socket, if the lease was taken with keep_socket=True.
+        It can be passed to a server process able to inherit it.
+    """
+
+    def __init__(self, port, sock=None):
+        self.port = port
+        self.socket = sock
+
+    def release(self):
+        release_port(self.port)
+
+    def __repr__(self):
+        return '<PortLease %d>' % self.port
+
+
+def _get_lease_fd():
+    """ The lease file descriptor, or None if the lease file is unavailable
+    """
+    global _lease_fd
+    if _lease_fd is None:
+        try:
+            _lease_fd = os.open(LEASE_FILE, os.O_RDWR | os.O_CREAT, 0o600)
+        except (IOError, OSError) as e:
+            log.warning("Can't open port lease file %s, ports will not be leased: %s", LEASE_FILE, e)
+            _lease_fd = -1
+    return _lease_fd if _lease_fd >= 0 else None
+
+
+def _try_lock(port):
+    fd = _get_lease_fd()
+    if fd is None:
+        return True
+    try:
+        fcntl.lockf(fd, fcntl.LOCK_EX | fcntl.LOCK_NB, 1, port, os.SEEK_SET)
+        return True
+    except (IOError, OSError) as e:
+        if e.errno in (errno.EACCES, errno.EAGAIN):
+            # Leased by another process
+            return False
+        log.warning("Can't lock port %d in %s, leaving it unleased: %s", port, LEASE_FILE, e)
+        return True
+
+
+def _unlock(port):
+    fd = _get_lease_fd()
+    if fd is not None:
+        try:
+            fcntl.lockf(fd, fcntl.LOCK_UN, 1, port, os.SEEK_SET)
+        except (IOError, OSError):
+            pass
+
+
+def _bind(host, port, keep_socket):
+    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    try:
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        s.bind((host, port))
+        port = s.getsockname()[1]
+        if keep_socket:
+            s.listen(socket.SOMAXCONN)
+            return port, s
+    except socket.error:
+        s.close()
+        return None, None
+    s.close()
+    return port, None
+
+
+def lease_port(host, port=0, keep_socket=False):
+    """
+    Lease a free port, atomically across all processes on this machine.
+
+    Parameters
+    ----------
+    host: `str`
+        Host address the port must be free on
+    port: `int`
+        Port to try first, a random port is picked if this is 0 or is not free.
+        If this process already leases it, the existing lease is returned.
+    keep_socket: `bool`
+        Keep the socket bound and listening, as `PortLease.socket`
+
+    Returns
+    -------
+    `PortLease`
+    """
+    if port == 0:
+        port = random.randrange(*PORT_RANGE)
+    else:
+        with _lock:
+            if port in _leases:
+                return _leases[port]
+
+    while True:
+        with _lock:
+            if port not in _leases and _try_lock(port):
+                bound, sock = _bind(host, port, keep_socket)
+                if bound is not None:
+                    lease = _leases[port] = PortLease(port, sock)
+                    return lease
+                _unlock(port)
+        port = random.randrange(*PORT_RANGE)
+
+
+def release_port(port):
+    """ Release a port leased with `lease_port`. Does nothing if the port is not leased.
+    """
+    with _lock:
+        lease = _leases.pop(port, None)
+        if lease is None:
+            return
+        if lease.socket is not None:
+            lease.socket.close()
+            lease.socket = None
+        _unlock(port)
+
+
+def _is_leased(port):
+    with _lock:
+        if port in _leases:
+            return True
+        if not _try_lock(port):
+            return True
+        _unlock(port)
+        return False
+
+
+def find_free_port(host, port=0):
+    """
+    Find a free port without leasing it, for callers that bind it themselves straight away.
+    Random ports leased by any process are skipped.
+
+    Parameters
+    ----------
+    host: `str`
+        Host address the port must be free on
+    port: `int`
+        Port to try first, returned as long as it can be bound. A random port is
+        picked if this is 0 or is not free.
+
+    Returns
+    -------
+    Available port number
+    """
+    if port != 0:
+        bound, _ = _bind(host, port, False)
+        if bound is not None:
+            return bound
+
+    while True:
+        port = random.randrange(*PORT_RANGE)
+        if not _is_leased(port):
+            bound, _ = _bind(host, port, False)
+            if bound is not None:
+                return bound
+
+
+_PROC_NET = ('/proc/net/tcp', '/proc/net/tcp6')
+_TCP_LISTEN = '0A'
+
+
+def _decode_address(address):
+    """ Decode an address from /proc/net/tcp{,6}, eg. '0100007F:1F90' -> ('127.0.0.1', 8080)
+    """
+    ip, port = address.split(':')
+    raw = binascii.unhexlify(ip)
+    # Addresses are written as native-endian 32-bit words
+    raw = b''.join(struct.pack('=I', *struct.unpack('>I', raw[i:i + 4])) for i in range(0, len(raw), 4))
+    if len(raw) == 4:
+        ip = socket.inet_ntop(socket.AF_INET, raw)
+    elif raw[:12] == b'\0' * 10 + b'\xff' * 2:
+        # IPv4-mapped IPv6 address
+        ip = socket.inet_ntop(socket.AF_INET, raw[12:])
+    else:
+        ip = socket.inet_ntop(socket.AF_INET6, raw)
+    return ip, int(port, 16)
+
+
+def _listening_inodes(ip, port):
+    inodes = set()
+    for path in _PROC_NET:
+        try:
+            with open(path) as f:
+                lines = f.readlines()[1:]
+        except IOError:
+            continue
+        for line in lines:
+            fields = line.split()
+            if fields[3] != _TCP_LISTEN:
+                continue
+            if _decode_address(fields[1]) == (ip, port):
+                inodes.add(fields[9])
+    return inodes
+
+
+def find_listening_pids(ip, port):
+    """
+    Find the processes with a socket listening on ip:port, by reading /proc/net/tcp{,6}
+    and mapping the socket inodes to their owners with a single pass over /proc/*/fd.
+
+    Returns
+    -------
+    set of pids, or None if /proc is not available on this platform or the owners of a
+    listening socket can't be read, eg. because they belong to another user.
+    """
+    if not os.path.exists(_PROC_NET[0]):
+        return None
+    inodes = _listening_inodes(ip, port)
+    if not inodes:
+        return set()
+    targets = set('socket:[%s]' % inode for inode in inodes)
+    pids = set()
+    for pid in os.listdir('/proc'):
+        if not pid.isdigit():
+            continue
+        fd_dir = os.path.join('/proc', pid, 'fd')
+        try:
+            fds = os.listdir(fd_dir)
+        except OSError:
+            # Process went away, or belongs to someone else
+            continue
+        for fd in fds:
+            try:
+                if os.readlink(os.path.join(fd_dir, fd)) in targets:
+                    pids.add(int(pid))
+                    break
+            except OSError:
+                continue
+    if not pids:
+        # Someone is listening, but we can't tell who
+        return None
+    return pids
@@ -2,11 +2,19 @@
 
 from __future__ import absolute_import, division, print_function, unicode_literals
 
+import getpass
+import hashlib
 import os
 import logging
+import shutil
+import signal
 import subprocess
+import tempfile
+import uuid
+from concurrent.futures import ThreadPoolExecutor
 
 import errno
+import psutil
 import pytest
 from six import text_type
 
@@ -14,15 +22,80 @@ from pytest_server_fixtures import CONFIG
 from pytest_fixture_config import requires_config
 
 from .base import TestServer
+from .group import get_prestarted, register_session_server
+from .readiness import FileProbe
+from .snapshot import copy_tree
 
 log = logging.getLogger(__name__)
 
+# Locale settings that initdb bakes into a new cluster
+LOCALE_VARS = ('LC_ALL', 'LC_COLLATE', 'LC_CTYPE', 'LC_MESSAGES', 'LC_MONETARY', 'LC_NUMERIC', 'LC_TIME', 'LANG')
+
+# pg_config executable -> (bindir, postgres version), looked up once per session
+_pg_install_cache = {}
+
+
+def get_pg_install(pg_config):
+    """
+    Returns the binary directory and version string of the Postgres installation
+    described by a pg_config executable. Results are cached for the session.
+    """
+    if pg_config not in _pg_install_cache:
+        bindir = subprocess.check_output([pg_config, "--bindir"]).decode('utf-8').rstrip()
+        version = subprocess.check_output([pg_config, "--version"]).decode('utf-8').rstrip()
+        _pg_install_cache[pg_config] = (bindir, version)
+    return _pg_install_cache[pg_config]
+
+
+def cluster_cache_key(version, initdb_args=()):
+    """
+    Key for a cached cluster: a hash of the Postgres version, the OS user, who becomes the
+    bootstrap superuser and owner of the cluster, the locale and the initdb options.
+    """
+    h = hashlib.sha1()
+    h.update(version.encode('utf-8'))
+    h.update(('\0user=%s' % getpass.getuser()).encode('utf-8'))
+    for var in LOCALE_VARS:
+        h.update(('\0%s=%s' % (var, os.environ.get(var, ''))).encode('utf-8'))
+    for arg in initdb_args:
+        h.update(('\0' + arg).encode('utf-8'))
+    return h.hexdigest()
+
+
+def get_cached_cluster(cache_dir, key, initdb):
+    """
+    Returns the path of the cached cluster for key, calling initdb(path) to create it if needed.
+    Clusters are created in a temporary directory and renamed into place, so concurrent
+    processes never see a partial cluster; if two race, the loser's copy is thrown away.
+    """
+    cluster = os.path.join(cache_dir, key)
+    if os.path.isdir(cluster):
+        return cluster
+    try:
+        os.makedirs(cache_dir)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+    tmp = tempfile.mkdtemp(prefix=key + '.', dir=cache_dir)
+    try:
+        initdb(tmp)
+        try:
+            os.rename(tmp, cluster)
+            log.debug("Cached initdb cluster in %s" % cluster)
+        except OSError as e:
+            if e.errno not in (errno.EEXIST, errno.ENOTEMPTY):
+                raise
+    finally:
+        if os.path.isdir(tmp):
+            shutil.rmtree(tmp, ignore_errors=True)
+    return cluster
+
 
 @pytest.fixture(scope='session')
 @requires_config(CONFIG, ['pg_config_executable'])
 def postgres_server_sess(request):
     """A session-scoped Postgres Database fixture"""
-    return _postgres_server(request)
+    return get_prestarted('postgres_server_sess') or _postgres_server(request)
 
 
 def _postgres_server(request):
@@ -32,17 +105,53 @@ def _postgres_server(request):
     return server
 
 
+@pytest.fixture(scope='session')
+def postgres_template_seed():
+    """Seed for the template database cloned by `postgres_db`.
+    Override this fixture to return a callable taking a psycopg2 connection, or a string of SQL.
+    """
+    return None
+
+
+@pytest.fixture(scope='session')
+def postgres_template_sess(postgres_server_sess, postgres_template_seed):
+    """Name of a template database on the session server, built once from `postgres_template_seed`"""
+    name = 'template_' + uuid.uuid4().hex[:12]
+    postgres_server_sess.create_template(name, postgres_template_seed)
+    return name
+
+
+@pytest.yield_fixture(scope='function')
+def postgres_db(postgres_server_sess, postgres_template_sess):
+    """Function-scoped psycopg2 connection to a fresh database cloned from `postgres_template_sess`.
+    The database is dropped in the background after the test.
+    """
+    name = postgres_server_sess.clone_database(postgres_template_sess)
+    conn = postgres_server_sess.connect(name)
+    try:
+        yield conn
+    finally:
+        conn.close()
+        postgres_server_sess.drop_database(name)
+
+
 class PostgresServer(TestServer):
     """
     Exposes a server.connect() method returning a raw psycopg2 connection.
     Also exposes a server.connection_config property returning a dict with connection parameters
     """
     random_port = True
+    # Fast shutdown: SIGTERM waits for all clients to disconnect
+    kill_signal = signal.SIGINT
+    snapshot_dirs = ('db',)
+    # Extra options for initdb, part of the cluster cache key
+    initdb_args = ()
 
     def __init__(self, database_name="integration", skip_on_missing_postgres=False, **kwargs):
         self.database_name = database_name
         # TODO make skip configurable with a pytest flag
         self._fail = pytest.skip if skip_on_missing_postgres else pytest.exit
+        self._drop_executor = None
         super(PostgresServer, self).__init__(workspace=None, delete=True, preserve_sys_path=False, **kwargs)
 
     def kill(self, retries=5):
@@ -54,16 +163,20 @@ class PostgresServer(TestServer):
                     pass
                 else:
                     raise
+            else:
+                # Wait for the postmaster to finish shutting down, so it can be restarted on the same data
+                try:
+                    psutil.Process(self.pid).wait(timeout=self.kill_retry_delay * retries)
+                except (psutil.NoSuchProcess, psutil.TimeoutExpired):
+                    pass
 
     def pre_setup(self):
         """
         Find postgres server binary
         Set up connection parameters
         """
-        (self.workspace / 'db').mkdir()  # pylint: disable=no-value-for-parameter
-
         try:
-            self.pg_bin = subprocess.check_output([CONFIG.pg_config_executable, "--bindir"]).decode('utf-8').rstrip()
+            self.pg_bin, pg_version = get_pg_install(CONFIG.pg_config_executable)
         except OSError as e:
             msg = "Failed to get pg_config --bindir: " + text_type(e)
             print(msg)
@@ -73,8 +186,18 @@ class PostgresServer(TestServer):
             msg = "Unable to find pg binary specified by pg_config: {} is not a file".format(initdb_path)
             print(msg)
             self._fail(msg)
+
+        def initdb(path):
+            subprocess.check_call([initdb_path] + list(self.initdb_args) + [path])
+
+        db = str(self.workspace / 'db')
         try:
-            subprocess.check_call([initdb_path, str(self.workspace / 'db')])
+            if CONFIG.pg_cluster_cache:
+                key = cluster_cache_key(pg_version, self.initdb_args)
+                copy_tree(get_cached_cluster(CONFIG.pg_cluster_cache, key, initdb), db)
+            else:
+                os.mkdir(db)
+                initdb(db)
         except OSError as e:
             msg = "Failed to launch postgres: " + text_type(e)
             print(msg)
@@ -101,6 +224,10 @@ class PostgresServer(TestServer):
         ]  # yapf: disable
         return cmd
 
+    def readiness_probe(self):
+        """Postgres creates its unix socket once it is ready to accept connections"""
+        return FileProbe(self.workspace / 'db' / '.s.PGSQL.{}'.format(self.port))
+
     def check_server_up(self):
         from psycopg2 import OperationalError
         conn = None
@@ -109,7 +236,10 @@ class PostgresServer(TestServer):
             conn = self.connect('postgres')
             conn.set_session(autocommit=True)
             with conn.cursor() as cursor:
-                cursor.execute("CREATE DATABASE " + self.database_name)
+                # The database already exists when restarting from a snapshot
+                cursor.execute("SELECT 1 FROM pg_database WHERE datname = %s", (self.database_name,))
+                if not cursor.fetchone():
+                    cursor.execute("CREATE DATABASE " + self.database_name)
             self.connection = self.connect(self.database_name)
             with open(self.workspace / 'db' / 'postmaster.pid', 'r') as f:
                 self.pid = int(f.readline().rstrip())
@@ -127,3 +257,75 @@ class PostgresServer(TestServer):
         if database is not None:
             cfg[u'database'] = database
         return psycopg2.connect(**cfg)
+
+    def _execute(self, database, statement, *args):
+        """Run a statement outside of a transaction, eg. CREATE DATABASE"""
+        conn = self.connect(database)
+        try:
+            conn.set_session(autocommit=True)
+            with conn.cursor() as cursor:
+                cursor.execute(statement, *args)
+        finally:
+            conn.close()
+
+    def create_template(self, name, seed=None):
+        """
+        Create a template database for clone_database().
+
+        Parameters
+        ----------
+        name: `str`
+            Name of the template database
+        seed: `callable` or `str`
+            Called with a psycopg2 connection to the new database to create its schema and data,
+            or a string of SQL to run in it.
+        """
+        from psycopg2 import sql
+        self._execute('postgres', sql.SQL("CREATE DATABASE {}").format(sql.Identifier(name)))
+        if seed is not None:
+            conn = self.connect(name)
+            try:
+                if callable(seed):
+                    seed(conn)
+                else:
+                    with conn.cursor() as cursor:
+                        cursor.execute(seed)
+                conn.commit()
+            finally:
+                conn.close()
+        # Nobody may be connected to a template while it is being cloned
+        self._execute('postgres', sql.SQL("ALTER DATABASE {} WITH IS_TEMPLATE true ALLOW_CONNECTIONS false")
+                      .format(sql.Identifier(name)))
+
+    def clone_database(self, template, name=None):
+        """
+        Create a new database as a copy of a template database, returning its name.
+        """
+        from psycopg2 import sql
+        name = name or 'test_' + uuid.uuid4().hex[:12]
+        self._execute('postgres', sql.SQL("CREATE DATABASE {} TEMPLATE {}")
+                      .format(sql.Identifier(name), sql.Identifier(template)))
+        return name
+
+    def drop_database(self, name, wait=False):
+        """
+        Drop a database in the background. All connections to it must have been closed.
+        Pending drops are finished before the server is torn down.
+        """
+        from psycopg2 import sql
+        if self._drop_executor is None:
+            self._drop_executor = ThreadPoolExecutor(max_workers=1)
+        future = self._drop_executor.submit(self._execute, 'postgres',
+                                            sql.SQL("DROP DATABASE IF EXISTS {}").format(sql.Identifier(name)))
+        if wait:
+            future.result()
+        return future
+
+    def teardown(self):
+        if self._drop_executor is not None:
+            self._drop_executor.shutdown(wait=True)
+            self._drop_executor = None
+        super(PostgresServer, self).teardown()
+
+
+register_session_server('postgres_server_sess', PostgresServer, ['pg_config_executable'])
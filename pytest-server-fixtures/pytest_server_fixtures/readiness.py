@@ -0,0 +1,179 @@
+""" Cheap readiness probes used to gate the (expensive) server up checks.
+
+A probe answers the question "has anything happened yet that makes it worth
+calling ``check_server_up()``?". The server's own protocol check is only run
+once a probe has fired, so servers are noticed as soon as they are listening
+rather than at the next step of the exponential backoff.
+"""
+import ctypes
+import ctypes.util
+import errno
+import logging
+import os
+import re
+import selectors
+import socket
+import threading
+import time
+
+from six import string_types
+
+log = logging.getLogger(__name__)
+
+
+class ReadinessProbe(object):
+    """ Base class for readiness probes. """
+
+    def wait(self, timeout):
+        """ Block until the probe fires or the timeout expires.
+
+        Parameters
+        ----------
+        timeout: ``float``
+            maximum time to wait in seconds
+
+        Returns
+        -------
+        True if the probe fired, False if it timed out or cannot fire.
+        """
+        raise NotImplementedError("Concrete class should implement this")
+
+
+class TCPProbe(ReadinessProbe):
+    """ Fires as soon as a TCP connection to (host, port) can be established.
+
+    Connections are made non-blocking and waited on with a selector, refused
+    connections are retried every ``retry_interval`` seconds.
+    """
+
+    def __init__(self, host, port, retry_interval=0.01):
+        self.host = host
+        self.port = port
+        self.retry_interval = retry_interval
+
+    def _try_connect(self, deadline):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setblocking(False)
+        try:
+            err = sock.connect_ex((self.host, self.port))
+            if err in (errno.EINPROGRESS, errno.EWOULDBLOCK, errno.EAGAIN):
+                with selectors.DefaultSelector() as sel:
+                    sel.register(sock, selectors.EVENT_WRITE)
+                    if not sel.select(max(deadline - time.time(), 0)):
+                        return False
+                err = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+            return err == 0
+        except socket.error:
+            return False
+        finally:
+            sock.close()
+
+    def wait(self, timeout):
+        deadline = time.time() + timeout
+        while True:
+            if self._try_connect(deadline):
+                return True
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return False
+            time.sleep(min(self.retry_interval, remaining))
+
+
+class LogLineProbe(ReadinessProbe):
+    """ Fires when a line of server output matches ``pattern``.
+
+    Lines are pushed into the probe with ``feed()`` by whatever is reading the
+    server's stdout/stderr. A probe that was never attached to an output
+    stream cannot fire, so ``wait()`` returns False immediately.
+    """
+
+    def __init__(self, pattern):
+        if isinstance(pattern, string_types):
+            pattern = re.compile(pattern)
+        self.pattern = pattern
+        self.attached = False
+        self._event = threading.Event()
+
+    def attach(self):
+        """ Mark this probe as receiving server output. """
+        self.attached = True
+
+    def feed(self, line):
+        if not isinstance(line, string_types):
+            line = line.decode('utf-8', 'replace')
+        if self.pattern.search(line):
+            self._event.set()
+
+    def wait(self, timeout):
+        if not self.attached:
+            return self._event.is_set()
+        return self._event.wait(timeout)
+
+
+_IN_CREATE = 0x00000100
+_IN_MOVED_TO = 0x00000080
+_IN_CLOSE_WRITE = 0x00000008
+_IN_NONBLOCK = os.O_NONBLOCK
+_IN_CLOEXEC = getattr(os, 'O_CLOEXEC', 0o2000000)
+_libc = None
+
+
+def _get_libc():
+    global _libc
+    if _libc is None:
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        if not hasattr(libc, 'inotify_init1'):
+            raise OSError(errno.ENOSYS, "inotify not supported")
+        _libc = libc
+    return _libc
+
+
+class FileProbe(ReadinessProbe):
+    """ Fires when ``path`` exists, eg. a pid file or unix socket.
+
+    Uses inotify on the parent directory where available, otherwise falls
+    back to polling ``os.path.exists`` every ``poll_interval`` seconds.
+    """
+
+    def __init__(self, path, poll_interval=0.01):
+        self.path = str(path)
+        self.poll_interval = poll_interval
+
+    def _inotify_fd(self):
+        try:
+            libc = _get_libc()
+        except (OSError, AttributeError):
+            return None
+        fd = libc.inotify_init1(_IN_NONBLOCK | _IN_CLOEXEC)
+        if fd < 0:
+            return None
+        parent = os.path.dirname(os.path.abspath(self.path)).encode('utf-8')
+        if libc.inotify_add_watch(fd, parent, _IN_CREATE | _IN_MOVED_TO | _IN_CLOSE_WRITE) < 0:
+            os.close(fd)
+            return None
+        return fd
+
+    def wait(self, timeout):
+        deadline = time.time() + timeout
+        fd = self._inotify_fd()
+        try:
+            with selectors.DefaultSelector() as sel:
+                if fd is not None:
+                    sel.register(fd, selectors.EVENT_READ)
+                while not os.path.exists(self.path):
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        return False
+                    if fd is None:
+                        time.sleep(min(self.poll_interval, remaining))
+                    elif sel.select(remaining):
+                        # Drain the event queue, we only care that something changed
+                        try:
+                            while os.read(fd, 4096):
+                                pass
+                        except OSError:
+                            pass
+                return True
+        finally:
+            if fd is not None:
+                os.close(fd)
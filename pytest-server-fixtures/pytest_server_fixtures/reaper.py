@@ -0,0 +1,69 @@
+""" Background teardown of test servers.
+
+Killing a server's process tree and deleting its workspace can take a while,
+which blocks the next test when done inline. With
+SERVER_FIXTURES_BACKGROUND_TEARDOWN set, servers rename their workspace to a
+trash path, so the name is free straight away, and hand the kill and rmtree
+to a small thread pool here. The session plugin drains the pool at the end of
+the session and reports any failures.
+"""
+import logging
+import os
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor, wait
+
+from pytest_server_fixtures import CONFIG
+
+log = logging.getLogger(__name__)
+
+_lock = threading.Lock()
+_executor = None
+_pending = []
+
+
+def trash(path):
+    """ Rename path to a unique trash path next to it. Returns the new path,
+        or the original one if it could not be renamed.
+    """
+    trash_path = '%s.trash-%s' % (str(path).rstrip(os.sep), uuid.uuid4().hex[:8])
+    try:
+        os.rename(str(path), trash_path)
+    except OSError as e:
+        log.debug("Failed to move %s to the trash, deleting it in place: %s" % (path, e))
+        return str(path)
+    return trash_path
+
+
+def submit(description, fn, *args):
+    """ Run fn(*args) in the background. Failures are reported by `drain()`.
+    """
+    global _executor
+    with _lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=CONFIG.teardown_workers)
+        future = _executor.submit(fn, *args)
+        _pending.append((description, future))
+    return future
+
+
+def drain():
+    """
+    Wait for all background teardowns to finish.
+
+    Returns
+    -------
+    list of (description, exception) for the ones that failed
+    """
+    global _executor
+    with _lock:
+        pending = list(_pending)
+        del _pending[:]
+        executor, _executor = _executor, None
+    wait([future for _, future in pending])
+    if executor is not None:
+        executor.shutdown(wait=True)
+    failures = [(description, future.exception()) for description, future in pending if future.exception()]
+    for description, err in failures:
+        log.error("Background %s failed: %s" % (description, err))
+    return failures
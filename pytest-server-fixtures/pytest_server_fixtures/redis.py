@@ -5,14 +5,205 @@ Created on 25 Apr 2012
 
 '''
 from __future__ import absolute_import
+import errno
+import hashlib
+import itertools
+import logging
+import os
+import random
+import re
 import socket
+import shutil
+import subprocess
+import tempfile
+import time
+import uuid
+import weakref
+from collections import namedtuple
 
 import pytest
+import six
 
 from pytest_server_fixtures import CONFIG
 from pytest_fixture_config import requires_config
 
 from .base2 import TestServerV2
+from .group import ServerGroup, get_prestarted, register_session_server
+from .images import register_fixture_image
+from .pool import lease_server
+from .readiness import LogLineProbe
+from .snapshot import copy_file
+
+log = logging.getLogger(__name__)
+
+# Logged at notice level once the server is up, 'The server is now ready...' before Redis 3.2
+READY_LOG_LINE = r'(?i)ready to accept connections'
+
+# Database leases are keys in database 0, which is never leased itself
+LEASE_KEY = 'pytest-server-fixtures:db-lease:%d'
+# Leases held by a crashed process are freed after this long
+LEASE_TTL_MS = 3600 * 1000
+LEASE_WAIT_SECS = 60
+
+# Deletes a lease only if it is still ours
+RELEASE_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+"""
+
+LOAD_CHUNK_SIZE = 10000
+
+
+class LoadStats(namedtuple('LoadStats', 'commands errors seconds')):
+    """ Result of `RedisTestServer.load()`
+    """
+    __slots__ = ()
+
+    @property
+    def rate(self):
+        """ Commands per second
+        """
+        return self.commands / self.seconds if self.seconds else float('inf')
+
+
+def _to_bytes(value):
+    if isinstance(value, bytes):
+        return value
+    if isinstance(value, six.text_type):
+        return value.encode('utf-8')
+    return str(value).encode('utf-8')
+
+
+def encode_command(args):
+    """ Encode a command as a RESP array of bulk strings, as sent by Redis clients
+    """
+    parts = [b'*' + str(len(args)).encode('ascii') + b'\r\n']
+    for arg in args:
+        arg = _to_bytes(arg)
+        parts.extend((b'$', str(len(arg)).encode('ascii'), b'\r\n', arg, b'\r\n'))
+    return b''.join(parts)
+
+
+def iter_commands(data):
+    """ Yields the commands for `RedisTestServer.load()` data: SET commands for a
+        mapping, otherwise the items of the iterable themselves.
+    """
+    if hasattr(data, 'items'):
+        for key, value in six.iteritems(data):
+            yield ('SET', key, value)
+    else:
+        for command in data:
+            yield command
+
+
+def _chunks(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def get_redis_cli():
+    """ redis-cli from the same directory as the redis server executable, or from the PATH
+    """
+    bindir = os.path.dirname(CONFIG.redis_executable)
+    return os.path.join(bindir, 'redis-cli') if bindir else 'redis-cli'
+
+
+RDB_FILENAME = 'dump.rdb'
+
+CLUSTER_SLOTS = 16384
+# Seconds to wait for all the nodes of a cluster or replica set to come together
+TOPOLOGY_TIMEOUT = 60
+
+_redis_version_cache = {}
+
+
+def get_redis_version(redis_executable):
+    """ Returns the version string of a redis-server executable. Results are cached for the session.
+    """
+    if redis_executable not in _redis_version_cache:
+        version = subprocess.check_output([redis_executable, '--version']).decode('utf-8').rstrip()
+        _redis_version_cache[redis_executable] = version
+    return _redis_version_cache[redis_executable]
+
+
+def get_redis_major_version(redis_executable):
+    """ Returns the major version of a redis-server executable, or None if it can't be told
+    """
+    match = re.search(r'v=(\d+)\.', get_redis_version(redis_executable))
+    return int(match.group(1)) if match else None
+
+
+def slot_ranges(masters):
+    """ Split the cluster hash slots into contiguous (first, last) ranges, one per master
+    """
+    return [(CLUSTER_SLOTS * i // masters, CLUSTER_SLOTS * (i + 1) // masters - 1) for i in range(masters)]
+
+
+def wait_for_all(nodes, ready, description, timeout=TOPOLOGY_TIMEOUT):
+    """ Wait until ready(node) is true for every node at the same time
+    """
+    deadline = time.time() + timeout
+    delay = 0.01
+    while True:
+        pending = [node for node in nodes if not ready(node)]
+        if not pending:
+            return
+        if time.time() > deadline:
+            raise RuntimeError("Timed out after %ss waiting for %s on %s"
+                               % (timeout, description, ', '.join('%s:%s' % (n.hostname, n.port) for n in pending)))
+        time.sleep(delay)
+        delay = min(delay * 2, 0.5)
+
+
+def dataset_key(dataset, version='', db=0, databases=None):
+    """
+    Key for a cached RDB file: a hash of the Redis version, the database the dataset is
+    loaded into, the number of databases and the commands of the dataset.
+    The order of the keys of a mapping does not matter.
+    """
+    if hasattr(dataset, 'items'):
+        dataset = sorted(six.iteritems(dataset), key=lambda item: _to_bytes(item[0]))
+        dataset = (('SET', key, value) for key, value in dataset)
+    h = hashlib.sha1()
+    h.update(version.encode('utf-8'))
+    h.update(('\0db=%s\0databases=%s\0' % (db, databases)).encode('utf-8'))
+    for command in dataset:
+        h.update(encode_command(command))
+    return h.hexdigest()
+
+
+def get_cached_rdb(cache_dir, key, build):
+    """
+    Returns the path of the cached RDB file for key, calling build(path) to create it if needed.
+    Files are built under a temporary name and renamed into place, so concurrent processes
+    never see a partial file.
+    """
+    rdb = os.path.join(cache_dir, key + '.rdb')
+    if os.path.isfile(rdb):
+        return rdb
+    try:
+        os.makedirs(cache_dir)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+    fd, tmp = tempfile.mkstemp(prefix=key + '.', suffix='.tmp', dir=cache_dir)
+    os.close(fd)
+    try:
+        build(tmp)
+        # mkstemp files are private, but a cache directory set in the config may be shared
+        os.chmod(tmp, 0o644)
+        os.rename(tmp, rdb)
+        log.debug("Cached Redis dataset in %s" % rdb)
+    finally:
+        if os.path.isfile(tmp):
+            os.remove(tmp)
+    return rdb
 
 
 def _redis_server(request):
@@ -34,7 +225,12 @@ def redis_server(request):
         ----------
         api: (``redis.Redis``)   Redis client API connected to this server
         .. also inherits all attributes from the `workspace` fixture
+
+        When SERVER_FIXTURES_POOL_SIZE is set, a warm server is leased from
+        a pool and flushed after the test instead.
     """
+    if CONFIG.pool_size:
+        return lease_server(request, RedisTestServer)
     return _redis_server(request)
 
 
@@ -43,22 +239,171 @@ def redis_server(request):
 def redis_server_sess(request):
     """ Same as redis_server fixture, scoped for test session
     """
-    return _redis_server(request)
+    return get_prestarted('redis_server_sess') or _redis_server(request)
+
+
+@pytest.fixture(scope='function')
+@requires_config(CONFIG, ['redis_executable'])
+def redis_db(request, redis_server_sess):
+    """ Function-scoped Redis client for a database of its own on the session server.
+
+        A free database index is leased for the test and flushed when it is
+        returned, so tests are isolated without starting a server each.
+        The client's database index is ``client.connection_pool.connection_kwargs['db']``.
+    """
+    db = redis_server_sess.lease_db()
+    request.addfinalizer(lambda: redis_server_sess.release_db(db))
+    return redis_server_sess.client(db)
+
+
+# Per-test command statistics, enabled with --server-fixtures-redis-stats
+SLOWLOG_LEN = 1024
+SLOWEST_COMMANDS = 5
+# Commands used to take the statistics themselves
+STATS_COMMANDS = ('info', 'slowlog', 'latency')
+
+_stats_enabled = False
+_instrumented = weakref.WeakSet()
+
+
+def enable_stats():
+    """ Instrument the Redis servers created from now on, for `stats_snapshot()` and `stats_since()`
+    """
+    global _stats_enabled
+    _stats_enabled = True
+
+
+def stats_enabled():
+    return _stats_enabled
+
+
+def instrumented_servers():
+    return list(_instrumented)
+
+
+def _decode(value):
+    return value.decode('utf-8', 'replace') if isinstance(value, bytes) else str(value)
+
+
+def stats_snapshot(server):
+    """ Current command counters of an instrumented server, to diff against with `stats_since()`
+    """
+    commands = {}
+    for key, value in server.api.info('commandstats').items():
+        name = key[len('cmdstat_'):] if key.startswith('cmdstat_') else key
+        if name.split('|')[0] not in STATS_COMMANDS:
+            commands[name] = (int(value['calls']), int(value['usec']))
+    slowlog = server.api.slowlog_get(1)
+    return {
+        'commands': commands,
+        'slowlog_id': slowlog[0]['id'] if slowlog else -1,
+        'time': int(time.time()),
+    }
+
+
+def stats_since(server, before=None):
+    """
+    Commands run by an instrumented server since a `stats_snapshot()`, or since it started.
+
+    Returns
+    -------
+    dict with the total calls and server-side microseconds per command and overall, the
+    slowest commands in the slowlog and any latency monitor events
+    """
+    after = stats_snapshot(server)
+    before = before or {'commands': {}, 'slowlog_id': -1, 'time': 0}
+    commands = {}
+    for name, (calls, usec) in after['commands'].items():
+        prev_calls, prev_usec = before['commands'].get(name, (0, 0))
+        if calls > prev_calls:
+            commands[name] = {'calls': calls - prev_calls, 'usec': usec - prev_usec}
+    slowest = [{'command': _decode(entry['command'])[:200], 'usec': entry['duration']}
+               for entry in server.api.slowlog_get(SLOWLOG_LEN)
+               if entry['id'] > before['slowlog_id']
+               and _decode(entry['command']).split(' ')[0].lower() not in STATS_COMMANDS]
+    slowest.sort(key=lambda entry: entry['usec'], reverse=True)
+    latency = [{'event': _decode(event), 'latest_ms': latest, 'max_ms': longest}
+               for event, timestamp, latest, longest in server.api.execute_command('LATENCY', 'LATEST')
+               if timestamp >= before['time']]
+    return {
+        'server': '%s:%s' % (server.hostname, server.port),
+        'calls': sum(c['calls'] for c in commands.values()),
+        'usec': sum(c['usec'] for c in commands.values()),
+        'commands': commands,
+        'slowest': slowest[:SLOWEST_COMMANDS],
+        'latency': latency,
+    }
+
+
+def _redis_topology(request, factory):
+    topology = factory()
+    request.addfinalizer(topology.teardown)
+    topology.start()
+    return topology
+
+
+@pytest.fixture(scope='function')
+@requires_config(CONFIG, ['redis_executable'])
+def redis_cluster(request):
+    """ Function-scoped Redis Cluster of three masters, see `RedisCluster`
+    """
+    return _redis_topology(request, RedisCluster)
+
+
+@pytest.fixture(scope='session')
+@requires_config(CONFIG, ['redis_executable'])
+def redis_cluster_sess(request):
+    """ Same as redis_cluster fixture, scoped for test session
+    """
+    return _redis_topology(request, RedisCluster)
+
+
+@pytest.fixture(scope='function')
+@requires_config(CONFIG, ['redis_executable'])
+def redis_replicated(request):
+    """ Function-scoped Redis primary with two replicas, see `RedisReplicaSet`
+    """
+    return _redis_topology(request, RedisReplicaSet)
+
+
+@pytest.fixture(scope='session')
+@requires_config(CONFIG, ['redis_executable'])
+def redis_replicated_sess(request):
+    """ Same as redis_replicated fixture, scoped for test session
+    """
+    return _redis_topology(request, RedisReplicaSet)
 
 
 class RedisTestServer(TestServerV2):
     """This will look for 'redis_executable' in configuration and use as the
     redis-server to run.
+
+    A dataset, in any form accepted by `load()` that can be iterated more than once,
+    is loaded into `db` when the server starts. With the thread server class it is
+    built once into an RDB file cached by content hash, and later servers start from
+    a copy of that file rather than replaying the writes.
     """
 
-    def __init__(self, db=0, delete=True, **kwargs):
+    def __init__(self, db=0, delete=True, databases=None, dataset=None, cluster=False, **kwargs):
         global redis
         import redis
 
         super(RedisTestServer, self).__init__(delete=delete, **kwargs)
         self.db = db
+        self.databases = databases or CONFIG.redis_databases
+        self.dataset = dataset
+        self.cluster = cluster
+        self._rdb_loaded = False
         self._api = None
+        self._lease_api = None
+        self._leases = {}
         self._port = self._get_port(6379)
+        self._bus_port = None
+        if _stats_enabled:
+            _instrumented.add(self)
+        if cluster and self._server_class == 'thread' and (get_redis_major_version(CONFIG.redis_executable) or 0) >= 7:
+            # The default bus port, port + 10000, may be out of range or taken
+            self._bus_port = self._get_port(16379)
 
     @property
     def api(self):
@@ -68,6 +413,118 @@ class RedisTestServer(TestServerV2):
             self._api = redis.Redis(host=self.hostname, port=self.port, db=self.db)
         return self._api
 
+    def client(self, db=None):
+        """ Returns a new `redis.Redis` client for the given database, by default `db`
+        """
+        return redis.Redis(host=self.hostname, port=self.port, db=self.db if db is None else db)
+
+    def lease_db(self, timeout=LEASE_WAIT_SECS):
+        """
+        Lease a database index that no-one else is using, waiting for one to be
+        returned if necessary.
+
+        Leases are held as keys in database 0 of the server itself, so they are
+        shared by every process using it, eg. xdist workers. Database 0 is never leased.
+
+        Returns
+        -------
+        The database index, to be returned with `release_db()`
+        """
+        if self.databases < 2:
+            raise ValueError("Redis server has no databases to lease, start it with databases > 1")
+        if self._lease_api is None:
+            self._lease_api = self.client(0)
+        token = uuid.uuid4().hex
+        deadline = time.time() + timeout
+        delay = 0.01
+        while True:
+            # Start at a random index so that concurrent callers don't all race for the same one
+            start = random.randrange(1, self.databases)
+            for i in range(self.databases - 1):
+                db = 1 + (start - 1 + i) % (self.databases - 1)
+                if self._lease_api.set(LEASE_KEY % db, token, nx=True, px=LEASE_TTL_MS):
+                    self._leases[db] = token
+                    return db
+            if time.time() > deadline:
+                raise RuntimeError("No free database on Redis server at %s:%s after %ss"
+                                   % (self.hostname, self.port, timeout))
+            time.sleep(delay)
+            delay = min(delay * 2, 0.5)
+
+    def release_db(self, db):
+        """ Flush a leased database and return it
+        """
+        token = self._leases.pop(db)
+        client = self.client(db)
+        try:
+            client.flushdb(asynchronous=True)
+        except redis.ResponseError:
+            # FLUSHDB ASYNC needs Redis 4.0
+            client.flushdb()
+        self._lease_api.eval(RELEASE_SCRIPT, 1, LEASE_KEY % db, token)
+
+    def load(self, data, db=None, method='pipeline', chunk_size=LOAD_CHUNK_SIZE):
+        """
+        Bulk-load data into the server, much faster than issuing commands one at a time.
+        The server runs without save points, so no background saves are forked during the load.
+
+        Parameters
+        ----------
+        data: `dict` or iterable
+            Either a mapping of keys to values to SET, or an iterable (eg. a generator) of
+            commands as sequences of arguments, eg. ``('HSET', 'key', 'field', 'value')``.
+            Data is streamed in chunks, so it needn't fit in memory.
+        db: `int`
+            Database to load into, by default `db`
+        method: `str`
+            'pipeline' to send chunks through non-transactional client pipelines,
+            or 'pipe' to stream the commands encoded as RESP through ``redis-cli --pipe``,
+            which is faster still for millions of keys but needs redis-cli locally.
+        chunk_size: `int`
+            Number of commands sent per round-trip
+
+        Returns
+        -------
+        `LoadStats` with the number of commands sent, how many of them failed and the time taken
+        """
+        db = self.db if db is None else db
+        start = time.time()
+        if method == 'pipeline':
+            commands, errors = self._load_pipeline(iter_commands(data), db, chunk_size)
+        elif method == 'pipe':
+            commands, errors = self._load_pipe(iter_commands(data), db, chunk_size)
+        else:
+            raise ValueError("Unknown load method: %s" % method)
+        stats = LoadStats(commands, errors, time.time() - start)
+        log.info("Loaded %d commands (%d errors) into Redis at %s:%s db %s in %.2fs, %.0f/s"
+                 % (stats.commands, stats.errors, self.hostname, self.port, db, stats.seconds, stats.rate))
+        return stats
+
+    def _load_pipeline(self, commands, db, chunk_size):
+        client = self.api if db == self.db else self.client(db)
+        count = errors = 0
+        for chunk in _chunks(commands, chunk_size):
+            pipe = client.pipeline(transaction=False)
+            for command in chunk:
+                pipe.execute_command(*command)
+            results = pipe.execute(raise_on_error=False)
+            count += len(chunk)
+            errors += sum(1 for r in results if isinstance(r, Exception))
+        return count, errors
+
+    def _load_pipe(self, commands, db, chunk_size):
+        cmd = [get_redis_cli(), '-h', self.hostname, '-p', str(self.port), '-n', str(db), '--pipe']
+        proc = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        try:
+            for chunk in _chunks(commands, chunk_size):
+                proc.stdin.write(b''.join(encode_command(command) for command in chunk))
+        finally:
+            out = proc.communicate()[0].decode('utf-8', 'replace')
+        match = re.search(r'errors: (\d+), replies: (\d+)', out)
+        if proc.returncode != 0 or not match:
+            raise RuntimeError("redis-cli --pipe failed (%s): %s" % (proc.returncode, out))
+        return int(match.group(2)), int(match.group(1))
+
     @property
     def cmd(self):
         return "redis-server"
@@ -82,13 +539,27 @@ class RedisTestServer(TestServerV2):
             "--port", str(self.port),
             "--timeout", "0",
             "--loglevel", "notice",
-            "--databases", "1",
+            "--databases", str(self.databases),
             "--maxmemory", "2gb",
             "--maxmemory-policy", "noeviction",
             "--appendonly", "no",
-            "--slowlog-log-slower-than", "-1",
-            "--slowlog-max-len", "1024",
+            # No save points: no background saves while loading data, or at shutdown
+            "--save", "",
+            "--slowlog-log-slower-than", "0" if _stats_enabled else "-1",
+            "--slowlog-max-len", str(SLOWLOG_LEN),
         ]
+        if _stats_enabled:
+            cmd += ["--latency-monitor-threshold", "1"]
+        if self._server_class == 'thread':
+            cmd += ["--dir", str(self.workspace), "--dbfilename", RDB_FILENAME]
+        if self.cluster:
+            cmd += [
+                "--cluster-enabled", "yes",
+                "--cluster-config-file", "nodes.conf",
+                "--cluster-node-timeout", "5000",
+            ]
+            if self._bus_port:
+                cmd += ["--cluster-port", str(self._bus_port)]
 
         return cmd
 
@@ -100,6 +571,47 @@ class RedisTestServer(TestServerV2):
     def port(self):
         return self._port
 
+    def pre_setup(self):
+        """ Put the cached RDB file for the dataset in the workspace, building it if needed
+        """
+        # Only thread servers can be pointed at an RDB file in the workspace, the others
+        # load the dataset in post_setup()
+        if self.dataset is None or not CONFIG.redis_rdb_cache or self._server_class != 'thread':
+            return
+        key = dataset_key(self.dataset, get_redis_version(CONFIG.redis_executable), self.db, self.databases)
+        rdb = get_cached_rdb(CONFIG.redis_rdb_cache, key, self._build_rdb)
+        copy_file(rdb, os.path.join(str(self.workspace), RDB_FILENAME))
+        self._rdb_loaded = True
+
+    def post_setup(self):
+        """ Load the dataset if it was not started from an RDB file
+        """
+        if self.dataset is not None and not self._rdb_loaded:
+            self.load(self.dataset)
+
+    def _build_rdb(self, path):
+        builder = RedisTestServer(db=self.db, databases=self.databases)
+        try:
+            builder.start()
+            stats = builder.load(self.dataset)
+            if stats.errors:
+                raise RuntimeError("%d commands of the Redis dataset failed" % stats.errors)
+            builder.api.save()
+            shutil.copy(os.path.join(str(builder.workspace), RDB_FILENAME), path)
+        finally:
+            builder.teardown()
+
+    def reset(self):
+        """ Delete all keys in all databases
+        """
+        self.api.flushall()
+
+    def readiness_probe(self):
+        """ Redis only logs that it is ready once its RDB file is loaded, but accepts connections before """
+        if self._server_class == 'thread':
+            return LogLineProbe(READY_LOG_LINE)
+        return super(RedisTestServer, self).readiness_probe()
+
     def check_server_up(self):
         """ Ping the server
         """
@@ -115,3 +627,163 @@ class RedisTestServer(TestServerV2):
         except redis.ConnectionError as e:
             print("server not up yet (%s)" % e)
             return False
+
+
+class RedisCluster(object):
+    """
+    Redis Cluster of masters, each with its own replicas, all started in parallel.
+
+    Once the nodes are up, the hash slots are split evenly between the masters with one
+    ADDSLOTSRANGE (ADDSLOTS before Redis 7) per master, the nodes are introduced to each
+    other and the replicas attached, then the cluster is waited for as a whole.
+
+    Attributes
+    ----------
+    masters: `list`
+        `RedisTestServer` master nodes, in slot order
+    replicas: `list`
+        `RedisTestServer` replica nodes
+    api: `redis.RedisCluster`
+        Cluster client connected to the nodes
+    """
+
+    def __init__(self, masters=3, replicas_per_master=0, **kwargs):
+        self.masters = [RedisTestServer(cluster=True, **kwargs) for _ in range(masters)]
+        self.replicas = [RedisTestServer(cluster=True, **kwargs) for _ in range(masters * replicas_per_master)]
+        self._api = None
+
+    @property
+    def nodes(self):
+        return self.masters + self.replicas
+
+    @property
+    def api(self):
+        if not self._api:
+            self._api = redis.RedisCluster(host=self.masters[0].hostname, port=self.masters[0].port)
+        return self._api
+
+    def start(self):
+        ServerGroup(self.nodes).start_all()
+        try:
+            self._assign_slots()
+            self._meet()
+            self._replicate()
+            wait_for_all(self.nodes, self._node_ready, "cluster state ok")
+        except Exception:
+            self.teardown()
+            raise
+        log.debug("Redis cluster of %d masters and %d replicas is up" % (len(self.masters), len(self.replicas)))
+        return self
+
+    def _assign_slots(self):
+        for epoch, node in enumerate(self.nodes, 1):
+            # Epochs must be distinct, as in redis-cli --cluster create
+            node.api.execute_command('CLUSTER', 'SET-CONFIG-EPOCH', epoch)
+        for node, (first, last) in zip(self.masters, slot_ranges(len(self.masters))):
+            try:
+                node.api.execute_command('CLUSTER', 'ADDSLOTSRANGE', first, last)
+            except redis.ResponseError:
+                # ADDSLOTSRANGE needs Redis 7.0
+                node.api.execute_command('CLUSTER', 'ADDSLOTS', *range(first, last + 1))
+
+    def _meet(self):
+        first = self.masters[0]
+        for node in self.nodes[1:]:
+            node.api.execute_command('CLUSTER', 'MEET', first.hostname, first.port)
+        wait_for_all(self.nodes, lambda node: self._known_nodes(node) == len(self.nodes), "nodes to meet")
+
+    def _replicate(self):
+        if not self.replicas:
+            return
+        ids = [node.api.execute_command('CLUSTER', 'MYID') for node in self.masters]
+        for i, node in enumerate(self.replicas):
+            node.api.execute_command('CLUSTER', 'REPLICATE', ids[i % len(ids)])
+
+    @staticmethod
+    def _cluster_info(node):
+        info = node.api.execute_command('CLUSTER', 'INFO')
+        if isinstance(info, bytes):
+            info = info.decode('utf-8')
+        if isinstance(info, dict):
+            return dict((k, str(v)) for k, v in info.items())
+        return dict(line.split(':', 1) for line in info.splitlines() if ':' in line)
+
+    def _known_nodes(self, node):
+        return int(self._cluster_info(node).get('cluster_known_nodes', 0))
+
+    def _node_ready(self, node):
+        info = self._cluster_info(node)
+        return (info.get('cluster_state') == 'ok'
+                and int(info.get('cluster_known_nodes', 0)) == len(self.nodes))
+
+    def teardown(self):
+        if self._api is not None:
+            self._api.close()
+            self._api = None
+        ServerGroup(self.nodes).teardown()
+
+
+class RedisReplicaSet(object):
+    """
+    Redis primary with replicas, all started in parallel.
+
+    Once the nodes are up, each replica is pointed at the primary with REPLICAOF
+    (SLAVEOF before Redis 5), then they are waited for together until every link is up.
+
+    Attributes
+    ----------
+    primary: `RedisTestServer`
+        Node accepting writes
+    replicas: `list`
+        `RedisTestServer` read-only replicas of the primary
+    api: `redis.Redis`
+        Client connected to the primary
+    """
+
+    def __init__(self, replicas=2, **kwargs):
+        self.primary = RedisTestServer(**kwargs)
+        self.replicas = [RedisTestServer(**kwargs) for _ in range(replicas)]
+
+    @property
+    def nodes(self):
+        return [self.primary] + self.replicas
+
+    @property
+    def api(self):
+        return self.primary.api
+
+    def start(self):
+        ServerGroup(self.nodes).start_all()
+        try:
+            for node in self.replicas:
+                try:
+                    node.api.execute_command('REPLICAOF', self.primary.hostname, self.primary.port)
+                except redis.ResponseError:
+                    # REPLICAOF needs Redis 5.0
+                    node.api.execute_command('SLAVEOF', self.primary.hostname, self.primary.port)
+            wait_for_all(self.replicas, self._replica_ready, "replication links")
+        except Exception:
+            self.teardown()
+            raise
+        log.debug("Redis primary with %d replicas is up" % len(self.replicas))
+        return self
+
+    def _replica_ready(self, node):
+        info = node.api.info('replication')
+        return info.get('master_link_status') == 'up' and not info.get('master_sync_in_progress')
+
+    def wait_for_replication(self, timeout=TOPOLOGY_TIMEOUT):
+        """ Wait until every replica has caught up with the writes made to the primary so far
+        """
+        offset = self.primary.api.info('replication')['master_repl_offset']
+        wait_for_all(self.replicas, lambda node: node.api.info('replication').get('slave_repl_offset', -1) >= offset,
+                     "replication offset %s" % offset, timeout)
+
+    def teardown(self):
+        ServerGroup(self.nodes).teardown()
+
+
+register_session_server('redis_server_sess', RedisTestServer, ['redis_executable'])
+for _name in ('redis_server', 'redis_server_sess', 'redis_db', 'redis_cluster', 'redis_cluster_sess',
+              'redis_replicated', 'redis_replicated_sess'):
+    register_fixture_image(_name, 'redis_image')
@@ -8,6 +8,9 @@ from pytest_server_fixtures import CONFIG
 from pytest_fixture_config import requires_config
 
 from .base2 import TestServerV2
+from .group import get_prestarted, register_session_server
+from .images import register_fixture_image
+from .pool import lease_server
 
 
 log = logging.getLogger(__name__)
@@ -34,7 +37,11 @@ def rethink_server(request):
         conn: (``rethinkdb.Connection``)  Connection to this server instance
         .. also inherits all attributes from the `workspace` fixture
 
+        When SERVER_FIXTURES_POOL_SIZE is set, a warm server is leased from
+        a pool and its databases are dropped after the test instead.
     """
+    if CONFIG.pool_size:
+        return lease_server(request, RethinkDBServer)
     return _rethink_server(request)
 
 
@@ -43,7 +50,7 @@ def rethink_server(request):
 def rethink_server_sess(request):
     """ Same as rethink_server fixture, scoped as session instead.
     """
-    return _rethink_server(request)
+    return get_prestarted('rethink_server_sess') or _rethink_server(request)
 
 
 @pytest.yield_fixture(scope="function")
@@ -113,6 +120,7 @@ def rethink_empty_db(request, rethink_module_db, rethink_make_tables):
 
 class RethinkDBServer(TestServerV2):
     random_hostname = False
+    snapshot_dirs = ('db',)
 
     def __init__(self, **kwargs):
         # defer loading of rethinkdb
@@ -165,6 +173,14 @@ class RethinkDBServer(TestServerV2):
     def http_port(self):
         return self._http_port
 
+    def reset(self):
+        """Drop all databases apart from the system database, and recreate an empty 'test' database."""
+        for name in r.db_list().run(self.conn):
+            if name != 'rethinkdb':
+                r.db_drop(name).run(self.conn)
+        r.db_create('test').run(self.conn)
+        self.conn.use('test')
+
     def check_server_up(self):
         """Test connection to the server."""
         log.info("Connecting to RethinkDB at {0}:{1}".format(
@@ -179,3 +195,8 @@ class RethinkDBServer(TestServerV2):
         except rethinkdb.errors.RqlDriverError as err:
             log.warning(err)
         return False
+
+
+register_session_server('rethink_server_sess', RethinkDBServer, ['rethink_executable'])
+for _name in ('rethink_server', 'rethink_server_sess'):
+    register_fixture_image(_name, 'rethink_image')
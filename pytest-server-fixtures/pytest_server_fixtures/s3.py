@@ -15,6 +15,7 @@ from future.utils import text_type
 from pytest_fixture_config import requires_config
 
 from . import CONFIG
+from .group import get_prestarted, register_session_server
 from .http import HTTPTestServer
 
 log = logging.getLogger(__name__)
@@ -35,7 +36,7 @@ def s3_server(request):
     The primary method on the server object is `s3_server.get_s3_client()`, which returns a boto3 `Resource`
     (`boto3.resource('s3', ...)`)
     """
-    return _s3_server(request)
+    return get_prestarted('s3_server') or _s3_server(request)
 
 BucketInfo = namedtuple('BucketInfo', ['client', 'name'])
 # Minio is a little too slow to start for each function call
@@ -56,6 +57,7 @@ class MinioServer(HTTPTestServer):
     random_port = True
     aws_access_key_id = "MINIO_TEST_ACCESS"
     aws_secret_access_key = "MINIO_TEST_SECRET"
+    snapshot_dirs = ('minio-db',)
 
     def __init__(self, workspace=None, delete=None, preserve_sys_path=False, **kwargs):
         env = kwargs.get('env', os.environ.copy())
@@ -99,3 +101,6 @@ class MinioServer(HTTPTestServer):
             text_type(self.datadir),
         ]
         return cmdargs
+
+
+register_session_server('s3_server', MinioServer, ['minio_executable'])
@@ -25,6 +25,7 @@ def create_server(server_class, **kwargs):
             env=kwargs["env"],
             image=kwargs["image"],
             labels=kwargs["labels"],
+            reuse=kwargs.get("reuse", False),
         )
 
     if server_class == 'kubernetes':
@@ -36,4 +37,5 @@ def create_server(server_class, **kwargs):
             env=kwargs["env"],
             image=kwargs["image"],
             labels=kwargs["labels"],
+            packed_pod=kwargs.get("packed_pod"),
         )
@@ -50,6 +50,10 @@ class ServerClass(threading.Thread):
         self._cmd = cmd
         self._get_args = get_args
         self._env = env or {}
+        # Called with each line of server output, when output is captured
+        self.line_callbacks = []
+        # output.RingBuffer that captured output is also written to
+        self.output_buffer = None
 
     def run(self):
         """In a new thread, wait for the server to return."""
@@ -68,6 +72,11 @@ class ServerClass(threading.Thread):
         """Tell if the server is running."""
         raise NotImplementedError("Concrete class should implement this")
 
+    @property
+    def captures_output(self):
+        """Tell if server output is passed to line_callbacks."""
+        return False
+
     @property
     def hostname(self):
         """Get server's hostname."""
@@ -1,10 +1,32 @@
 """
 Docker server class implementation.
+
+In reuse mode (SERVER_FIXTURES_DOCKER_REUSE) containers are not stopped on
+teardown. They are labelled with a hash of their image, command, args and env,
+and later fixtures with the same hash attach to an idle one instead of starting
+a new container. Each container is leased by one process at a time with an
+flock on a file named after it, and containers left idle for longer than
+SERVER_FIXTURES_DOCKER_REUSE_TIMEOUT seconds are stopped.
+
+Container start and removal are waited for with a single docker events stream
+per process, shared by all servers, falling back to polling the container
+state if the stream is unavailable.
 """
 from __future__ import absolute_import
 
+import errno
+import fcntl
+import hashlib
+import json
 import logging
+import os
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
 import docker
+from docker.utils import parse_repository_tag
 
 from retry import retry
 from pytest_server_fixtures import CONFIG
@@ -15,6 +37,155 @@ from .common import (ServerClass,
 
 log = logging.getLogger(__name__)
 
+REUSE_KEY_LABEL = 'server-fixtures/reuse-key'
+# Seconds to wait for a container event before falling back to polling
+EVENT_TIMEOUT = 60
+LOCK_DIR = os.path.join(tempfile.gettempdir(), 'pytest-server-fixtures-docker')
+
+_reaped = False
+
+
+class EventWatcher(object):
+    """
+    Follows the docker event stream for server fixture containers on a background thread,
+    waking up threads waiting for a container to start or go away.
+    """
+
+    def __init__(self, client):
+        self._client = client
+        self._cond = threading.Condition()
+        # container id -> set of actions seen
+        self._seen = {}
+        self.failed = False
+
+    def start(self):
+        # Subscribe before returning, so no events are missed by containers launched afterwards
+        stream = self._client.events(decode=True, filters={'type': 'container', 'label': 'server-fixtures'})
+        thread = threading.Thread(target=self._run, args=(stream,), name='server-fixtures-docker-events')
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def _run(self, stream):
+        try:
+            for event in stream:
+                action = event.get('Action') or event.get('status')
+                container_id = event.get('Actor', {}).get('ID') or event.get('id')
+                with self._cond:
+                    self._seen.setdefault(container_id, set()).add(action)
+                    self._cond.notify_all()
+        except Exception as e:
+            log.warning("Docker event stream failed, falling back to polling: %s", e)
+        with self._cond:
+            self.failed = True
+            self._cond.notify_all()
+
+    def wait_for(self, container_id, actions, timeout=EVENT_TIMEOUT):
+        """ Wait until one of the actions, eg. 'start' or 'destroy', is seen for the container.
+            Returns False on timeout or if the event stream has gone away.
+        """
+        deadline = time.time() + timeout
+        with self._cond:
+            while not self._seen.get(container_id, set()).intersection(actions):
+                remaining = deadline - time.time()
+                if self.failed or remaining <= 0:
+                    return False
+                self._cond.wait(remaining)
+            return True
+
+    def forget(self, container_id):
+        with self._cond:
+            self._seen.pop(container_id, None)
+
+
+_watcher = None
+_watcher_lock = threading.Lock()
+
+
+def get_event_watcher(client):
+    """ Returns the process-wide `EventWatcher`, or None if the event stream is not available
+    """
+    global _watcher
+    with _watcher_lock:
+        if _watcher is None or _watcher.failed:
+            try:
+                _watcher = EventWatcher(client).start()
+            except docker.errors.APIError as e:
+                log.warning("Failed to subscribe to docker events: %s", e)
+                return None
+        return _watcher
+
+
+def pull_images(images, max_workers=4):
+    """ Pull the images that are not present locally, concurrently.
+        Failures are logged, the fixtures using those images will fail to launch with the real error.
+    """
+    client = docker.from_env()
+
+    def pull(image):
+        try:
+            client.images.get(image)
+            return
+        except docker.errors.ImageNotFound:
+            pass
+        repository, tag = parse_repository_tag(image)
+        log.debug('Pulling image %s', image)
+        client.images.pull(repository, tag=tag or 'latest')
+
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        futures = [(image, pool.submit(pull, image)) for image in images]
+    for image, future in futures:
+        if future.exception():
+            log.warning("Failed to pull image %s: %s", image, future.exception())
+
+
+def reuse_key(image, cmd, args, env):
+    """ Deterministic hash identifying interchangeable containers
+    """
+    spec = json.dumps([image, cmd, [str(arg) for arg in args], sorted((env or {}).items())])
+    return hashlib.sha1(spec.encode('utf-8')).hexdigest()[:16]
+
+
+def _lock_container(name):
+    """ Lease a container to this process. Returns the open lock file, or None if someone else holds it.
+    """
+    try:
+        os.makedirs(LOCK_DIR)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+    f = open(os.path.join(LOCK_DIR, name + '.lock'), 'a')
+    try:
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except (IOError, OSError):
+        f.close()
+        return None
+    return f
+
+
+def _unlock_container(lock):
+    # The lock file's mtime records when the container was last used
+    os.utime(lock.name, None)
+    lock.close()
+
+
+def reap_idle_containers(client, timeout):
+    """ Stop reusable containers that nobody has leased for more than timeout seconds
+    """
+    for container in client.containers.list(filters={'label': REUSE_KEY_LABEL}):
+        lock = _lock_container(container.name)
+        if lock is None:
+            continue
+        try:
+            if time.time() - os.path.getmtime(lock.name) > timeout:
+                log.debug('Stopping idle container %s', container.name)
+                container.stop()
+                os.unlink(lock.name)
+        except (docker.errors.APIError, OSError) as e:
+            log.warning("Failed to stop idle container %s: %s", container.name, e)
+        finally:
+            lock.close()
+
 
 class DockerServer(ServerClass):
     """Docker server class."""
@@ -25,7 +196,8 @@ class DockerServer(ServerClass):
                  get_args,
                  env,
                  image,
-                 labels={}):
+                 labels={},
+                 reuse=False):
         super(DockerServer, self).__init__(cmd, get_args, env)
 
         self._image = image
@@ -37,8 +209,17 @@ class DockerServer(ServerClass):
 
         self._client = docker.from_env()
         self._container = None
+        self._events = None
+        self.reuse = reuse
+        # Set when launch() attached to an existing container
+        self.reused = False
+        self._lock = None
 
     def launch(self):
+        self._events = get_event_watcher(self._client)
+        if self.reuse:
+            self._launch_reusable()
+            return
         try:
             log.debug('Launching container')
             self._container = self._client.containers.run(
@@ -62,6 +243,45 @@ class DockerServer(ServerClass):
 
         self.start()
 
+    def _launch_reusable(self):
+        global _reaped
+        if not _reaped:
+            _reaped = True
+            reap_idle_containers(self._client, CONFIG.docker_reuse_timeout)
+
+        key = reuse_key(self._image, self._cmd, self._get_args(), self._env)
+        for container in self._client.containers.list(filters={'label': '%s=%s' % (REUSE_KEY_LABEL, key)}):
+            self._lock = _lock_container(container.name)
+            if self._lock is not None:
+                log.debug('Reusing container %s', container.name)
+                self._container = container
+                self.reused = True
+                return
+
+        name = 'server-fixtures-reuse-%s-%s' % (key, self._id)
+        self._lock = _lock_container(name)
+        labels = merge_dicts(self._labels, {REUSE_KEY_LABEL: key})
+        # The container outlives this session
+        del labels['server-fixtures/session-id']
+        try:
+            log.debug('Launching reusable container %s', name)
+            self._container = self._client.containers.run(
+                image=self._image,
+                name=name,
+                command=[self._cmd] + self._get_args(),
+                environment=self._env,
+                labels=labels,
+                detach=True,
+                auto_remove=True,
+            )
+            self._wait_until_running()
+        except docker.errors.APIError as e:
+            log.warning("Failed to start container: %s", e)
+            _unlock_container(self._lock)
+            self._lock = None
+            raise
+        # No thread waits on the container, it is not expected to exit
+
     def run(self):
         try:
             self._container.wait()
@@ -73,6 +293,13 @@ class DockerServer(ServerClass):
         if not self._container:
             return
 
+        if self._lock is not None:
+            # Leave the container running for the next fixture
+            _unlock_container(self._lock)
+            self._lock = None
+            self._container = None
+            return
+
         try:
             # stopping container will also remove it as 'auto_remove' is set
             self._container.stop()
@@ -101,21 +328,38 @@ class DockerServer(ServerClass):
             log.warning("Failed to get container status: %s", e)
             raise
 
+    def _wait_until_running(self):
+        if self._events is not None and self._events.wait_for(self._container.id, ('start', 'die')):
+            if self.is_running:
+                return
+        self._poll_until_running()
+
     @retry(ServerFixtureNotRunningException,
            tries=28,
            delay=1,
            backoff=2,
            max_delay=10)
-    def _wait_until_running(self):
+    def _poll_until_running(self):
         if not self.is_running:
             raise ServerFixtureNotRunningException()
 
+    def _wait_until_terminated(self):
+        container_id = self._container.id
+        try:
+            # Containers are removed once stopped, as 'auto_remove' is set
+            if self._events is not None and self._events.wait_for(container_id, ('destroy',)):
+                return
+            self._poll_until_terminated()
+        finally:
+            if self._events is not None:
+                self._events.forget(container_id)
+
     @retry(ServerFixtureNotTerminatedException,
            tries=28,
            delay=1,
            backoff=2,
            max_delay=10)
-    def _wait_until_terminated(self):
+    def _poll_until_terminated(self):
         try:
             self._get_status()
         except docker.errors.APIError as e:
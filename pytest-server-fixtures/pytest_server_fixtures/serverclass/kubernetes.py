@@ -1,18 +1,32 @@
 """
 Kubernetes server class implementation.
+
+Pod phases are followed with a single watch stream per process on the session's
+label selector, which wakes up threads waiting for a pod to be running or
+deleted. Polling the pod status is the fallback if the stream fails.
+
+Servers started together can be packed into one pod as sibling containers with
+a `PackedPod`, sharing the pod IP on their distinct ports, so the pod is
+scheduled once.
 """
 from __future__ import absolute_import
 
 import os
 import logging
+import threading
+import time
 import uuid
 
 from kubernetes import config
 from kubernetes import client as k8sclient
+from kubernetes import watch
 from kubernetes.client.rest import ApiException
 from retry import retry
 from pytest_server_fixtures import CONFIG
+from pytest_server_fixtures import reaper
+from pytest_server_fixtures.util import get_random_id
 from .common import (ServerClass,
+                     SERVER_ID_LEN,
                      merge_dicts,
                      ServerFixtureNotRunningException,
                      ServerFixtureNotTerminatedException)
@@ -35,11 +49,265 @@ if CONFIG.k8s_local_test:
     fixture_namespace = 'default'
 
 
+# Waiting reasons of a pre-pull container whose image isn't on the node yet, and those that are errors
+PULL_WAITING_REASONS = ('ContainerCreating', 'ErrImagePull', 'ImagePullBackOff')
+PULL_ERROR_REASONS = ('ErrImagePull', 'ImagePullBackOff', 'InvalidImageName')
+# Seconds to wait for a pod watch event before falling back to polling
+WATCH_TIMEOUT = 120
+# Marks deleted pods in PodWatcher
+DELETED = 'Deleted'
+
+
 class NotRunningInKubernetesException(Exception):
     """Thrown when code is not running as a Pod inside a Kubernetes cluster."""
     pass
 
 
+class PodWatcher(object):
+    """
+    Follows the pods matching a label selector with one `watch.Watch` stream on a background
+    thread, waking up threads waiting for pods to change phase.
+    """
+
+    def __init__(self, api, namespace, label_selector):
+        self._api = api
+        self._namespace = namespace
+        self._label_selector = label_selector
+        self._cond = threading.Condition()
+        # pod name -> phase, or DELETED
+        self._phases = {}
+        self.failed = False
+
+    def start(self):
+        thread = threading.Thread(target=self._run, name='server-fixtures-pod-watch')
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def _run(self):
+        resource_version = None
+        try:
+            while True:
+                # Without a resource version the watch starts by listing the existing pods
+                stream = watch.Watch().stream(self._api.list_namespaced_pod, namespace=self._namespace,
+                                              label_selector=self._label_selector,
+                                              resource_version=resource_version, timeout_seconds=300)
+                try:
+                    for event in stream:
+                        pod = event['object']
+                        resource_version = pod.metadata.resource_version
+                        phase = DELETED if event['type'] == 'DELETED' else pod.status.phase
+                        with self._cond:
+                            self._phases[pod.metadata.name] = phase
+                            self._cond.notify_all()
+                except ApiException as e:
+                    if e.status != 410:
+                        raise
+                    # Resource version too old, start again from a fresh listing
+                    resource_version = None
+        except Exception as e:
+            log.warning("Pod watch failed, falling back to polling: %s", e)
+        with self._cond:
+            self.failed = True
+            self._cond.notify_all()
+
+    def wait_for(self, name, phases, timeout=WATCH_TIMEOUT):
+        """ Wait until the pod is in one of the phases, eg. 'Running' or DELETED.
+            Returns the phase, or None on timeout or if the watch has failed.
+        """
+        deadline = time.time() + timeout
+        with self._cond:
+            while self._phases.get(name) not in phases:
+                remaining = deadline - time.time()
+                if self.failed or remaining <= 0:
+                    return None
+                self._cond.wait(remaining)
+            return self._phases[name]
+
+    def forget(self, name):
+        with self._cond:
+            self._phases.pop(name, None)
+
+
+_watcher = None
+_watcher_lock = threading.Lock()
+
+
+def get_pod_watcher(api):
+    """ Returns the process-wide `PodWatcher` for this session's pods
+    """
+    global _watcher
+    with _watcher_lock:
+        if _watcher is None or _watcher.failed:
+            _watcher = PodWatcher(api, fixture_namespace,
+                                  'server-fixtures/session-id=%s' % CONFIG.session_id).start()
+        return _watcher
+
+
+class PackedPod(object):
+    """
+    A pod running several `KubernetesServer` containers. Servers join it from their launch(),
+    and the pod is created by the last of the expected number of servers to join, with a single
+    create_namespaced_pod call. It is deleted once they have all been torn down.
+
+    Parameters
+    ----------
+    size: `int`
+        Number of servers that will join the pod
+    timeout: `float`
+        Seconds to wait for the other servers to join
+    """
+
+    def __init__(self, size, timeout=WATCH_TIMEOUT):
+        self.size = size
+        self.timeout = timeout
+        self.name = 'server-fixtures-%s-%s' % (CONFIG.session_id, get_random_id(SERVER_ID_LEN))
+        self.labels = {
+            'server-fixtures': 'kubernetes-server-fixtures',
+            'server-fixtures/server-type': 'packed',
+            'server-fixtures/session-id': CONFIG.session_id,
+        }
+        self._cond = threading.Condition()
+        self._members = []
+        self._active = 0
+        self._done = False
+        self._error = None
+
+    def join(self, server):
+        """ Add a server's container, waiting until the pod has been created
+        """
+        with self._cond:
+            if self._done and self._error is None:
+                raise ValueError("Pod %s has already been created" % self.name)
+            self._members.append(server)
+            self._active += 1
+            if len(self._members) == self.size:
+                try:
+                    self._create(server._v1api)
+                except Exception as e:
+                    self._error = e
+                self._done = True
+                self._cond.notify_all()
+            deadline = time.time() + self.timeout
+            while not self._done:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    self._abort(ServerFixtureNotRunningException(
+                        "Only %d of %d servers joined pod %s" % (len(self._members), self.size, self.name)))
+                    break
+                self._cond.wait(remaining)
+            if self._error is not None:
+                raise self._error
+
+    def abort(self, error):
+        """ Called when a server expected to join will not, releases the others with the error
+        """
+        with self._cond:
+            self._abort(error)
+
+    def _abort(self, error):
+        if not self._done:
+            self._error = error
+            self._done = True
+            self._cond.notify_all()
+
+    @property
+    def created(self):
+        with self._cond:
+            return self._done and self._error is None
+
+    def leave(self):
+        """ Returns True when the last server has left, and the pod can be deleted
+        """
+        with self._cond:
+            self._active -= 1
+            return self._active == 0
+
+    def _create(self, api):
+        containers = [server._get_container('fixture-%d' % i) for i, server in enumerate(self._members)]
+        pod = k8sclient.V1Pod(metadata=k8sclient.V1ObjectMeta(name=self.name, labels=self.labels),
+                              spec=k8sclient.V1PodSpec(containers=containers))
+        log.debug("[K8S %s:%s] Creating pod with %d containers", fixture_namespace, self.name, len(containers))
+        api.create_namespaced_pod(namespace=fixture_namespace, body=pod)
+
+
+def _pull_status(pods):
+    """
+    Count the containers of the pre-pull pods whose images are on their node, and collect pull errors.
+    Any state past the pull counts, even if the image couldn't run its command.
+    """
+    pulled = 0
+    errors = []
+    for pod in pods:
+        for status in pod.status.container_statuses or []:
+            waiting = status.state.waiting
+            if waiting is None or waiting.reason not in PULL_WAITING_REASONS:
+                pulled += 1
+            if waiting is not None and waiting.reason in PULL_ERROR_REASONS:
+                errors.append('%s on %s: %s' % (status.image, pod.spec.node_name, waiting.message or waiting.reason))
+    return pulled, errors
+
+
+def prepull_images(images, timeout=600):
+    """
+    Pull images onto every node of the cluster, with a DaemonSet running each of them as a
+    container. The containers are started side by side, so an image that can't run the no-op
+    command (eg. one without a shell) doesn't hold up the others: only the pulls are waited for.
+    Gives up early if a pull fails. The DaemonSet is deleted afterwards.
+    """
+    if not fixture_namespace:
+        raise NotRunningInKubernetesException()
+
+    name = 'server-fixtures-prepull-%s' % CONFIG.session_id.lower()
+    labels = {
+        'server-fixtures': 'kubernetes-server-fixtures',
+        'server-fixtures/session-id': CONFIG.session_id,
+        'server-fixtures/prepull': name,
+    }
+    containers = [k8sclient.V1Container(name='image-%d' % i, image=image, command=['sh', '-c', 'true'])
+                  for i, image in enumerate(images)]
+    body = k8sclient.V1DaemonSet(
+        metadata=k8sclient.V1ObjectMeta(name=name, labels=labels),
+        spec=k8sclient.V1DaemonSetSpec(
+            selector=k8sclient.V1LabelSelector(match_labels={'server-fixtures/prepull': name}),
+            template=k8sclient.V1PodTemplateSpec(
+                metadata=k8sclient.V1ObjectMeta(labels=labels),
+                spec=k8sclient.V1PodSpec(containers=containers),
+            ),
+        ),
+    )
+    api = k8sclient.AppsV1Api()
+    v1api = k8sclient.CoreV1Api()
+    log.debug("[K8S %s:%s] Pre-pulling images %s", fixture_namespace, name, images)
+    try:
+        api.create_namespaced_daemon_set(namespace=fixture_namespace, body=body)
+    except ApiException as e:
+        # Eg. no permission to create DaemonSets, the fixtures will pull the images themselves
+        log.warning("[K8S %s:%s] Failed to create pre-pull DaemonSet: %s", fixture_namespace, name, e.reason)
+        return
+    try:
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            nodes = api.read_namespaced_daemon_set_status(namespace=fixture_namespace, name=name).status \
+                       .desired_number_scheduled
+            pods = v1api.list_namespaced_pod(namespace=fixture_namespace,
+                                             label_selector='server-fixtures/prepull=%s' % name).items
+            pulled, errors = _pull_status(pods)
+            if errors:
+                log.warning("[K8S %s:%s] Failed to pre-pull images: %s", fixture_namespace, name, '; '.join(errors))
+                return
+            if nodes and len(pods) >= nodes and pulled >= nodes * len(images):
+                return
+            time.sleep(1)
+        log.warning("[K8S %s:%s] Images not pulled on all nodes after %ss", fixture_namespace, name, timeout)
+    finally:
+        try:
+            api.delete_namespaced_daemon_set(namespace=fixture_namespace, name=name,
+                                             body=k8sclient.V1DeleteOptions(grace_period_seconds=1))
+        except ApiException as e:
+            log.error("[K8S %s:%s] Failed to delete pre-pull DaemonSet: %s", fixture_namespace, name, e.reason)
+
+
 class KubernetesServer(ServerClass):
     """Kubernetes server class."""
 
@@ -49,7 +317,8 @@ class KubernetesServer(ServerClass):
                 get_args,
                 env,
                 image,
-                labels={}):
+                labels={},
+                packed_pod=None):
         super(KubernetesServer, self).__init__(cmd, get_args, env)
 
         if not fixture_namespace:
@@ -63,11 +332,16 @@ class KubernetesServer(ServerClass):
         })
 
         self._v1api = k8sclient.CoreV1Api()
+        self._watcher = get_pod_watcher(self._v1api)
+        self._packed_pod = packed_pod
 
     def launch(self):
         try:
             log.debug('%s Launching pod' % self._log_prefix)
-            self._create_pod()
+            if self._packed_pod is not None:
+                self._packed_pod.join(self)
+            else:
+                self._create_pod()
             self._wait_until_running()
             log.debug('%s Pod is running' % self._log_prefix)
         except ApiException as e:
@@ -78,8 +352,15 @@ class KubernetesServer(ServerClass):
         pass
 
     def teardown(self):
+        if self._packed_pod is not None:
+            if not self._packed_pod.leave() or not self._packed_pod.created:
+                # Other servers are still running in the pod, or it was never created
+                return
         self._delete_pod()
-        # TODO: provide an flag to skip the wait to speed up the tests?
+        if CONFIG.k8s_async_delete:
+            # Deletion is confirmed in the background, and waited for at the end of the session
+            reaper.submit('deletion of pod %s' % self.name, self._wait_until_teardown)
+            return
         self._wait_until_teardown()
 
     @property
@@ -98,6 +379,12 @@ class KubernetesServer(ServerClass):
             raise ServerFixtureNotRunningException()
         return self._get_pod_status().pod_ip
 
+    @property
+    def name(self):
+        if self._packed_pod is not None:
+            return self._packed_pod.name
+        return super(KubernetesServer, self).name
+
     @property
     def namespace(self):
         return fixture_namespace
@@ -106,16 +393,17 @@ class KubernetesServer(ServerClass):
     def labels(self):
         return self._labels
 
-    def _get_pod_spec(self):
-        container = k8sclient.V1Container(
-            name='fixture',
+    def _get_container(self, name='fixture'):
+        return k8sclient.V1Container(
+            name=name,
             image=self._image,
-            command=self._get_cmd(),
-            env=[k8sclient.V1EnvVar(name=k, value=v) for k, v in self._env.iteritems()],
+            command=[self._cmd] + [str(arg) for arg in self._get_args()],
+            env=[k8sclient.V1EnvVar(name=k, value=v) for k, v in self._env.items()],
         )
 
+    def _get_pod_spec(self):
         return k8sclient.V1PodSpec(
-            containers=[container]
+            containers=[self._get_container()]
         )
 
     def _create_pod(self):
@@ -145,14 +433,27 @@ class KubernetesServer(ServerClass):
             log.error("%s Failed to read pod status: %s", self._log_prefix, e.reason)
             raise
 
-    @retry(ServerFixtureNotRunningException, tries=28, delay=1, backoff=2, max_delay=10)
     def _wait_until_running(self):
         log.debug("%s Waiting for pod status to become running", self._log_prefix)
+        if self._watcher.wait_for(self.name, ('Running', 'Succeeded', 'Failed', DELETED)) == 'Running':
+            return
+        self._poll_until_running()
+
+    @retry(ServerFixtureNotRunningException, tries=28, delay=1, backoff=2, max_delay=10)
+    def _poll_until_running(self):
         if not self.is_running:
             raise ServerFixtureNotRunningException()
 
-    @retry(ServerFixtureNotTerminatedException, tries=28, delay=1, backoff=2, max_delay=10)
     def _wait_until_teardown(self):
+        try:
+            if self._watcher.wait_for(self.name, (DELETED,)):
+                return
+            self._poll_until_teardown()
+        finally:
+            self._watcher.forget(self.name)
+
+    @retry(ServerFixtureNotTerminatedException, tries=28, delay=1, backoff=2, max_delay=10)
+    def _poll_until_teardown(self):
         try:
             self._get_pod_status()
             # waiting for pod to be deleted (expect ApiException with status 404)
@@ -1,15 +1,16 @@
 """
 Thread server class implementation
 """
+import errno
 import logging
 import os
+import selectors
 import signal
 import subprocess
 import traceback
 import time
-import psutil
 
-from retry import retry
+import six
 
 from pytest_server_fixtures import CONFIG
 from pytest_server_fixtures.base import ProcessReader
@@ -18,41 +19,87 @@ from .common import ServerClass, is_debug
 log = logging.getLogger(__name__)
 
 
-# ThreadServer will attempt to kill all child processes recursively.
-KILL_RETRY_COUNT=15 # Total retry count to kill if not all child processes are terminated.
-KILL_RETRY_WAIT_SECS=1 # Wait time between two retries
-KILL_WAIT_SECS=5 # Time to wait for processes to terminate in a single retry.
+# ThreadServer runs each server in its own session, so the server and any processes
+# it forks share a process group that is signalled as a whole on teardown.
+KILL_GRACE_SECS = 3  # Time allowed to exit after SIGTERM, before SIGKILL is sent
+KILL_WAIT_SECS = 5  # Time to wait for the processes to go away after SIGKILL
+GROUP_POLL_SECS = 0.01  # Interval to check for remaining group members once the leader has exited
 
 
-class ProcessStillRunningException(Exception):
-    pass
+def _wait_for_exit(proc, timeout):
+    """ Wait for the process to exit, with a pidfd where available. Returns True if it has exited.
+    """
+    if proc.poll() is not None:
+        return True
+    pidfd_open = getattr(os, 'pidfd_open', None)
+    if pidfd_open is not None:
+        try:
+            fd = pidfd_open(proc.pid)
+        except OSError:
+            fd = None
+        if fd is not None:
+            try:
+                with selectors.DefaultSelector() as sel:
+                    sel.register(fd, selectors.EVENT_READ)
+                    sel.select(timeout)
+            finally:
+                os.close(fd)
+            return proc.poll() is not None
+    if six.PY2:
+        deadline = time.time() + timeout
+        while proc.poll() is None and time.time() < deadline:
+            time.sleep(GROUP_POLL_SECS)
+        return proc.poll() is not None
+    try:
+        proc.wait(timeout)
+        return True
+    except subprocess.TimeoutExpired:
+        return False
+
+
+def _group_alive(pgid):
+    try:
+        os.killpg(pgid, 0)
+        return True
+    except OSError as e:
+        if e.errno == errno.ESRCH:
+            return False
+        # EPERM: a member is still there, but belongs to someone else
+        return True
+
+
+def _wait_for_group(proc, timeout):
+    """ Wait for the process and the rest of its process group to exit. Returns True if they have.
+    """
+    deadline = time.time() + timeout
+    if not _wait_for_exit(proc, timeout):
+        return False
+    while _group_alive(proc.pid):
+        if time.time() >= deadline:
+            return False
+        time.sleep(GROUP_POLL_SECS)
+    return True
 
 
-@retry(ProcessStillRunningException,
-       tries=KILL_RETRY_COUNT,
-       delay=KILL_RETRY_WAIT_SECS)
-def _kill_all(procs, sig):
-    log.debug("Killing %d processes with signal %s" % (len(procs), sig))
-    for p in procs:
-        p.send_signal(sig)
+def _signal_group(pgid, sig):
+    try:
+        os.killpg(pgid, sig)
+    except OSError as e:
+        if e.errno != errno.ESRCH:
+            raise
 
-    log.debug("Waiting for %d processes to die" % len(procs))
-    gone, alive = psutil.wait_procs(procs, timeout=KILL_WAIT_SECS)
 
-    if len(alive) == 0:
-        log.debug("All processes are terminated")
+def _kill_process_group(proc, grace=KILL_GRACE_SECS):
+    """ SIGTERM the process group led by proc, then SIGKILL it if it has not exited within grace seconds.
+    """
+    log.debug("Terminating process group %d" % proc.pid)
+    _signal_group(proc.pid, signal.SIGTERM)
+    if _wait_for_group(proc, grace):
         return
-
-    log.warning("%d processes remainings: %s" % (len(alive), ",".join([p.name() for p in alive])))
-    raise ProcessStillRunningException()
-
-
-def _kill_proc_tree(pid, sig=signal.SIGKILL, timeout=None):
-    parent = psutil.Process(pid)
-    children = parent.children(recursive=True)
-    children.append(parent)
-    log.debug("Killing process tree for %d (total_procs_to_kill=%d)" % (parent.pid, len(children)))
-    _kill_all(children, sig)
+    log.warning("Process group %d still running %ss after SIGTERM, sending SIGKILL" % (proc.pid, grace))
+    _signal_group(proc.pid, signal.SIGKILL)
+    if not _wait_for_group(proc, KILL_WAIT_SECS):
+        log.warning("Process group %d still running after SIGKILL" % proc.pid)
 
 
 class ThreadServer(ServerClass):
@@ -78,10 +125,13 @@ class ThreadServer(ServerClass):
 
         run_cmd = [self._cmd] + self._get_args(workspace=self._workspace)
 
-        debug = is_debug()
-
-        extra_args = dict()
-        if debug:
+        # Its own session makes the server the leader of a new process group
+        if six.PY2:
+            extra_args = dict(preexec_fn=os.setsid)
+        else:
+            extra_args = dict(start_new_session=True)
+        capture = self.captures_output
+        if capture:
             extra_args['stdout'] = subprocess.PIPE
             extra_args['stderr'] = subprocess.PIPE
 
@@ -89,9 +139,9 @@ class ThreadServer(ServerClass):
         log.debug("Running server: %s" % ' '.join(run_cmd))
         log.debug("CWD: %s" % self._cwd)
 
-        if debug:
-            ProcessReader(self._proc, self._proc.stdout, False).start()
-            ProcessReader(self._proc, self._proc.stderr, True).start()
+        if capture:
+            ProcessReader(self._proc, self._proc.stdout, False, self.line_callbacks, self.output_buffer).start()
+            ProcessReader(self._proc, self._proc.stderr, True, self.line_callbacks, self.output_buffer).start()
 
         self.start()
 
@@ -112,6 +162,11 @@ class ThreadServer(ServerClass):
         # return False if there is a return code from the main process
         return self._proc.poll() is None
 
+    @property
+    def captures_output(self):
+        # Output is piped when debugging, or when something consumes it
+        return is_debug() or self.output_buffer is not None or bool(self.line_callbacks)
+
     @property
     def hostname(self):
         return self._hostname
@@ -121,6 +176,6 @@ class ThreadServer(ServerClass):
             log.warning("No process is running, skip teardown.")
             return
 
-        _kill_proc_tree(self._proc.pid)
+        _kill_process_group(self._proc)
         self._proc = None
 
@@ -0,0 +1,102 @@
+""" Snapshots of server data directories, used by TestServer.save() and restore().
+
+Files are copied with reflinks (copy-on-write clones, FICLONE) where the
+filesystem supports them (btrfs, xfs, overlayfs on either), so capturing and
+restoring take roughly constant time regardless of the amount of data.
+Elsewhere files are copied normally. Hardlinks are not used because servers
+like Postgres and MongoDB write to their data files in-place, which would
+modify the snapshot as well.
+"""
+import errno
+import fcntl
+import logging
+import os
+import shutil
+import tempfile
+
+from pytest_shutil.workspace import Workspace
+
+log = logging.getLogger(__name__)
+
+# From linux/fs.h
+FICLONE = 0x40049409
+
+# Devices that have been seen to not support reflinks
+_no_reflink_devices = set()
+
+
+def _reflink(src, dst):
+    with open(src, 'rb') as fsrc:
+        with open(dst, 'wb') as fdst:
+            fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+
+
+def copy_file(src, dst):
+    """ Copy a file with its metadata, as a reflink if possible.
+    """
+    dev = os.stat(os.path.dirname(os.path.abspath(dst))).st_dev
+    if dev not in _no_reflink_devices:
+        try:
+            _reflink(src, dst)
+            shutil.copystat(src, dst)
+            return dst
+        except (IOError, OSError) as e:
+            if e.errno not in (errno.EOPNOTSUPP, errno.ENOTTY, errno.EXDEV, errno.EINVAL, errno.ENOSYS):
+                raise
+            log.debug("Reflinks not supported for %s, falling back to copies" % dst)
+            _no_reflink_devices.add(dev)
+    return shutil.copy2(src, dst)
+
+
+def copy_tree(src, dst):
+    """ Copy a directory tree, using reflinks where possible.
+    """
+    shutil.copytree(str(src), str(dst), symlinks=True, copy_function=copy_file)
+
+
+class Snapshot(object):
+    """
+    Snapshot of some directories within a root directory.
+
+    Parameters
+    ----------
+    root: `str`
+        Directory the paths are relative to, eg. the server workspace
+    paths: `list`
+        Directories to capture, relative to root. Use '.' for the whole root.
+    """
+
+    def __init__(self, root, paths):
+        self.root = str(root)
+        self.paths = list(paths)
+        self.store = None
+
+    def capture(self):
+        """ Capture the current contents of the snapshot paths, replacing any previous capture.
+        """
+        self.discard()
+        self.store = tempfile.mkdtemp(prefix='snapshot.', dir=Workspace.get_base_tempdir())
+        for i, path in enumerate(self.paths):
+            src = os.path.normpath(os.path.join(self.root, path))
+            if os.path.isdir(src):
+                copy_tree(src, os.path.join(self.store, str(i)))
+        log.debug("Captured snapshot of %s %s in %s" % (self.root, self.paths, self.store))
+
+    def restore(self):
+        """ Put the snapshot paths back to their captured state.
+        """
+        if self.store is None:
+            raise ValueError("Nothing has been captured")
+        for i, path in enumerate(self.paths):
+            dst = os.path.normpath(os.path.join(self.root, path))
+            if os.path.isdir(dst):
+                shutil.rmtree(dst)
+            saved = os.path.join(self.store, str(i))
+            if os.path.isdir(saved):
+                copy_tree(saved, dst)
+        log.debug("Restored snapshot of %s %s" % (self.root, self.paths))
+
+    def discard(self):
+        if self.store is not None:
+            shutil.rmtree(self.store, ignore_errors=True)
+            self.store = None
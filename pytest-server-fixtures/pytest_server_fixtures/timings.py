@@ -0,0 +1,130 @@
+""" Timings of test server lifecycle phases.
+
+TestServer and TestServerV2 record how long each phase of their lifecycle takes
+(pre_setup, launch, wait_for_go, post_setup, kill, rmtree, ...), tagged with the
+server class, the scope of the fixture that created the server and the xdist
+worker. The session plugin prints a summary of them and can export them as a
+Chrome trace-event file, viewable in chrome://tracing or https://ui.perfetto.dev.
+"""
+import json
+import logging
+import os
+import threading
+import time
+from collections import namedtuple
+from contextlib import contextmanager
+
+log = logging.getLogger(__name__)
+
+_now = getattr(time, 'monotonic', time.time)
+
+PhaseRecord = namedtuple('PhaseRecord', 'server server_id phase scope worker start duration')
+
+_records = []
+_lock = threading.Lock()
+_local = threading.local()
+
+
+def get_worker():
+    """ Name of the xdist worker this process is, or 'master'
+    """
+    return os.environ.get('PYTEST_XDIST_WORKER', 'master')
+
+
+def current_scope():
+    """ Scope of the fixture currently being set up in this thread, or None
+    """
+    return getattr(_local, 'scope', None)
+
+
+@contextmanager
+def fixture_scope(scope):
+    """ Marks servers created in this block as belonging to a fixture with the given scope
+    """
+    previous = current_scope()
+    _local.scope = scope
+    try:
+        yield
+    finally:
+        _local.scope = previous
+
+
+@contextmanager
+def phase(server, name):
+    """ Records the time taken by the block as a lifecycle phase of server
+    """
+    start = _now()
+    try:
+        yield
+    finally:
+        record(server, name, start, _now() - start)
+
+
+def record(server, name, start, duration):
+    rec = PhaseRecord(server.__class__.__name__, id(server), name,
+                      getattr(server, '_fixture_scope', None), get_worker(), start, duration)
+    with _lock:
+        _records.append(rec)
+    return rec
+
+
+def get_records():
+    with _lock:
+        return list(_records)
+
+
+def add_records(records):
+    """ Adds records from another process, eg. as dicts from an xdist worker
+    """
+    with _lock:
+        _records.extend(r if isinstance(r, PhaseRecord) else PhaseRecord(**r) for r in records)
+
+
+def clear():
+    with _lock:
+        del _records[:]
+
+
+def summarize(records=None):
+    """
+    Totals the phase durations per server class, scope and phase.
+
+    Returns
+    -------
+    list of (server, scope, phase, count, total, max) tuples, longest total first
+    """
+    totals = {}
+    for rec in get_records() if records is None else records:
+        key = (rec.server, rec.scope or '-', rec.phase)
+        count, total, longest = totals.get(key, (0, 0.0, 0.0))
+        totals[key] = (count + 1, total + rec.duration, max(longest, rec.duration))
+    rows = [key + value for key, value in totals.items()]
+    return sorted(rows, key=lambda row: row[4], reverse=True)
+
+
+def to_chrome_trace(records=None):
+    """ Returns the records as a Chrome trace-event document, one process per xdist worker
+        and one thread per server.
+    """
+    records = get_records() if records is None else records
+    workers = sorted(set(rec.worker for rec in records))
+    events = []
+    threads = set()
+    for rec in records:
+        pid = workers.index(rec.worker)
+        if (pid, rec.server_id) not in threads:
+            threads.add((pid, rec.server_id))
+            events.append({'name': 'thread_name', 'ph': 'M', 'pid': pid, 'tid': rec.server_id,
+                           'args': {'name': '%s (%s)' % (rec.server, rec.scope or '-')}})
+        events.append({'name': rec.phase, 'cat': rec.server, 'ph': 'X', 'pid': pid, 'tid': rec.server_id,
+                       'ts': int(rec.start * 1e6), 'dur': int(rec.duration * 1e6),
+                       'args': {'scope': rec.scope, 'worker': rec.worker}})
+    for pid, worker in enumerate(workers):
+        events.append({'name': 'process_name', 'ph': 'M', 'pid': pid, 'args': {'name': worker}})
+    return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+
+def write_chrome_trace(path, records=None):
+    with open(path, 'w') as f:
+        json.dump(to_chrome_trace(records), f)
+    log.debug("Wrote server fixture timings to %s" % path)
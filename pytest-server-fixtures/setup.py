@@ -25,6 +25,7 @@ install_requires = ['pytest',
                     'requests',
                     'retry',
                     'psutil',
+                    'futures; python_version<"3"',
                     ]
 
 extras_require = {
@@ -53,6 +54,7 @@ entry_points = {
         'rethinkdb_server = pytest_server_fixtures.rethink',
         'xvfb_server = pytest_server_fixtures.xvfb',
         's3 = pytest_server_fixtures.s3',
+        'server_fixtures = pytest_server_fixtures.plugin',
     ]
 }
 
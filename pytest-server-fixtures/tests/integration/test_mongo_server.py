@@ -14,3 +14,11 @@ def test_mongo_server_multi(count, mongo_server):
     assert coll.count() == 0
     coll.insert({'a': 'b'})
     assert coll.count() == 1
+
+
+@pytest.mark.parametrize('count', range(3))
+def test_mongo_unique_db(count, mongo_unique_db):
+    coll = mongo_unique_db.some_collection
+    assert coll.count() == 0
+    coll.insert({'a': 'b'})
+    assert coll.count() == 1
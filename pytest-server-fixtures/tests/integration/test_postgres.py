@@ -9,3 +9,15 @@ def test_postgres_server(postgres_server_sess):
     assert cursor.fetchone() == (1, 100, "abc'def")
 
 
+@pytest.fixture(scope='session')
+def postgres_template_seed():
+    return "CREATE TABLE test (id serial PRIMARY KEY, num integer);" \
+           "INSERT INTO test (num) VALUES (100);"
+
+
+@pytest.mark.parametrize('num', [1, 2])
+def test_postgres_db_is_cloned_per_test(postgres_db, num):
+    cursor = postgres_db.cursor()
+    cursor.execute("INSERT INTO test (num) VALUES (%s)", (num,))
+    cursor.execute("SELECT num FROM test ORDER BY id;")
+    assert cursor.fetchall() == [(100,), (num,)]
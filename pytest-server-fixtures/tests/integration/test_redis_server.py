@@ -1,6 +1,28 @@
+import pytest
+
+
 def test_server_runner(redis_server):
     """ Boot up a server, push some keys into it
     """
     assert redis_server.check_server_up()
     redis_server.api.set('foo', 'bar')
     assert redis_server.api.get('foo').decode('utf8') == 'bar'
+
+
+@pytest.mark.parametrize('value', ['a', 'b'])
+def test_redis_db_is_isolated(redis_db, value):
+    assert redis_db.get('foo') is None
+    redis_db.set('foo', value)
+    assert redis_db.connection_pool.connection_kwargs['db'] != 0
+
+
+def test_redis_cluster_spreads_keys(redis_cluster):
+    for i in range(100):
+        redis_cluster.api.set('key:%d' % i, i)
+    assert all(node.api.dbsize() > 0 for node in redis_cluster.masters)
+
+
+def test_redis_replicated(redis_replicated):
+    redis_replicated.api.set('foo', 'bar')
+    redis_replicated.wait_for_replication()
+    assert all(node.api.get('foo') == b'bar' for node in redis_replicated.replicas)
@@ -1,10 +1,18 @@
+import os
+import threading
+
+import docker
+from six.moves import queue
+
 try:
     from unittest.mock import sentinel, patch, Mock
 except ImportError:
     # python 2
     from mock import sentinel, patch, Mock
 
-from pytest_server_fixtures.serverclass.docker import DockerServer
+from pytest_server_fixtures.serverclass.docker import (DockerServer, EventWatcher, REUSE_KEY_LABEL,
+                                                       reuse_key, reap_idle_containers, _lock_container,
+                                                       _unlock_container, pull_images)
 
 @patch('pytest_server_fixtures.serverclass.docker.ServerClass.__init__')
 def test_init(mock_init):
@@ -17,3 +25,125 @@ def test_init(mock_init):
     mock_init.assert_called_with(sentinel.cmd,
                                  sentinel.get_args,
                                  sentinel.env)
+
+
+def test_reuse_key():
+    key = reuse_key('redis:5', 'redis-server', ['--port', 6379], {'A': '1', 'B': '2'})
+    assert key == reuse_key('redis:5', 'redis-server', ['--port', '6379'], {'B': '2', 'A': '1'})
+    assert key != reuse_key('redis:6', 'redis-server', ['--port', 6379], {'A': '1', 'B': '2'})
+    assert key != reuse_key('redis:5', 'redis-server', ['--port', 6380], {'A': '1', 'B': '2'})
+    assert key != reuse_key('redis:5', 'redis-server', ['--port', 6379], {'A': '1'})
+
+
+def _reusable_server(client):
+    with patch('pytest_server_fixtures.serverclass.docker.docker.from_env', return_value=client):
+        return DockerServer('RedisTestServer', 'redis-server', lambda: ['--port', 6379], {}, 'redis:5',
+                            reuse=True)
+
+
+@patch('pytest_server_fixtures.serverclass.docker._reaped', True)
+def test_reuse_attaches_to_idle_container(tmpdir):
+    busy, idle = Mock(), Mock()
+    busy.name, idle.name = 'busy', 'idle'
+    client = Mock()
+    client.containers.list.return_value = [busy, idle]
+    with patch('pytest_server_fixtures.serverclass.docker.LOCK_DIR', str(tmpdir)):
+        busy_lock = _lock_container('busy')
+        try:
+            server = _reusable_server(client)
+            server.launch()
+            assert server.reused
+            assert server._container is idle
+            assert not client.containers.run.called
+            # Another process can't lease it until it is released
+            assert _lock_container('idle') is None
+            server.teardown()
+            assert not idle.stop.called
+            _lock_container('idle').close()
+        finally:
+            busy_lock.close()
+
+
+@patch('pytest_server_fixtures.serverclass.docker._reaped', True)
+def test_reuse_starts_labelled_container(tmpdir):
+    client = Mock()
+    client.containers.list.return_value = []
+    client.containers.run.return_value.status = 'running'
+    with patch('pytest_server_fixtures.serverclass.docker.LOCK_DIR', str(tmpdir)):
+        server = _reusable_server(client)
+        server.launch()
+        server.teardown()
+    assert not server.reused
+    labels = client.containers.run.call_args[1]['labels']
+    assert labels[REUSE_KEY_LABEL] == reuse_key('redis:5', 'redis-server', ['--port', 6379], {})
+    assert 'server-fixtures/session-id' not in labels
+    assert not client.containers.run.return_value.stop.called
+
+
+def test_reap_idle_containers(tmpdir):
+    old, recent = Mock(), Mock()
+    old.name, recent.name = 'old', 'recent'
+    client = Mock()
+    client.containers.list.return_value = [old, recent]
+    with patch('pytest_server_fixtures.serverclass.docker.LOCK_DIR', str(tmpdir)):
+        _unlock_container(_lock_container('old'))
+        _unlock_container(_lock_container('recent'))
+        os.utime(str(tmpdir / 'old.lock'), (0, 0))
+        reap_idle_containers(client, 60)
+    assert old.stop.called
+    assert not recent.stop.called
+
+
+def _event_stream():
+    events = queue.Queue()
+
+    def stream():
+        while True:
+            event = events.get()
+            if isinstance(event, Exception):
+                raise event
+            yield event
+
+    client = Mock()
+    client.events.return_value = stream()
+    return client, events
+
+
+def test_event_watcher_wakes_waiters():
+    client, events = _event_stream()
+    watcher = EventWatcher(client).start()
+    events.put({'Action': 'create', 'Actor': {'ID': 'abc'}})
+    threading.Timer(0.05, events.put, args=({'Action': 'start', 'Actor': {'ID': 'abc'}},)).start()
+    assert watcher.wait_for('abc', ('start', 'die'), timeout=5)
+    # Events seen before waiting count too
+    assert watcher.wait_for('abc', ('create',), timeout=0)
+    assert not watcher.wait_for('abc', ('destroy',), timeout=0.01)
+    assert not watcher.wait_for('other', ('start',), timeout=0.01)
+    watcher.forget('abc')
+    assert not watcher.wait_for('abc', ('start',), timeout=0)
+
+
+def test_event_watcher_stream_failure_releases_waiters():
+    client, events = _event_stream()
+    watcher = EventWatcher(client).start()
+    threading.Timer(0.05, events.put, args=(ValueError('connection lost'),)).start()
+    assert not watcher.wait_for('abc', ('start',), timeout=5)
+    assert watcher.failed
+
+
+def test_pull_images_skips_local_images():
+    client = Mock()
+
+    def get(image):
+        if image != 'redis:5':
+            raise docker.errors.ImageNotFound(image)
+    client.images.get.side_effect = get
+
+    def pull(repo, tag):
+        if repo != 'mongo':
+            raise ValueError('no such image')
+    client.images.pull.side_effect = pull
+    with patch('pytest_server_fixtures.serverclass.docker.docker.from_env', return_value=client):
+        pull_images(['redis:5', 'mongo:3.6', 'myregistry:5000/rethinkdb'])
+    assert sorted(c[0] for c in client.images.pull.call_args_list) == [(u'mongo',), (u'myregistry:5000/rethinkdb',)]
+    assert sorted(c[1]['tag'] for c in client.images.pull.call_args_list) == ['3.6', 'latest']
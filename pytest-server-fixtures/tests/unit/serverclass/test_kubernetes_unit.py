@@ -1,3 +1,5 @@
+import threading
+
 import pytest
 
 try:
@@ -6,7 +8,12 @@ except ImportError:
     # python 2
     from mock import sentinel, patch, Mock
 
-from pytest_server_fixtures.serverclass.kubernetes import KubernetesServer
+from kubernetes.client import V1Container
+from kubernetes.client.rest import ApiException
+
+from pytest_server_fixtures.serverclass.common import ServerFixtureNotRunningException
+from pytest_server_fixtures.serverclass.kubernetes import (DELETED, KubernetesServer, PackedPod, PodWatcher,
+                                                           _pull_status, prepull_images)
 
 @pytest.mark.skip(reason="Need a way to run this test in Kubernetes")
 @patch('pytest_server_fixtures.serverclass.docker.ServerClass.__init__')
@@ -20,3 +27,150 @@ def test_init(mock_init):
     mock_init.assert_called_with(sentinel.cmd,
                                  sentinel.get_args,
                                  sentinel.env)
+
+
+def _event(event_type, name, phase, resource_version='1'):
+    pod = Mock()
+    pod.metadata.name = name
+    pod.metadata.resource_version = resource_version
+    pod.status.phase = phase
+    return {'type': event_type, 'object': pod}
+
+
+def _watch(*streams):
+    """ Patch watch.Watch so each new watch replays the next list of events, then blocks forever """
+    streams = list(streams)
+    blocked = threading.Event()
+
+    def stream(*args, **kwargs):
+        for event in streams.pop(0) if streams else []:
+            if isinstance(event, Exception):
+                raise event
+            yield event
+        blocked.wait()
+
+    return patch('pytest_server_fixtures.serverclass.kubernetes.watch.Watch',
+                 return_value=Mock(stream=Mock(side_effect=stream)))
+
+
+def test_pod_watcher_tracks_phases():
+    with _watch([_event('ADDED', 'a', 'Pending'), _event('MODIFIED', 'a', 'Running'),
+                 _event('DELETED', 'b', 'Running')]):
+        watcher = PodWatcher(Mock(), 'ns', 'server-fixtures/session-id=x').start()
+        assert watcher.wait_for('a', ('Running', 'Failed'), timeout=5) == 'Running'
+        assert watcher.wait_for('b', (DELETED,), timeout=5) == DELETED
+        assert watcher.wait_for('a', (DELETED,), timeout=0.01) is None
+        watcher.forget('a')
+        assert watcher.wait_for('a', ('Running',), timeout=0) is None
+
+
+def test_pod_watcher_restarts_after_gone():
+    with _watch([ApiException(status=410)], [_event('ADDED', 'a', 'Running')]):
+        watcher = PodWatcher(Mock(), 'ns', 'server-fixtures/session-id=x').start()
+        assert watcher.wait_for('a', ('Running',), timeout=5) == 'Running'
+        assert not watcher.failed
+
+
+def test_pod_watcher_failure_releases_waiters():
+    with _watch([ApiException(status=500)]):
+        watcher = PodWatcher(Mock(), 'ns', 'server-fixtures/session-id=x').start()
+        assert watcher.wait_for('a', ('Running',), timeout=5) is None
+        assert watcher.failed
+
+
+def _packable(port):
+    server = Mock()
+    server.port = port
+    server._get_container.side_effect = lambda name: V1Container(name=name, image='img')
+    return server
+
+
+def test_packed_pod_created_once_by_last_server():
+    pod = PackedPod(3, timeout=5)
+    servers = [_packable(port) for port in (6379, 27017, 28015)]
+    threads = [threading.Thread(target=pod.join, args=(server,)) for server in servers]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join(5)
+    assert pod.created
+    api = [s._v1api for s in servers if s._v1api.create_namespaced_pod.called]
+    assert len(api) == 1
+    body = api[0].create_namespaced_pod.call_args[1]['body']
+    assert body.metadata.name == pod.name
+    assert len(body.spec.containers) == 3
+    assert sorted(s._get_container.call_args[0][0] for s in servers) == ['fixture-0', 'fixture-1', 'fixture-2']
+    assert [pod.leave(), pod.leave(), pod.leave()] == [False, False, True]
+
+
+def test_packed_pod_abort_releases_waiters():
+    pod = PackedPod(2, timeout=5)
+    threading.Timer(0.05, pod.abort, args=(ValueError('boom'),)).start()
+    with pytest.raises(ValueError):
+        pod.join(_packable(6379))
+    assert not pod.created
+
+
+def test_packed_pod_times_out():
+    pod = PackedPod(2, timeout=0.01)
+    with pytest.raises(ServerFixtureNotRunningException):
+        pod.join(_packable(6379))
+
+
+def test_prepull_images_gives_up_if_daemonset_not_created():
+    with patch('pytest_server_fixtures.serverclass.kubernetes.fixture_namespace', 'ns'), \
+            patch('pytest_server_fixtures.serverclass.kubernetes.k8sclient.AppsV1Api') as apps_api:
+        api = apps_api.return_value
+        api.create_namespaced_daemon_set.side_effect = ApiException(status=409, reason='Conflict')
+        prepull_images(['redis:x'])
+    assert not api.read_namespaced_daemon_set_status.called
+    assert not api.delete_namespaced_daemon_set.called
+
+
+def _prepull_pod(*reasons):
+    """ A pre-pull pod with a container per waiting reason, None for a running container """
+    pod = Mock()
+    pod.spec.node_name = 'node'
+    pod.status.container_statuses = []
+    for i, reason in enumerate(reasons):
+        status = Mock(image='image-%d' % i)
+        status.state.waiting = None if reason is None else Mock(reason=reason, message=None)
+        pod.status.container_statuses.append(status)
+    return pod
+
+
+def test_pull_status_counts_containers_past_the_pull():
+    pods = [_prepull_pod(None, 'RunContainerError', 'CrashLoopBackOff'), _prepull_pod('ContainerCreating')]
+    assert _pull_status(pods) == (3, [])
+    assert _pull_status([_prepull_pod(None, 'ImagePullBackOff')]) == (1, ['image-1 on node: ImagePullBackOff'])
+
+
+def test_prepull_images_waits_for_pulls_on_every_node():
+    with patch('pytest_server_fixtures.serverclass.kubernetes.fixture_namespace', 'ns'), \
+            patch('pytest_server_fixtures.serverclass.kubernetes.time.sleep'), \
+            patch('pytest_server_fixtures.serverclass.kubernetes.k8sclient.CoreV1Api') as core_api, \
+            patch('pytest_server_fixtures.serverclass.kubernetes.k8sclient.AppsV1Api') as apps_api:
+        api = apps_api.return_value
+        api.read_namespaced_daemon_set_status.return_value.status.desired_number_scheduled = 2
+        core_api.return_value.list_namespaced_pod.side_effect = [
+            Mock(items=[_prepull_pod('ContainerCreating', None)]),
+            Mock(items=[_prepull_pod(None, 'RunContainerError'), _prepull_pod(None, None)]),
+        ]
+        prepull_images(['redis:x', 'distroless:x'])
+    body = api.create_namespaced_daemon_set.call_args[1]['body']
+    assert [c.image for c in body.spec.template.spec.containers] == ['redis:x', 'distroless:x']
+    assert core_api.return_value.list_namespaced_pod.call_count == 2
+    assert api.delete_namespaced_daemon_set.called
+
+
+def test_prepull_images_stops_on_pull_errors():
+    with patch('pytest_server_fixtures.serverclass.kubernetes.fixture_namespace', 'ns'), \
+            patch('pytest_server_fixtures.serverclass.kubernetes.time.sleep') as sleep, \
+            patch('pytest_server_fixtures.serverclass.kubernetes.k8sclient.CoreV1Api') as core_api, \
+            patch('pytest_server_fixtures.serverclass.kubernetes.k8sclient.AppsV1Api') as apps_api:
+        api = apps_api.return_value
+        api.read_namespaced_daemon_set_status.return_value.status.desired_number_scheduled = 1
+        core_api.return_value.list_namespaced_pod.return_value = Mock(items=[_prepull_pod('ErrImagePull')])
+        prepull_images(['redis:missing'])
+    assert not sleep.called
+    assert api.delete_namespaced_daemon_set.called
@@ -1,3 +1,11 @@
+import os
+import signal
+import subprocess
+import sys
+import time
+
+import pytest
+
 try:
     from unittest.mock import sentinel, patch, Mock
 except ImportError:
@@ -5,7 +13,7 @@ except ImportError:
     from mock import sentinel, patch, Mock
 
 from pytest_server_fixtures import CONFIG
-from pytest_server_fixtures.serverclass.thread import ThreadServer
+from pytest_server_fixtures.serverclass.thread import ThreadServer, _group_alive, _kill_process_group
 
 
 @patch('pytest_server_fixtures.serverclass.thread.ServerClass.__init__')
@@ -23,3 +31,64 @@ def test_init(mock_init):
     assert ts._hostname == sentinel.listen_hostname
     assert ts._workspace == sentinel.workspace
     assert ts._cwd == sentinel.cwd
+
+
+def test_captures_output_only_when_consumed(monkeypatch):
+    monkeypatch.delenv('DEBUG', raising=False)
+    ts = ThreadServer(sentinel.cmd, sentinel.get_args, {}, sentinel.workspace)
+    assert not ts.captures_output
+    ts.line_callbacks.append(Mock())
+    assert ts.captures_output
+    ts.line_callbacks = []
+    ts.output_buffer = Mock()
+    assert ts.captures_output
+
+
+@pytest.mark.parametrize('buffered', [False, True])
+def test_launch_pipes_output_only_when_captured(monkeypatch, buffered):
+    monkeypatch.delenv('DEBUG', raising=False)
+    ts = ThreadServer(sys.executable, lambda **kwargs: ['-c', 'print("hello")'], {}, sentinel.workspace)
+    if buffered:
+        ts.output_buffer = Mock()
+    with patch('pytest_server_fixtures.serverclass.thread.subprocess.Popen') as popen, \
+            patch('pytest_server_fixtures.serverclass.thread.ProcessReader') as reader, \
+            patch.object(ThreadServer, 'start'):
+        ts.launch()
+    assert ('stdout' in popen.call_args[1]) == buffered
+    assert reader.called == buffered
+
+
+def _start_group(script):
+    return subprocess.Popen([sys.executable, '-c', script], start_new_session=True,
+                            stdout=subprocess.PIPE)
+
+
+FORKING_SERVER = """
+import subprocess, sys, time
+child = subprocess.Popen([sys.executable, '-c', 'import time; time.sleep(60)'])
+print(child.pid)
+sys.stdout.flush()
+time.sleep(60)
+"""
+
+
+def test_kill_process_group_kills_forked_children():
+    proc = _start_group(FORKING_SERVER)
+    child = int(proc.stdout.readline())
+    start = time.time()
+    _kill_process_group(proc)
+    assert time.time() - start < 2
+    assert proc.poll() == -signal.SIGTERM
+    assert not _group_alive(proc.pid)
+    with pytest.raises(OSError):
+        os.kill(child, 0)
+
+
+def test_kill_process_group_escalates_to_sigkill():
+    proc = _start_group("import signal, sys, time\n"
+                        "signal.signal(signal.SIGTERM, signal.SIG_IGN)\n"
+                        "print('ready'); sys.stdout.flush()\n"
+                        "time.sleep(60)")
+    proc.stdout.readline()
+    _kill_process_group(proc, grace=0.1)
+    assert proc.poll() == -signal.SIGKILL
@@ -0,0 +1,79 @@
+import pytest
+
+try:
+    from unittest.mock import Mock, call, patch
+except ImportError:
+    # python 2
+    from mock import Mock, call, patch
+
+from pytest_server_fixtures import group
+from pytest_server_fixtures.group import ServerGroup, start_all
+
+
+def test_start_all_starts_every_server():
+    servers = [Mock(), Mock(), Mock()]
+    server_group = start_all(*servers)
+    assert server_group.servers == servers
+    for server in servers:
+        assert server.start.call_args_list == [call()]
+        assert not server.teardown.called
+
+
+def test_start_all_rolls_back_on_failure():
+    good, bad = Mock(), Mock()
+    bad.start.side_effect = ValueError('boom')
+    with pytest.raises(ValueError):
+        ServerGroup([good, bad]).start_all()
+    assert good.teardown.call_args_list == [call()]
+    assert bad.teardown.call_args_list == [call()]
+
+
+def test_context_manager_tears_down():
+    server = Mock()
+    with ServerGroup([server]) as server_group:
+        server_group.start_all()
+    assert server.teardown.call_args_list == [call()]
+
+
+def test_prestart_session_servers():
+    factory = Mock()
+    with patch.dict(group.SESSION_SERVERS, {'foo_sess': (factory, ['server_class']),
+                                            'bar_sess': (Mock(), [])}):
+        server_group = group.prestart_session_servers(['foo_sess', 'other'])
+        try:
+            assert server_group.servers == [factory.return_value]
+            assert group.get_prestarted('foo_sess') is factory.return_value
+            assert group.get_prestarted('bar_sess') is None
+        finally:
+            group.clear_prestarted()
+    assert factory.return_value.start.call_args_list == [call()]
+
+
+def test_pack_assigns_servers_with_distinct_ports():
+    servers = [Mock(port=6379), Mock(port=27017), Mock(port=6379)]
+    with patch('pytest_server_fixtures.group.CONFIG.server_class', 'kubernetes'), \
+            patch('pytest_server_fixtures.serverclass.kubernetes.PackedPod') as PackedPod:
+        ServerGroup(servers, max_workers=1, pack=True).start_all()
+    PackedPod.assert_called_once_with(2)
+    assert servers[0].packed_pod is PackedPod.return_value
+    assert servers[1].packed_pod is PackedPod.return_value
+    assert servers[2].packed_pod is not PackedPod.return_value
+
+
+def test_pack_aborts_pod_when_a_server_fails():
+    good, bad = Mock(port=6379), Mock(port=27017)
+    bad.start.side_effect = ValueError('boom')
+    with patch('pytest_server_fixtures.group.CONFIG.server_class', 'kubernetes'), \
+            patch('pytest_server_fixtures.serverclass.kubernetes.PackedPod') as PackedPod:
+        with pytest.raises(ValueError):
+            ServerGroup([good, bad], pack=True).start_all()
+    assert PackedPod.return_value.abort.call_count == 1
+
+
+def test_pack_only_on_kubernetes():
+    servers = [Mock(port=6379), Mock(port=27017)]
+    with patch('pytest_server_fixtures.group.CONFIG.server_class', 'docker'), \
+            patch('pytest_server_fixtures.serverclass.kubernetes.PackedPod') as PackedPod:
+        ServerGroup(servers, pack=True).start_all()
+    assert not PackedPod.called
+    assert all(server.start.called for server in servers)
@@ -0,0 +1,43 @@
+try:
+    from unittest.mock import patch
+except ImportError:
+    # python 2
+    from mock import patch
+
+from pytest_server_fixtures import images, timings
+import pytest_server_fixtures.redis  # noqa: F401 registers the redis fixtures
+import pytest_server_fixtures.mongo  # noqa: F401 registers the mongo fixtures
+
+
+def test_images_for_used_fixtures():
+    with patch.multiple('pytest_server_fixtures.CONFIG', redis_image='redis:x', mongo_image='mongo:y'):
+        assert images.images_for(['redis_server', 'redis_server_sess', 'tmpdir']) == ['redis:x']
+        assert images.images_for(['redis_server', 'mongo_server_cls']) == ['mongo:y', 'redis:x']
+        assert images.images_for(['tmpdir']) == []
+
+
+def test_prepull_does_nothing_for_thread_servers():
+    with patch('pytest_server_fixtures.CONFIG.server_class', 'thread'):
+        assert images.prepull(['redis_server']) == []
+
+
+def test_prepull_docker_images():
+    timings.clear()
+    with patch.multiple('pytest_server_fixtures.CONFIG', server_class='docker', redis_image='redis:x'), \
+            patch('pytest_server_fixtures.serverclass.docker.pull_images') as pull_images:
+        assert images.prepull(['redis_server'], max_workers=2) == ['redis:x']
+    pull_images.assert_called_once_with(['redis:x'], max_workers=2)
+    assert [(r.server, r.phase, r.scope) for r in timings.get_records()] == [('ImagePrePull', 'prepull', 'session')]
+    timings.clear()
+
+
+def test_prepull_kubernetes_images_once_per_session(monkeypatch):
+    with patch.multiple('pytest_server_fixtures.CONFIG', server_class='kubernetes', redis_image='redis:x'), \
+            patch('pytest_server_fixtures.serverclass.kubernetes.prepull_images') as prepull_images:
+        monkeypatch.setenv('PYTEST_XDIST_WORKER', 'gw1')
+        assert images.prepull(['redis_server']) == []
+        assert not prepull_images.called
+        monkeypatch.setenv('PYTEST_XDIST_WORKER', 'gw0')
+        assert images.prepull(['redis_server']) == ['redis:x']
+    prepull_images.assert_called_once_with(['redis:x'])
+    timings.clear()
@@ -0,0 +1,161 @@
+import os
+import threading
+import time
+
+import pytest
+
+try:
+    from unittest.mock import Mock, patch
+except ImportError:
+    from mock import Mock, patch
+
+from pytest_server_fixtures import mongo
+from pytest_server_fixtures.mongo import MongoTestServer, choose_storage, get_mongod_version
+
+
+def test_drop_database_later_batches_drops():
+    server = MongoTestServer()
+    server.api = Mock()
+    first_drop = threading.Event()
+    release = threading.Event()
+
+    def drop_database(name):
+        if name == 'a':
+            first_drop.set()
+            release.wait(5)
+
+    server.api.drop_database.side_effect = drop_database
+    server.drop_database_later('a')
+    assert first_drop.wait(5)
+    # Queued while 'a' is being dropped, so dropped together afterwards
+    server.drop_database_later('b')
+    server.drop_database_later('c')
+    assert server._pending_drops == ['b', 'c']
+    release.set()
+    server.drain_drops()
+    assert [c[0][0] for c in server.api.drop_database.call_args_list] == ['a', 'b', 'c']
+    assert server._drops_thread is None
+
+
+def test_drop_failures_do_not_stop_the_thread():
+    server = MongoTestServer()
+    server.api = Mock()
+    server.api.drop_database.side_effect = [RuntimeError('boom'), None]
+    server.drop_database_later('a')
+    server.drop_database_later('b')
+    server.drain_drops()
+    assert server.api.drop_database.call_count == 2
+
+
+def test_drops_after_draining_run_inline():
+    server = MongoTestServer()
+    server.api = Mock()
+    server.drop_database_later('a')
+    server.drain_drops()
+    server.drop_database_later('b')
+    assert server._drops_thread is None
+    assert server._drops_stopping
+    assert [c[0][0] for c in server.api.drop_database.call_args_list] == ['a', 'b']
+    server.drain_drops()
+
+
+def test_drop_queued_while_draining_does_not_hang_the_drain():
+    server = MongoTestServer()
+    server.api = Mock()
+    dropping = threading.Event()
+    release = threading.Event()
+
+    def drop_database(name):
+        if name == 'a':
+            dropping.set()
+            release.wait(5)
+
+    server.api.drop_database.side_effect = drop_database
+    server.drop_database_later('a')
+    assert dropping.wait(5)
+    drain = threading.Thread(target=server.drain_drops)
+    drain.start()
+    while not server._drops_stopping:
+        time.sleep(0.001)
+    server.drop_database_later('b')
+    release.set()
+    drain.join(5)
+    assert not drain.is_alive()
+    assert sorted(c[0][0] for c in server.api.drop_database.call_args_list) == ['a', 'b']
+
+
+def test_teardown_drains_drops():
+    server = MongoTestServer()
+    api = server.api = Mock()
+    server.drop_database_later('a')
+    server.teardown()
+    api.drop_database.assert_called_once_with('a')
+    api.close.assert_called_once_with()
+
+
+def test_get_mongod_version():
+    out = b'db version v4.4.6\nBuild Info: {\n    "modules": [\n        "enterprise"\n    ]\n}\n'
+    with patch.dict(mongo._mongod_version_cache, clear=True), \
+            patch('pytest_server_fixtures.mongo.subprocess.check_output', return_value=out) as check_output:
+        assert get_mongod_version('mongod') == ((4, 4), True)
+        assert get_mongod_version('mongod') == ((4, 4), True)
+    assert check_output.call_count == 1
+
+
+def test_choose_storage(tmpdir):
+    assert choose_storage((7, 0), True, str(tmpdir)) == 'inMemory'
+    assert choose_storage((6, 0), False, str(tmpdir)) == 'ephemeralForTest'
+    assert choose_storage((7, 0), False, str(tmpdir)) == 'tmpfs'
+    assert choose_storage(None, False, str(tmpdir / 'missing')) == 'disk'
+
+
+@pytest.mark.parametrize('storage, cache_size_gb, expected, unexpected', [
+    ('disk', 0, ['--nojournal'], ['--storageEngine', '--wiredTigerCacheSizeGB']),
+    ('disk', 0.5, ['--nojournal', '--wiredTigerCacheSizeGB=0.5'], ['--storageEngine']),
+    ('inMemory', 1, ['--storageEngine=inMemory', '--inMemorySizeGB=1'], ['--nojournal']),
+    ('ephemeralForTest', 1, ['--storageEngine=ephemeralForTest'], ['--wiredTigerCacheSizeGB']),
+])
+def test_get_args_storage(storage, cache_size_gb, expected, unexpected):
+    server = MongoTestServer(storage=storage, cache_size_gb=cache_size_gb, server_class='thread')
+    with patch('pytest_server_fixtures.mongo.get_mongod_version', return_value=((4, 4), False)):
+        args = server.get_args(workspace=server.workspace)
+    assert '--dbpath=%s' % server.workspace in args
+    for arg in expected:
+        assert arg in args
+    for arg in unexpected:
+        assert not any(a.startswith(arg) for a in args)
+
+
+def test_tmpfs_storage(tmpdir):
+    server = MongoTestServer(storage='tmpfs', server_class='thread')
+    with patch('pytest_server_fixtures.mongo.TMPFS_DIR', str(tmpdir)):
+        server.pre_setup()
+    dbpath = server._dbpath
+    assert os.path.dirname(dbpath) == str(tmpdir)
+    assert '--dbpath=%s' % dbpath in server.get_args(workspace=server.workspace)
+    server.teardown()
+    assert not os.path.exists(dbpath)
+
+
+def test_storage_without_thread_server_class():
+    assert MongoTestServer(storage='tmpfs', server_class='docker').storage_mode == 'disk'
+    assert MongoTestServer(storage='auto', server_class='docker').storage_mode == 'disk'
+
+
+def test_unknown_storage_is_rejected_before_the_workspace_exists():
+    with patch('pytest_server_fixtures.base2.TestServerV2.__init__') as init:
+        with pytest.raises(ValueError):
+            MongoTestServer(storage='floppy')
+    assert not init.called
+
+
+def test_get_args_without_nojournal_for_mongo_7(tmpdir):
+    server = MongoTestServer(storage='auto', server_class='thread')
+    with patch('pytest_server_fixtures.mongo.get_mongod_version', return_value=((7, 0), False)), \
+            patch('pytest_server_fixtures.mongo.TMPFS_DIR', str(tmpdir)):
+        assert server.storage_mode == 'tmpfs'
+        server.pre_setup()
+        args = server.get_args(workspace=server.workspace)
+    assert '--nojournal' not in args
+    assert '--dbpath=%s' % server._dbpath in args
+    server.teardown()
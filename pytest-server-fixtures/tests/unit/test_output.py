@@ -0,0 +1,85 @@
+import subprocess
+import sys
+import threading
+import time
+
+from pytest_server_fixtures.base import ProcessReader
+from pytest_server_fixtures.output import OutputMultiplexer, RingBuffer
+
+
+class Sink(object):
+    def __init__(self, expected):
+        self.lines = []
+        self.expected = expected
+        self.done = threading.Event()
+
+    def __call__(self, line):
+        self.lines.append(line)
+        if len(self.lines) == self.expected:
+            self.done.set()
+
+
+def _popen(script):
+    return subprocess.Popen([sys.executable, '-c', script], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+
+
+def test_multiplexer_splits_lines_and_flushes_partial_line():
+    p = _popen("import sys, time\n"
+               "sys.stdout.write('one\\ntw'); sys.stdout.flush(); time.sleep(0.05)\n"
+               "sys.stdout.write('o\\nthree')")
+    sink = Sink(3)
+    OutputMultiplexer().add(p.stdout, sink)
+    p.wait()
+    assert sink.done.wait(5)
+    assert sink.lines == [b'one\n', b'two\n', b'three']
+
+
+def test_multiplexer_reads_many_streams_on_one_thread():
+    mux = OutputMultiplexer()
+    procs = [_popen("import sys; print('out %d'); sys.stderr.write('err %d\\n')" % (i, i)) for i in range(5)]
+    sinks = []
+    for p in procs:
+        for stream in (p.stdout, p.stderr):
+            sinks.append(Sink(1))
+            mux.add(stream, sinks[-1])
+    for p in procs:
+        p.wait()
+    for sink in sinks:
+        assert sink.done.wait(5)
+    assert sorted(sink.lines[0] for sink in sinks) == sorted(
+        [('out %d\n' % i).encode() for i in range(5)] + [('err %d\n' % i).encode() for i in range(5)])
+    # Streams are closed when the multiplexer thread reads their EOF, after the last line
+    deadline = time.time() + 5
+    while not all(p.stdout.closed and p.stderr.closed for p in procs) and time.time() < deadline:
+        time.sleep(0.01)
+    assert all(p.stdout.closed and p.stderr.closed for p in procs)
+
+
+def test_process_reader_calls_callbacks_with_text():
+    p = _popen("print('hello'); print(''); print('world')")
+    sink = Sink(2)
+    ProcessReader(p, p.stdout, False, [sink]).start()
+    p.wait()
+    assert sink.done.wait(5)
+    assert sink.lines == ['hello\n', 'world\n']
+
+
+def test_ring_buffer_keeps_latest_bytes():
+    buf = RingBuffer(8)
+    buf.write(b'abc')
+    assert buf.getvalue() == b'abc'
+    buf.write(b'defghij')
+    assert buf.position == 10
+    assert buf.getvalue() == b'cdefghij'
+    assert buf.since(7) == b'hij'
+    assert buf.since(0) == b'cdefghij'
+    assert buf.since(10) == b''
+
+
+def test_ring_buffer_write_larger_than_size():
+    buf = RingBuffer(4)
+    buf.write(b'x')
+    buf.write(b'0123456789')
+    assert buf.position == 11
+    assert buf.getvalue() == b'6789'
+    assert len(buf._data) == 4
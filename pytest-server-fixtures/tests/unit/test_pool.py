@@ -0,0 +1,53 @@
+try:
+    from unittest.mock import Mock, call
+except ImportError:
+    # python 2
+    from mock import Mock, call
+
+from pytest_server_fixtures.pool import ServerPool
+
+
+def test_fill_starts_idle_servers():
+    factory = Mock(side_effect=lambda: Mock())
+    pool = ServerPool(factory, size=2)
+    pool.fill()
+    assert factory.call_count == 2
+    assert all(s.start.call_args_list == [call()] for s in pool._idle)
+
+
+def test_server_is_reset_and_reused():
+    factory = Mock(side_effect=lambda: Mock())
+    pool = ServerPool(factory, size=1)
+    server = pool.acquire()
+    pool.release(server)
+    assert server.reset.call_args_list == [call()]
+    assert not server.teardown.called
+    assert pool.acquire() is server
+    assert factory.call_count == 1
+
+
+def test_server_is_discarded_after_max_reuse():
+    pool = ServerPool(Mock(side_effect=lambda: Mock()), size=1, max_reuse=2)
+    server = pool.acquire()
+    pool.release(server)
+    assert pool.acquire() is server
+    pool.release(server)
+    assert server.teardown.call_args_list == [call()]
+    assert pool.acquire() is not server
+
+
+def test_server_is_discarded_when_reset_fails():
+    pool = ServerPool(Mock(side_effect=lambda: Mock()), size=1)
+    server = pool.acquire()
+    server.reset.side_effect = ValueError('connection refused')
+    pool.release(server)
+    assert server.teardown.call_args_list == [call()]
+    assert not pool._idle
+
+
+def test_close_tears_down_idle_servers():
+    pool = ServerPool(Mock(side_effect=lambda: Mock()), size=2)
+    pool.fill()
+    idle = list(pool._idle)
+    pool.close()
+    assert all(s.teardown.call_args_list == [call()] for s in idle)
@@ -0,0 +1,129 @@
+import os
+import fcntl
+import socket
+
+try:
+    from unittest.mock import patch
+except ImportError:
+    # python 2
+    from mock import patch
+
+from pytest_server_fixtures import ports
+from pytest_server_fixtures.base import get_ephemeral_port
+
+
+def _locked_elsewhere(port):
+    """ POSIX record locks don't conflict within a process, so check from a child """
+    pid = os.fork()
+    if pid == 0:
+        fd = os.open(ports.LEASE_FILE, os.O_RDWR)
+        try:
+            fcntl.lockf(fd, fcntl.LOCK_EX | fcntl.LOCK_NB, 1, port, os.SEEK_SET)
+        except (IOError, OSError):
+            os._exit(1)
+        os._exit(0)
+    return os.waitpid(pid, 0)[1] != 0
+
+
+def test_lease_is_held_until_released():
+    lease = ports.lease_port('127.0.0.1')
+    try:
+        assert _locked_elsewhere(lease.port)
+    finally:
+        lease.release()
+    assert not _locked_elsewhere(lease.port)
+
+
+def test_leased_port_is_not_handed_out_twice():
+    port = ports.find_free_port('127.0.0.1')
+    with patch('pytest_server_fixtures.ports.random.randrange', side_effect=[port, port, port + 1]):
+        lease = ports.lease_port('127.0.0.1')
+        try:
+            other = ports.lease_port('127.0.0.1')
+            assert (lease.port, other.port) == (port, port + 1)
+            other.release()
+        finally:
+            lease.release()
+
+
+def test_lease_keep_socket():
+    lease = ports.lease_port('127.0.0.1', keep_socket=True)
+    try:
+        assert lease.socket.getsockname() == ('127.0.0.1', lease.port)
+    finally:
+        lease.release()
+    assert lease.socket is None
+
+
+def test_explicit_port_leased_by_this_process_is_returned():
+    lease = ports.lease_port('127.0.0.1')
+    try:
+        assert ports.lease_port('127.0.0.1', lease.port) is lease
+    finally:
+        lease.release()
+
+
+def test_get_ephemeral_port_leases():
+    port = get_ephemeral_port(host='127.0.0.1', lease=True)
+    try:
+        assert port in ports._leases
+    finally:
+        ports.release_port(port)
+    assert port not in ports._leases
+
+
+def test_get_ephemeral_port_does_not_lease_by_default():
+    port = get_ephemeral_port(host='127.0.0.1')
+    assert port not in ports._leases
+    assert not _locked_elsewhere(port)
+
+
+def test_get_ephemeral_port_keeps_explicit_port():
+    port = get_ephemeral_port(host='127.0.0.1')
+    assert get_ephemeral_port(port, host='127.0.0.1') == port
+    assert get_ephemeral_port(port, host='127.0.0.1') == port
+
+
+def test_find_free_port_skips_leased_ports():
+    lease = ports.lease_port('127.0.0.1')
+    try:
+        with patch('pytest_server_fixtures.ports.random.randrange', side_effect=[lease.port, lease.port + 1]):
+            assert ports.find_free_port('127.0.0.1') == lease.port + 1
+    finally:
+        lease.release()
+
+
+def test_no_leases_without_lease_file(monkeypatch, tmpdir):
+    monkeypatch.setattr(ports, 'LEASE_FILE', str(tmpdir.join('missing', 'ports.lock')))
+    monkeypatch.setattr(ports, '_lease_fd', None)
+    assert ports.find_free_port('127.0.0.1')
+    lease = ports.lease_port('127.0.0.1')
+    lease.release()
+    assert ports._lease_fd == -1
+
+
+def test_find_listening_pids():
+    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    s.bind(('127.0.0.1', 0))
+    s.listen(1)
+    try:
+        assert ports.find_listening_pids('127.0.0.1', s.getsockname()[1]) == {os.getpid()}
+    finally:
+        s.close()
+
+
+def test_find_listening_pids_with_unreadable_owner():
+    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    s.bind(('127.0.0.1', 0))
+    s.listen(1)
+    try:
+        with patch('pytest_server_fixtures.ports.os.readlink', side_effect=OSError):
+            assert ports.find_listening_pids('127.0.0.1', s.getsockname()[1]) is None
+    finally:
+        s.close()
+
+
+def test_decode_address():
+    assert ports._decode_address('0100007F:1F90') == ('127.0.0.1', 8080)
+    assert ports._decode_address('0000000000000000FFFF00000100007F:1F90') == ('127.0.0.1', 8080)
+    assert ports._decode_address('00000000000000000000000001000000:0016') == ('::1', 22)
@@ -0,0 +1,50 @@
+import os
+
+try:
+    from unittest.mock import Mock
+except ImportError:
+    from mock import Mock
+
+from pytest_server_fixtures.postgres import cluster_cache_key, get_cached_cluster
+
+
+def _initdb(path):
+    with open(os.path.join(path, 'PG_VERSION'), 'w') as f:
+        f.write('11\n')
+
+
+def test_cluster_cache_key_depends_on_version_user_locale_and_args(monkeypatch):
+    monkeypatch.setenv('LANG', 'C')
+    key = cluster_cache_key('PostgreSQL 11.1')
+    assert key == cluster_cache_key('PostgreSQL 11.1', ())
+    assert key != cluster_cache_key('PostgreSQL 11.2')
+    assert key != cluster_cache_key('PostgreSQL 11.1', ['--data-checksums'])
+    monkeypatch.setenv('LANG', 'en_US.UTF-8')
+    assert key != cluster_cache_key('PostgreSQL 11.1')
+    monkeypatch.setenv('LANG', 'C')
+    monkeypatch.setattr('getpass.getuser', lambda: 'someone-else')
+    assert key != cluster_cache_key('PostgreSQL 11.1')
+
+
+def test_get_cached_cluster_runs_initdb_once(tmpdir):
+    initdb = Mock(side_effect=_initdb)
+    cache = str(tmpdir / 'cache')
+    cluster = get_cached_cluster(cache, 'abc', initdb)
+    assert cluster == os.path.join(cache, 'abc')
+    assert os.path.isfile(os.path.join(cluster, 'PG_VERSION'))
+    assert get_cached_cluster(cache, 'abc', initdb) == cluster
+    assert initdb.call_count == 1
+    assert os.listdir(cache) == ['abc']
+
+
+def test_get_cached_cluster_loses_race(tmpdir):
+    cache = str(tmpdir)
+
+    def initdb(path):
+        # Another process finishes first
+        os.mkdir(os.path.join(cache, 'abc'))
+        _initdb(os.path.join(cache, 'abc'))
+        _initdb(path)
+
+    assert get_cached_cluster(cache, 'abc', initdb) == os.path.join(cache, 'abc')
+    assert os.listdir(cache) == ['abc']
@@ -0,0 +1,52 @@
+import os
+import socket
+import threading
+
+from pytest_server_fixtures.readiness import TCPProbe, LogLineProbe, FileProbe
+
+
+def test_tcp_probe_fires_when_listening():
+    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    s.bind(('127.0.0.1', 0))
+    s.listen(1)
+    try:
+        assert TCPProbe('127.0.0.1', s.getsockname()[1]).wait(1)
+    finally:
+        s.close()
+
+
+def test_tcp_probe_times_out_when_nothing_listening():
+    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    s.bind(('127.0.0.1', 0))
+    port = s.getsockname()[1]
+    s.close()
+    assert not TCPProbe('127.0.0.1', port).wait(0.05)
+
+
+def test_log_line_probe():
+    probe = LogLineProbe(r'Ready to accept connections')
+    probe.attach()
+    probe.feed(b'* Server initialized\n')
+    assert not probe.wait(0.01)
+    probe.feed(b'* Ready to accept connections\n')
+    assert probe.wait(0.01)
+
+
+def test_log_line_probe_not_attached_does_not_block():
+    probe = LogLineProbe('foo')
+    assert not probe.wait(10)
+
+
+def test_file_probe(tmpdir):
+    path = tmpdir / 'server.pid'
+    timer = threading.Timer(0.05, path.write, args=('1234',))
+    timer.start()
+    try:
+        assert FileProbe(path).wait(5)
+    finally:
+        timer.cancel()
+    assert FileProbe(str(path)).wait(0)
+
+
+def test_file_probe_times_out(tmpdir):
+    assert not FileProbe(os.path.join(str(tmpdir), 'missing')).wait(0.05)
@@ -0,0 +1,56 @@
+import os
+import threading
+
+try:
+    from unittest.mock import patch
+except ImportError:
+    # python 2
+    from mock import patch
+
+from pytest_server_fixtures import reaper
+from pytest_server_fixtures.base import TestServer
+
+
+def test_trash_renames_to_unique_path(tmpdir):
+    path = tmpdir.mkdir('workspace')
+    trashed = reaper.trash(path)
+    assert not path.exists()
+    assert os.path.isdir(trashed)
+    assert os.path.basename(trashed).startswith('workspace.trash-')
+
+
+def test_trash_missing_path(tmpdir):
+    path = str(tmpdir / 'missing')
+    assert reaper.trash(path) == path
+
+
+def test_drain_waits_and_reports_failures():
+    done = threading.Event()
+
+    def boom():
+        raise ValueError('boom')
+
+    reaper.submit('teardown of A', done.set)
+    reaper.submit('teardown of B', boom)
+    failures = reaper.drain()
+    assert done.is_set()
+    assert [(d, str(e)) for d, e in failures] == [('teardown of B', 'boom')]
+    assert reaper.drain() == []
+
+
+class Server(TestServer):
+    def __init__(self):
+        super(Server, self).__init__(hostname='localhost', port=1234)
+
+
+def test_background_teardown_trashes_workspace_and_tears_down_once():
+    server = Server()
+    workspace = server.workspace
+    with patch('pytest_server_fixtures.base.CONFIG.background_teardown', True), \
+            patch.object(Server, 'kill') as kill:
+        server.teardown()
+        server.teardown()
+        assert not workspace.exists()
+        assert reaper.drain() == []
+    assert kill.call_count == 1
+    assert not server.workspace.exists()
@@ -0,0 +1,309 @@
+import os
+
+import pytest
+
+try:
+    from unittest.mock import Mock, call, patch
+except ImportError:
+    from mock import Mock, call, patch
+
+import redis
+
+from pytest_server_fixtures.readiness import LogLineProbe
+from pytest_server_fixtures.redis import (CLUSTER_SLOTS, LEASE_KEY, RELEASE_SCRIPT, RedisCluster, RedisReplicaSet,
+                                         RedisTestServer, dataset_key, encode_command, get_cached_rdb,
+                                         iter_commands, slot_ranges, stats_since, stats_snapshot, wait_for_all)
+
+
+def _server(databases=4):
+    server = RedisTestServer(databases=databases)
+    server._lease_api = Mock()
+    return server
+
+
+def test_get_args_sets_databases():
+    args = RedisTestServer(databases=8).get_args()
+    assert args[args.index('--databases') + 1] == '8'
+
+
+def test_readiness_probe_waits_for_ready_log_line():
+    probe = RedisTestServer(server_class='thread').readiness_probe()
+    assert isinstance(probe, LogLineProbe)
+    probe.attach()
+    probe.feed(b'1:M 01 Jan 2020 00:00:00.000 * DB loaded from disk: 0.001 seconds')
+    assert not probe.wait(0)
+    probe.feed(b'1:M 01 Jan 2020 00:00:00.000 * Ready to accept connections')
+    assert probe.wait(0)
+    assert not isinstance(RedisTestServer(server_class='docker').readiness_probe(), LogLineProbe)
+
+
+def test_get_args_disables_save_points():
+    args = RedisTestServer().get_args()
+    assert args[args.index('--save') + 1] == ''
+
+
+def test_lease_db_skips_leased_databases():
+    server = _server()
+    server._lease_api.set.side_effect = lambda key, *args, **kwargs: key == LEASE_KEY % 2
+    db = server.lease_db()
+    assert db == 2
+    keys = set(c[0][0] for c in server._lease_api.set.call_args_list)
+    assert LEASE_KEY % 0 not in keys
+    assert server._leases[2] == server._lease_api.set.call_args[0][1]
+
+
+def test_lease_db_times_out():
+    server = _server()
+    server._lease_api.set.return_value = False
+    with pytest.raises(RuntimeError):
+        server.lease_db(timeout=0)
+    assert server._lease_api.set.call_count == 3
+
+
+def test_lease_db_needs_spare_databases():
+    with pytest.raises(ValueError):
+        _server(databases=1).lease_db()
+
+
+def test_release_db_flushes_and_deletes_our_lease():
+    server = _server()
+    server._leases[3] = 'token'
+    client = Mock()
+    with patch.object(RedisTestServer, 'client', return_value=client) as get_client:
+        server.release_db(3)
+    get_client.assert_called_once_with(3)
+    client.flushdb.assert_called_once_with(asynchronous=True)
+    server._lease_api.eval.assert_called_once_with(RELEASE_SCRIPT, 1, LEASE_KEY % 3, 'token')
+    assert server._leases == {}
+
+
+def test_encode_command():
+    assert encode_command(('SET', u'k\xe9', 10)) == b'*3\r\n$3\r\nSET\r\n$3\r\nk\xc3\xa9\r\n$2\r\n10\r\n'
+
+
+def test_iter_commands():
+    assert list(iter_commands({'a': 1})) == [('SET', 'a', 1)]
+    commands = (('HSET', 'h', str(i), i) for i in range(2))
+    assert list(iter_commands(commands)) == [('HSET', 'h', '0', 0), ('HSET', 'h', '1', 1)]
+
+
+def test_load_pipeline_in_chunks():
+    server = RedisTestServer()
+    server._server = Mock(hostname='host')
+    server._api = Mock()
+    pipe = server._api.pipeline.return_value
+    pipe.execute.side_effect = [[True, ValueError()], [True]]
+    stats = server.load((('SET', 'k%d' % i, i) for i in range(3)), chunk_size=2)
+    assert (stats.commands, stats.errors) == (3, 1)
+    assert server._api.pipeline.call_count == 2
+    server._api.pipeline.assert_called_with(transaction=False)
+    assert pipe.execute_command.call_count == 3
+
+
+def test_load_pipe_through_redis_cli():
+    server = RedisTestServer()
+    server._server = Mock(hostname='host')
+    with patch('pytest_server_fixtures.redis.subprocess.Popen') as popen:
+        proc = popen.return_value
+        proc.communicate.return_value = (b'All data transferred.\nerrors: 0, replies: 2\n', None)
+        proc.returncode = 0
+        stats = server.load({'a': 1, 'b': 2}, db=3, method='pipe')
+    assert (stats.commands, stats.errors) == (2, 0)
+    assert popen.call_args[0][0][-3:] == ['-n', '3', '--pipe']
+    proc.stdin.write.assert_called_once_with(encode_command(('SET', 'a', 1)) + encode_command(('SET', 'b', 2)))
+
+
+def test_dataset_key():
+    key = dataset_key({'a': 1, 'b': 2}, '7.0')
+    assert key == dataset_key({'b': 2, 'a': 1}, '7.0')
+    assert key == dataset_key([('SET', 'a', 1), ('SET', 'b', 2)], '7.0')
+    assert key != dataset_key({'a': 1, 'b': 3}, '7.0')
+    assert key != dataset_key({'a': 1, 'b': 2}, '7.2')
+    assert key != dataset_key({'a': 1, 'b': 2}, '7.0', db=1)
+    assert key != dataset_key({'a': 1, 'b': 2}, '7.0', databases=4)
+
+
+def test_get_cached_rdb_builds_once(tmpdir):
+    def build(path):
+        with open(path, 'wb') as f:
+            f.write(b'REDIS0009')
+
+    build = Mock(side_effect=build)
+    cache = str(tmpdir / 'cache')
+    rdb = get_cached_rdb(cache, 'abc', build)
+    assert rdb == os.path.join(cache, 'abc.rdb')
+    assert get_cached_rdb(cache, 'abc', build) == rdb
+    assert build.call_count == 1
+    assert os.listdir(cache) == ['abc.rdb']
+    assert os.stat(rdb).st_mode & 0o777 == 0o644
+
+
+def test_get_cached_rdb_failed_build_leaves_nothing(tmpdir):
+    with pytest.raises(RuntimeError):
+        get_cached_rdb(str(tmpdir), 'abc', Mock(side_effect=RuntimeError))
+    assert os.listdir(str(tmpdir)) == []
+
+
+def test_get_args_puts_rdb_in_workspace():
+    server = RedisTestServer(server_class='thread')
+    args = server.get_args()
+    assert args[args.index('--dir') + 1] == str(server.workspace)
+    assert args[args.index('--dbfilename') + 1] == 'dump.rdb'
+    assert '--dir' not in RedisTestServer(server_class='docker').get_args()
+
+
+def test_post_setup_loads_dataset_without_rdb():
+    server = RedisTestServer(dataset={'a': 1})
+    with patch.object(RedisTestServer, 'load') as load:
+        server.post_setup()
+        load.assert_called_once_with({'a': 1})
+        load.reset_mock()
+        server._rdb_loaded = True
+        server.post_setup()
+        assert not load.called
+
+
+def test_slot_ranges_cover_all_slots():
+    ranges = slot_ranges(3)
+    assert ranges[0][0] == 0
+    assert ranges[-1][1] == CLUSTER_SLOTS - 1
+    assert all(prev[1] + 1 == cur[0] for prev, cur in zip(ranges, ranges[1:]))
+
+
+def test_wait_for_all_times_out_with_pending_nodes():
+    nodes = [Mock(hostname='a', port=1), Mock(hostname='b', port=2)]
+    with pytest.raises(RuntimeError) as err:
+        wait_for_all(nodes, lambda node: node.port == 1, 'something', timeout=0)
+    assert 'b:2' in str(err.value)
+    assert 'a:1' not in str(err.value)
+
+
+def _mock_nodes(nodes, execute_command):
+    for i, node in enumerate(nodes):
+        node._server = Mock(hostname='host%d' % i)
+        node._api = Mock()
+        node._api.execute_command.side_effect = lambda *args, i=i: execute_command(i, *args)
+
+
+def test_cluster_start():
+    cluster = RedisCluster(masters=2, replicas_per_master=1, server_class='docker')
+
+    def execute_command(i, *args):
+        if args[1] == 'INFO':
+            return b'cluster_state:ok\r\ncluster_known_nodes:4\r\n'
+        if args[1] == 'MYID':
+            return b'id%d' % i
+        if args[1] == 'ADDSLOTSRANGE':
+            raise redis.ResponseError('unknown subcommand')
+
+    _mock_nodes(cluster.nodes, execute_command)
+    with patch('pytest_server_fixtures.redis.ServerGroup') as group:
+        cluster.start()
+    group.return_value.start_all.assert_called_once_with()
+    first, second, replica, _ = [node._api.execute_command.call_args_list for node in cluster.nodes]
+    assert call('CLUSTER', 'SET-CONFIG-EPOCH', 1) in first
+    assert call('CLUSTER', 'SET-CONFIG-EPOCH', 3) in replica
+    assert call('CLUSTER', 'ADDSLOTS', *range(CLUSTER_SLOTS // 2)) in first
+    assert call('CLUSTER', 'ADDSLOTS', *range(CLUSTER_SLOTS // 2, CLUSTER_SLOTS)) in second
+    assert call('CLUSTER', 'MEET', 'host0', cluster.masters[0].port) in second
+    assert call('CLUSTER', 'REPLICATE', b'id0') in replica
+    assert call('CLUSTER', 'REPLICATE', b'id1') in cluster.replicas[1]._api.execute_command.call_args_list
+
+
+def test_cluster_start_failure_tears_down():
+    cluster = RedisCluster(masters=2, server_class='docker')
+    _mock_nodes(cluster.nodes, Mock(side_effect=redis.ConnectionError))
+    with patch('pytest_server_fixtures.redis.ServerGroup') as group:
+        with pytest.raises(redis.ConnectionError):
+            cluster.start()
+    group.return_value.teardown.assert_called_once_with()
+
+
+def test_replica_set_start():
+    replicated = RedisReplicaSet(replicas=2, server_class='docker')
+
+    def execute_command(i, *args):
+        if args[0] == 'REPLICAOF':
+            raise redis.ResponseError('unknown command')
+
+    _mock_nodes(replicated.nodes, execute_command)
+    for node in replicated.replicas:
+        node._api.info.return_value = {'master_link_status': 'up', 'master_sync_in_progress': 0}
+    with patch('pytest_server_fixtures.redis.ServerGroup'):
+        replicated.start()
+    for node in replicated.replicas:
+        node._api.execute_command.assert_called_with('SLAVEOF', 'host0', replicated.primary.port)
+    assert replicated.api is replicated.primary.api
+
+
+def _stats_server(commandstats, slowlog, latency=()):
+    server = Mock(hostname='host', port=1234)
+    server.api.info.return_value = commandstats
+    server.api.slowlog_get.side_effect = lambda n: slowlog[:n]
+    server.api.execute_command.return_value = list(latency)
+    return server
+
+
+def test_stats_snapshot_ignores_own_commands():
+    server = _stats_server({'cmdstat_get': {'calls': 3, 'usec': 10},
+                            'cmdstat_info': {'calls': 9, 'usec': 90},
+                            'cmdstat_slowlog|get': {'calls': 9, 'usec': 90}},
+                           [{'id': 7, 'duration': 5, 'command': b'GET a'}])
+    snapshot = stats_snapshot(server)
+    assert snapshot['commands'] == {'get': (3, 10)}
+    assert snapshot['slowlog_id'] == 7
+
+
+def test_stats_since():
+    before = {'commands': {'get': (3, 10)}, 'slowlog_id': 7, 'time': 100}
+    slowlog = [{'id': 10, 'duration': 4, 'command': b'SLOWLOG GET 1'},
+               {'id': 9, 'duration': 50, 'command': b'KEYS *'},
+               {'id': 8, 'duration': 20, 'command': b'GET a'},
+               {'id': 7, 'duration': 90, 'command': b'GET b'}]
+    server = _stats_server({'cmdstat_get': {'calls': 5, 'usec': 30},
+                            'cmdstat_keys': {'calls': 1, 'usec': 50}},
+                           slowlog, [[b'command', 101, 2, 5], [b'fork', 99, 1, 1]])
+    stats = stats_since(server, before)
+    assert stats['commands'] == {'get': {'calls': 2, 'usec': 20}, 'keys': {'calls': 1, 'usec': 50}}
+    assert (stats['calls'], stats['usec']) == (3, 70)
+    assert stats['slowest'] == [{'command': 'KEYS *', 'usec': 50}, {'command': 'GET a', 'usec': 20}]
+    assert stats['latency'] == [{'event': 'command', 'latest_ms': 2, 'max_ms': 5}]
+
+
+def test_get_args_enables_slowlog_with_stats():
+    assert '--latency-monitor-threshold' not in RedisTestServer().get_args()
+    with patch('pytest_server_fixtures.redis._stats_enabled', True):
+        args = RedisTestServer().get_args()
+    assert args[args.index('--slowlog-log-slower-than') + 1] == '0'
+    assert '--latency-monitor-threshold' in args
+
+
+def test_pre_setup_skips_rdb_without_thread_server_class():
+    server = RedisTestServer(server_class='docker', dataset={'a': 1})
+    with patch('pytest_server_fixtures.redis.get_redis_version') as get_version, \
+            patch('pytest_server_fixtures.redis.get_cached_rdb') as get_cached:
+        server.pre_setup()
+    assert not get_version.called
+    assert not get_cached.called
+    assert not server._rdb_loaded
+    assert '--dir' not in server.get_args()
+    with patch.object(RedisTestServer, 'load') as load:
+        server.post_setup()
+    load.assert_called_once_with({'a': 1})
+
+
+def test_plugin_counts_only_the_test_call():
+    from pytest_server_fixtures import plugin
+
+    server = _stats_server({'cmdstat_get': {'calls': 3, 'usec': 10}}, [])
+    item = Mock(nodeid='test_x')
+    with patch('pytest_server_fixtures.redis._stats_enabled', True), \
+            patch('pytest_server_fixtures.redis.instrumented_servers', return_value=[server]), \
+            patch.object(plugin, '_redis_stats', []) as records:
+        hook = plugin.pytest_runtest_call(item)
+        next(hook)
+        # The test itself runs here
+        server.api.info.return_value = {'cmdstat_get': {'calls': 5, 'usec': 30}}
+        with pytest.raises(StopIteration):
+            next(hook)
+    assert [(r['nodeid'], r['calls'], r['usec']) for r in records] == [('test_x', 2, 20)]
@@ -25,13 +25,32 @@ def test_init():
 def test_kill():
     self = create_autospec(_TestServer, dead=False,
                            hostname=sentinel.hostname,
-                           port=sentinel.port)
-    self.run.side_effect = ['100\n', '', '']
+                           port=sentinel.port,
+                           kill_retry_delay=sentinel.delay)
+    self._find_pids.side_effect = [['100'], []]
     with patch('os.kill') as kill:
-        with patch('socket.gethostbyname', return_value=sentinel.ip):
-            _TestServer._find_and_kill(self, 2, sentinel.signal)
+        with patch('psutil.Process') as process:
+            with patch('psutil.wait_procs') as wait_procs:
+                _TestServer._find_and_kill(self, 2, sentinel.signal)
+    assert self._find_pids.call_args_list == [call(), call()]
+    assert kill.call_args_list == [call(100, sentinel.signal)]
+    assert wait_procs.call_args_list == [call([process.return_value], timeout=sentinel.delay)]
+
+
+def test_find_pids():
+    self = create_autospec(_TestServer, hostname=sentinel.hostname, port=sentinel.port)
+    with patch('socket.gethostbyname', return_value=sentinel.ip):
+        with patch('pytest_server_fixtures.base.find_listening_pids', return_value={100}) as find:
+            assert _TestServer._find_pids(self) == [100]
+    assert find.call_args_list == [call(sentinel.ip, sentinel.port)]
+    assert not self.run.called
+
+
+def test_find_pids_falls_back_to_netstat():
+    self = create_autospec(_TestServer, hostname=sentinel.hostname, port=sentinel.port)
+    self.run.return_value = '100\n'
+    with patch('socket.gethostbyname', return_value=sentinel.ip):
+        with patch('pytest_server_fixtures.base.find_listening_pids', return_value=None):
+            assert _TestServer._find_pids(self) == ['100']
     assert self.run.call_args_list == [call("netstat -anp 2>/dev/null | grep sentinel.ip:sentinel.port "
-                                            "| grep LISTEN | awk '{ print $7 }' | cut -d'/' -f1", capture=True, cd='/'),
-                                       call("netstat -anp 2>/dev/null | grep sentinel.ip:sentinel.port "
                                             "| grep LISTEN | awk '{ print $7 }' | cut -d'/' -f1", capture=True, cd='/')]
-    assert kill.call_args_list == [call(100, sentinel.signal)]
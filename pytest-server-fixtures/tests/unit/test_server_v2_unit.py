@@ -3,7 +3,9 @@ try:
 except ImportError:
     # python 2
     from mock import create_autospec, sentinel, call, patch, Mock
+import sys
 
+from pytest_server_fixtures.readiness import LogLineProbe
 from pytest_server_fixtures.base2 import TestServerV2 as _TestServerV2 # TODO: why as _TestServerV2?
 
 def test_init():
@@ -19,3 +21,44 @@ def test_init():
 def test_hostname_when_server_is_not_started():
     ts = _TestServerV2()
     assert ts.hostname == None
+
+
+class _LogReadyServer(_TestServerV2):
+    readiness_timeout = 10
+
+    @property
+    def cmd(self):
+        return 'python'
+
+    @property
+    def cmd_local(self):
+        return sys.executable
+
+    @property
+    def image(self):
+        return 'python'
+
+    @property
+    def port(self):
+        return 0
+
+    def get_args(self, workspace=None):
+        return ['-c', 'import sys, time; sys.stderr.write("Ready to accept connections\\n"); sys.stderr.flush(); time.sleep(60)']
+
+    def readiness_probe(self):
+        self.probe = LogLineProbe('Ready to accept connections')
+        return self.probe
+
+    def check_server_up(self):
+        return self.probe.wait(0)
+
+
+def test_log_line_probe_sees_thread_server_output(monkeypatch):
+    monkeypatch.delenv('DEBUG', raising=False)
+    ts = _LogReadyServer(server_class='thread')
+    try:
+        ts.start()
+        assert ts.probe.attached
+        assert ts.probe.wait(0)
+    finally:
+        ts.teardown()
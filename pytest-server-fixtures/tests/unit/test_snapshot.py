@@ -0,0 +1,60 @@
+import os
+
+try:
+    from unittest.mock import patch
+except ImportError:
+    # python 2
+    from mock import patch
+
+from pytest_server_fixtures import snapshot
+from pytest_server_fixtures.snapshot import Snapshot
+
+
+def test_capture_and_restore(tmpdir):
+    data = tmpdir.mkdir('db')
+    data.join('table').write('seeded')
+    data.mkdir('sub').join('index').write('seeded')
+    tmpdir.join('server.log').write('log')
+
+    snap = Snapshot(str(tmpdir), ['db'])
+    snap.capture()
+    try:
+        data.join('table').write('modified')
+        data.join('new').write('new')
+        data.join('sub').remove()
+        tmpdir.join('server.log').write('more log')
+
+        snap.restore()
+        assert data.join('table').read() == 'seeded'
+        assert data.join('sub', 'index').read() == 'seeded'
+        assert not data.join('new').check()
+        # Only the snapshot dirs are rolled back
+        assert tmpdir.join('server.log').read() == 'more log'
+    finally:
+        snap.discard()
+    assert snap.store is None
+
+
+def test_snapshot_whole_root(tmpdir):
+    root = tmpdir.mkdir('root')
+    root.join('a').write('a')
+    snap = Snapshot(str(root), ['.'])
+    snap.capture()
+    try:
+        root.join('a').remove()
+        snap.restore()
+        assert root.join('a').read() == 'a'
+    finally:
+        snap.discard()
+
+
+def test_copy_file_falls_back_without_reflinks(tmpdir):
+    src = tmpdir.join('src')
+    src.write('data')
+    os.chmod(str(src), 0o600)
+    dst = tmpdir.join('dst')
+    with patch('pytest_server_fixtures.snapshot._reflink', side_effect=OSError(95, 'Operation not supported')):
+        with patch.object(snapshot, '_no_reflink_devices', set()):
+            snapshot.copy_file(str(src), str(dst))
+    assert dst.read() == 'data'
+    assert os.stat(str(dst)).st_mode & 0o777 == 0o600
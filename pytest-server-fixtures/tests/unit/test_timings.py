@@ -0,0 +1,69 @@
+import json
+
+import pytest
+
+from pytest_server_fixtures import timings
+
+
+class Server(object):
+    def __init__(self):
+        self._fixture_scope = timings.current_scope()
+
+
+@pytest.yield_fixture(autouse=True)
+def clear_records():
+    timings.clear()
+    yield
+    timings.clear()
+
+
+def test_phase_records_server_scope_and_duration():
+    with timings.fixture_scope('session'):
+        server = Server()
+    assert timings.current_scope() is None
+    with timings.phase(server, 'launch'):
+        pass
+    [rec] = timings.get_records()
+    assert rec.server == 'Server'
+    assert rec.server_id == id(server)
+    assert rec.phase == 'launch'
+    assert rec.scope == 'session'
+    assert rec.worker == 'master'
+    assert rec.duration >= 0
+
+
+def test_phase_records_failures():
+    with pytest.raises(ValueError):
+        with timings.phase(Server(), 'pre_setup'):
+            raise ValueError()
+    assert [rec.phase for rec in timings.get_records()] == ['pre_setup']
+
+
+def test_worker_from_xdist(monkeypatch):
+    monkeypatch.setenv('PYTEST_XDIST_WORKER', 'gw3')
+    assert timings.record(Server(), 'kill', 0, 1).worker == 'gw3'
+
+
+def test_summarize():
+    server = Server()
+    timings.record(server, 'launch', 0, 1.0)
+    timings.record(server, 'launch', 0, 3.0)
+    timings.record(server, 'kill', 0, 0.5)
+    assert timings.summarize() == [('Server', '-', 'launch', 2, 4.0, 3.0),
+                                   ('Server', '-', 'kill', 1, 0.5, 0.5)]
+
+
+def test_chrome_trace(tmpdir):
+    server = Server()
+    timings.record(server, 'launch', 1.5, 0.25)
+    timings.add_records([dict(timings.record(server, 'kill', 2.0, 0.1)._asdict(), worker='gw0')])
+    path = str(tmpdir / 'trace.json')
+    timings.write_chrome_trace(path)
+    with open(path) as f:
+        events = json.load(f)['traceEvents']
+    spans = [e for e in events if e['ph'] == 'X']
+    assert [(e['name'], e['ts'], e['dur']) for e in spans] == [('launch', 1500000, 250000),
+                                                               ('kill', 2000000, 100000),
+                                                               ('kill', 2000000, 100000)]
+    processes = dict((e['pid'], e['args']['name']) for e in events if e['name'] == 'process_name')
+    assert processes == {0: 'gw0', 1: 'master'}